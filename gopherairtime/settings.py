@@ -79,6 +79,20 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared by all web and worker processes, e.g. for the Hotsocket token
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/1'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -136,7 +150,9 @@ BROKER_URL = os.environ.get('RABBITMQ_URL', 'redis://localhost:6379/0')
 
 from kombu import Exchange, Queue
 
-CELERY_DEFAULT_RATE_LIMIT = "30/m"
+# Hotsocket calls are limited across all workers by HOTSOCKET_RATE_LIMITS,
+# so tasks have no per worker rate limit
+CELERY_DEFAULT_RATE_LIMIT = None
 CELERY_DEFAULT_QUEUE = 'gopherairtime'
 CELERY_QUEUES = (
     Queue('gopherairtime',
@@ -156,6 +172,9 @@ CELERY_ROUTES = {
     'recharges.tasks.ready_recharge': {
         'queue': 'gopherairtime',
     },
+    'recharges.tasks.ready_recharges': {
+        'queue': 'gopherairtime',
+    },
     'recharges.tasks.hotsocket_login': {
         'queue': 'gopherairtime',
     },
@@ -168,6 +187,9 @@ CELERY_ROUTES = {
     'recharges.tasks.hotsocket_check_status': {
         'queue': 'gopherairtime',
     },
+    'recharges.tasks.hotsocket_poll_status': {
+        'queue': 'gopherairtime',
+    },
 }
 
 CELERYBEAT_SCHEDULE = {
@@ -175,10 +197,18 @@ CELERYBEAT_SCHEDULE = {
         'task': 'recharges.tasks.hotsocket_login',
         'schedule': timedelta(minutes=60),
     },
+    'ready-every-1-minutes': {
+        'task': 'recharges.tasks.ready_recharges',
+        'schedule': timedelta(minutes=1),
+    },
     'recharge-every-1-minutes': {
         'task': 'recharges.tasks.hotsocket_process_queue',
         'schedule': timedelta(minutes=1),
     },
+    'poll-status-every-10-seconds': {
+        'task': 'recharges.tasks.hotsocket_poll_status',
+        'schedule': timedelta(seconds=10),
+    },
 }
 
 CELERY_TASK_SERIALIZER = 'json'
@@ -188,11 +218,148 @@ CELERY_ACCEPT_CONTENT = ['json']
 HOTSOCKET_API_ENDPOINT = os.environ.get('HOTSOCKET_API_ENDPOINT','http://api.hotsocket.co.za:8080/test')
 HOTSOCKET_API_USERNAME = os.environ.get('HOTSOCKET_API_USERNAME', 'Replaceme_username')
 HOTSOCKET_API_PASSWORD = os.environ.get('HOTSOCKET_API_PASSWORD', 'Replaceme_password')
+# Connections kept open to Hotsocket per worker process, and the connect
+# and read timeouts in seconds. Status lookups are safe to repeat, so
+# they are retried HOTSOCKET_STATUS_RETRIES times on connection errors.
+HOTSOCKET_POOL_SIZE = 10
+HOTSOCKET_CONNECT_TIMEOUT = 3.05
+HOTSOCKET_READ_TIMEOUT = 30
+HOTSOCKET_STATUS_RETRIES = 2
+# Recharge requests that fail with a Hotsocket system error or a rejected
+# token, or that could not connect, are submitted again after
+# HOTSOCKET_RETRY_DELAY seconds, growing by HOTSOCKET_RETRY_BACKOFF per
+# attempt up to HOTSOCKET_RETRY_MAX_DELAY and jittered by up to
+# HOTSOCKET_RETRY_JITTER, until HOTSOCKET_RETRY_MAX_ATTEMPTS have failed.
+HOTSOCKET_RETRY_MAX_ATTEMPTS = 5
+HOTSOCKET_RETRY_DELAY = 30
+HOTSOCKET_RETRY_BACKOFF = 2
+HOTSOCKET_RETRY_MAX_DELAY = 1800
+HOTSOCKET_RETRY_JITTER = 0.5
+# Hotsocket references each worker process takes from the reference
+# sequence at a time
+HOTSOCKET_REFERENCE_BLOCK_SIZE = 100
+# Token bucket limits on Hotsocket requests shared by all workers, as
+# (requests per second, burst) per endpoint and network code. '*' applies
+# to networks that are not listed, and unlisted endpoints are not limited.
+# Requests wait up to HOTSOCKET_RATE_LIMIT_MAX_WAIT seconds for a token
+# before the task is rescheduled.
+HOTSOCKET_RATE_LIMITS = {
+    '/recharge': {'*': (10, 20)},
+    '/status': {'*': (20, 40)},
+}
+HOTSOCKET_RATE_LIMIT_BACKEND = 'redis'
+HOTSOCKET_RATE_LIMIT_MAX_WAIT = 5
+# Longest countdown of a rescheduled recharge submission (seconds)
+HOTSOCKET_RATE_LIMIT_MAX_COUNTDOWN = 60
+# Each Hotsocket endpoint has a circuit breaker shared by all workers. It
+# opens when, within a window of HOTSOCKET_CIRCUIT_WINDOW seconds and after
+# at least HOTSOCKET_CIRCUIT_MIN_REQUESTS requests, the given share of
+# requests failed or took HOTSOCKET_CIRCUIT_SLOW_SECONDS or more. After
+# HOTSOCKET_CIRCUIT_OPEN_SECONDS a single probe request decides whether it
+# closes again.
+HOTSOCKET_CIRCUIT_WINDOW = 30
+HOTSOCKET_CIRCUIT_MIN_REQUESTS = 20
+HOTSOCKET_CIRCUIT_ERROR_RATIO = 0.5
+HOTSOCKET_CIRCUIT_SLOW_SECONDS = 10
+HOTSOCKET_CIRCUIT_SLOW_RATIO = 0.5
+HOTSOCKET_CIRCUIT_OPEN_SECONDS = 30
+HOTSOCKET_CIRCUIT_PROBE_TIMEOUT = 60
+# Requests the dispatch_recharges command keeps in flight at once
+HOTSOCKET_DISPATCHER_CONCURRENCY = 200
+
+# Hotsocket tokens expire two hours after login. Workers keep the token in
+# memory for HOTSOCKET_TOKEN_LOCAL_TTL seconds between checks of the shared
+# cache, and one of them logs in again HOTSOCKET_TOKEN_REFRESH_MARGIN
+# seconds before expiry. Tokens are kept in the Account table for
+# HOTSOCKET_ACCOUNT_RETENTION seconds.
+HOTSOCKET_TOKEN_LIFETIME = 2 * 60 * 60
+HOTSOCKET_TOKEN_REFRESH_MARGIN = 15 * 60
+HOTSOCKET_TOKEN_LOCAL_TTL = 30
+HOTSOCKET_TOKEN_LOCK_TIMEOUT = 30
+HOTSOCKET_ACCOUNT_RETENTION = 24 * 60 * 60
+
+# hotsocket_process_queue claims recharges in batches of this size, up to
+# the maximum per run. Queued submission tasks expire after
+# HOTSOCKET_QUEUED_TIMEOUT seconds, and recharges still Queued once every
+# task for them has expired are requeued. Claiming stops while
+# HOTSOCKET_QUEUED_MAX recharges are Queued, which the /recharge rate limit
+# submits in half the timeout.
+HOTSOCKET_QUEUE_BATCH_SIZE = int(os.environ.get('HOTSOCKET_QUEUE_BATCH_SIZE',
+                                                500))
+HOTSOCKET_QUEUE_MAX_PER_RUN = 10000
+HOTSOCKET_QUEUED_TIMEOUT = 15 * 60
+HOTSOCKET_QUEUED_MAX = int(HOTSOCKET_RATE_LIMITS['/recharge']['*'][0] *
+                           HOTSOCKET_QUEUED_TIMEOUT / 2)
+# hotsocket_poll_status claims due recharges in batches, up to the maximum
+# per run, for HOTSOCKET_POLL_LEASE seconds and makes
+# HOTSOCKET_POLL_CONCURRENCY lookups at once.
+HOTSOCKET_POLL_BATCH_SIZE = int(os.environ.get('HOTSOCKET_POLL_BATCH_SIZE',
+                                               100))
+HOTSOCKET_POLL_MAX_PER_RUN = 5000
+HOTSOCKET_POLL_CONCURRENCY = 10
+HOTSOCKET_POLL_LEASE = 5 * 60
+# The first status check is made at the HOTSOCKET_POLL_FIRST_PERCENTILE
+# submission to final status latency of the recharge's network and product,
+# learned from the last HOTSOCKET_LATENCY_WINDOW seconds and recomputed every
+# HOTSOCKET_LATENCY_CACHE_TTL seconds. Until there are
+# HOTSOCKET_LATENCY_MIN_SAMPLES it is made after HOTSOCKET_STATUS_CHECK_DELAY
+# seconds. Each pending result multiplies the delay by HOTSOCKET_POLL_BACKOFF,
+# +/- HOTSOCKET_POLL_JITTER, between the minimum and maximum delays.
+HOTSOCKET_STATUS_CHECK_DELAY = 60
+HOTSOCKET_LATENCY_PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+HOTSOCKET_POLL_FIRST_PERCENTILE = 0.5
+HOTSOCKET_LATENCY_WINDOW = 24 * 60 * 60
+HOTSOCKET_LATENCY_CACHE_TTL = 5 * 60
+HOTSOCKET_LATENCY_MIN_SAMPLES = 20
+HOTSOCKET_POLL_BACKOFF = 2
+HOTSOCKET_POLL_JITTER = 0.2
+HOTSOCKET_POLL_MIN_DELAY = 5
+HOTSOCKET_POLL_MAX_DELAY = 30 * 60
+# A recharge whose status lookups keep failing with a system error is
+# marked Failed once it has been checked this many times
+HOTSOCKET_STATUS_MAX_CHECKS = 20
 HOTSOCKET_CODES = {
     "LOGIN_SUCCESSFUL": "0000",
     "LOGIN_FAILURE": "5010",
 }
 
+# Numbering rules used to normalise msisdns, keyed by country code.
+# Local numbers are read as belonging to MSISDN_DEFAULT_COUNTRY_CODE.
+MSISDN_DEFAULT_COUNTRY_CODE = os.environ.get('MSISDN_DEFAULT_COUNTRY_CODE',
+                                             '27')
+MSISDN_COUNTRY_RULES = {
+    '27': {
+        'national_lengths': [9],
+        'trunk_prefix': '0',
+        'international_prefix': '00',
+    },
+}
+
+# JSON file mapping network codes to msisdn prefixes, reloaded by running
+# workers when it changes. Defaults to recharges/data/network_prefixes.json
+NETWORK_PREFIX_FILE = os.environ.get('NETWORK_PREFIX_FILE', None)
+NETWORK_PREFIX_RELOAD_INTERVAL = 60
+
+# Number of rows written per bulk insert by the bulk recharge paths
+RECHARGE_BULK_CHUNK_SIZE = int(os.environ.get('RECHARGE_BULK_CHUNK_SIZE',
+                                              1000))
+# Ready recharges inline as the API creates them instead of in a task
+RECHARGE_READY_ON_INGEST = os.environ.get('RECHARGE_READY_ON_INGEST',
+                                          'false').lower() == 'true'
+# Submit recharges to Hotsocket as soon as they are ready. The
+# hotsocket_process_queue beat sweep then only picks up stragglers.
+RECHARGE_SUBMIT_ON_READY = os.environ.get('RECHARGE_SUBMIT_ON_READY',
+                                          'false').lower() == 'true'
+# Number of recharges readied per query by ready_recharges
+RECHARGE_READY_BATCH_SIZE = int(os.environ.get('RECHARGE_READY_BATCH_SIZE',
+                                               1000))
+
+# Seconds the recharge counts on /metrics are cached for, so scrapes do not
+# each count the recharges table
+METRICS_RECHARGE_COUNTS_TTL = 60
+# Port the Celery workers serve their Prometheus metrics on, 0 to disable
+METRICS_WORKER_PORT = int(os.environ.get('METRICS_WORKER_PORT', 0))
+
 
 import djcelery
 djcelery.setup_loader()
@@ -14,6 +14,15 @@ BROKER_BACKEND = 'memory'
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 HOTSOCKET_API_ENDPOINT = 'http://test-hotsocket'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+HOTSOCKET_RATE_LIMITS = {}
+HOTSOCKET_RATE_LIMIT_BACKEND = 'memory'
+
 DATABASES = {
     'default': dj_database_url.config(
         default=os.environ.get(
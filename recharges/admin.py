@@ -5,7 +5,7 @@ from recharges.models import Recharge, Account
 
 class RechargeAdmin(admin.ModelAdmin):
     list_display = ('msisdn', 'amount', 'reference', 'hotsocket_ref',
-                    'status', 'status_message', 'network_code',
+                    'status', 'status_message', 'attempts', 'network_code',
                     'product_code', 'created_at', 'updated_at')
     list_filter = ['status', 'network_code',
                    'product_code', 'created_at', 'updated_at']
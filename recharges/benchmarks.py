@@ -0,0 +1,142 @@
+"""
+Micro-benchmarks for the msisdn normalisation and network lookup that run
+for every recharge and every imported row. Each benchmark reports the time
+per msisdn and the memory allocated per msisdn, and can be checked against
+the limits in data/benchmark_thresholds.json so that a slower
+implementation fails the test run.
+"""
+import gc
+import json
+import os
+import random
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from .networks import get_prefix_file
+from .tasks import (lookup_network_code, lookup_network_codes,
+                    normalize_msisdn, normalize_msisdns)
+
+DEFAULT_THRESHOLD_FILE = os.path.join(
+    os.path.dirname(__file__), 'data', 'benchmark_thresholds.json')
+
+# Ways the same South African number turns up in requests and imports
+LOCAL_FORMATS = (
+    lambda n: '0' + n,
+    lambda n: '0%s %s %s' % (n[:2], n[2:5], n[5:]),
+    lambda n: '(0%s) %s-%s' % (n[:2], n[2:5], n[5:]),
+    lambda n: '0027' + n,
+    lambda n: '+27' + n,
+    lambda n: '+27 %s %s %s' % (n[:2], n[2:5], n[5:]),
+    lambda n: '27' + n,
+    lambda n: ' +27-%s-%s-%s. ' % (n[:2], n[2:5], n[5:]),
+)
+# Inputs that are not South African mobile numbers
+OTHER_INPUTS = ('12345', '31337', '*120#', 'n/a', '+4420794600', '08212')
+
+
+def make_msisdns(count, seed=0):
+    """
+    Returns count msisdns in a realistic mix of formats, with one in ten a
+    shortcode or junk, for networks from the prefix file. The same seed
+    gives the same msisdns.
+    """
+    rand = random.Random(seed)
+    with open(get_prefix_file()) as f:
+        prefixes = sorted(prefix[3:] for network_prefixes in
+                          json.load(f).values()
+                          for prefix in network_prefixes)
+    msisdns = []
+    for _ in range(count):
+        if rand.random() < 0.1:
+            msisdns.append(rand.choice(OTHER_INPUTS))
+            continue
+        prefix = rand.choice(prefixes)
+        number = prefix + ''.join(str(rand.randint(0, 9))
+                                  for _ in range(9 - len(prefix)))
+        msisdns.append(rand.choice(LOCAL_FORMATS)(number))
+    return msisdns
+
+
+# Name, function and whether it takes a list of msisdns rather than one.
+# The functions are looked up when called, so a patched implementation is
+# the one measured.
+BENCHMARKS = (
+    ('normalize_msisdn', lambda msisdn: normalize_msisdn(msisdn), False),
+    ('normalize_msisdns', lambda msisdns: normalize_msisdns(msisdns), True),
+    ('lookup_network_code', lambda msisdn: lookup_network_code(msisdn),
+     False),
+    ('lookup_network_codes',
+     lambda msisdns: lookup_network_codes(msisdns), True),
+)
+
+
+def time_per_op(func, batch, inputs, repeat):
+    """
+    Returns the best time per msisdn over repeat passes, in nanoseconds
+    """
+    def run():
+        if batch:
+            func(inputs)
+        else:
+            for value in inputs:
+                func(value)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) * 1e9 / \
+        len(inputs)
+
+
+def allocated_per_op(func, batch, inputs):
+    """
+    Returns the mean peak memory allocated per msisdn, in bytes, or None
+    where tracemalloc is not available
+    """
+    if tracemalloc is None:
+        return None
+    calls = [inputs] if batch else inputs
+    total = 0
+    for value in calls:
+        tracemalloc.start()
+        func(value)
+        total += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return float(total) / len(inputs)
+
+
+def run_benchmarks(count=10000, repeat=5, seed=0):
+    """
+    Runs every benchmark over count mixed msisdns and returns a dict of
+    benchmark name to its ns_per_op and bytes_per_op
+    """
+    inputs = make_msisdns(count, seed)
+    results = {}
+    for name, func, batch in BENCHMARKS:
+        # Warm up caches, such as the normaliser and prefix index, first
+        time_per_op(func, batch, inputs, 1)
+        gc.collect()
+        results[name] = {
+            "ns_per_op": time_per_op(func, batch, inputs, repeat),
+            "bytes_per_op": allocated_per_op(func, batch, inputs),
+        }
+    return results
+
+
+def load_thresholds(path=None):
+    with open(path or DEFAULT_THRESHOLD_FILE) as f:
+        return json.load(f)
+
+
+def check_thresholds(results, thresholds):
+    """
+    Returns a message for every result above its threshold
+    """
+    failures = []
+    for name, limits in sorted(thresholds.items()):
+        for metric, limit in sorted(limits.items()):
+            value = results.get(name, {}).get(metric)
+            if value is not None and value > limit:
+                failures.append("%s %s is %.0f, above the threshold of %s"
+                                % (name, metric, value, limit))
+    return failures
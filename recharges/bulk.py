@@ -0,0 +1,53 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Recharge
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most size items from iterable without
+    materialising the whole iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_chunk_size():
+    """
+    Returns the configured number of rows per bulk insert
+    """
+    return getattr(settings, 'RECHARGE_BULK_CHUNK_SIZE', 1000)
+
+
+def allocate_recharge_ids(count):
+    """
+    Reserves count primary keys from the Recharge id sequence.
+    bulk_create does not return ids, so they are assigned up front.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            [Recharge._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def bulk_insert_recharges(recharges):
+    """
+    Inserts a list of unsaved Recharge instances in a single query and
+    returns their ids. post_save hooks do not fire for these rows.
+    """
+    if not recharges:
+        return []
+    ids = allocate_recharge_ids(len(recharges))
+    for recharge, recharge_id in zip(recharges, ids):
+        recharge.id = recharge_id
+    Recharge.objects.bulk_create(recharges)
+    return ids
@@ -0,0 +1,138 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of making a Hotsocket request while its circuit is open
+    """
+
+    def __init__(self, wait):
+        super(CircuitOpen, self).__init__(
+            "Hotsocket circuit open for %.0fs" % wait)
+        self.wait = wait
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for a Hotsocket endpoint, kept in the shared cache so
+    that all workers trip and recover together. Requests, errors and slow
+    responses are counted in fixed windows. The circuit opens when enough
+    of a window's requests fail or are slow. Once it has been open for
+    HOTSOCKET_CIRCUIT_OPEN_SECONDS it is half open: a single probe request
+    is let through, and closes the circuit if it succeeds or opens it
+    again if it does not.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def key(self, *parts):
+        return ':'.join(('hotsocket:circuit', self.name) + parts)
+
+    def window_keys(self, now=None):
+        window = str(int((now or time.time()) //
+                         settings.HOTSOCKET_CIRCUIT_WINDOW))
+        return (self.key(window, 'requests'), self.key(window, 'errors'),
+                self.key(window, 'slow'))
+
+    def state(self):
+        """
+        Returns the state of the circuit and, if it is open, the seconds
+        until it is half open
+        """
+        open_key, tripped_key = self.key('open'), self.key('tripped')
+        values = cache.get_many([open_key, tripped_key])
+        if open_key in values:
+            return OPEN, max(0, values[open_key] - time.time())
+        if tripped_key in values:
+            return HALF_OPEN, 0
+        return CLOSED, 0
+
+    def allow(self):
+        """
+        Raises CircuitOpen unless a request may be made. Returns True if
+        the request is the probe of a half open circuit.
+        """
+        state, wait = self.state()
+        if state == OPEN:
+            raise CircuitOpen(wait)
+        if state == HALF_OPEN:
+            if not cache.add(self.key('probe'), 1,
+                             settings.HOTSOCKET_CIRCUIT_PROBE_TIMEOUT):
+                raise CircuitOpen(settings.HOTSOCKET_CIRCUIT_OPEN_SECONDS)
+            return True
+        return False
+
+    def incr(self, key):
+        cache.add(key, 0, settings.HOTSOCKET_CIRCUIT_WINDOW * 2)
+        return cache.incr(key)
+
+    def record(self, probe, error, elapsed):
+        """
+        Records the outcome of a request made after allow()
+        """
+        slow = elapsed >= settings.HOTSOCKET_CIRCUIT_SLOW_SECONDS
+        if probe:
+            if error or slow:
+                self.trip()
+            else:
+                self.reset()
+            return
+        requests_key, errors_key, slow_key = self.window_keys()
+        requests = self.incr(requests_key)
+        if not (error or slow):
+            return
+        if error:
+            self.incr(errors_key)
+        if slow:
+            self.incr(slow_key)
+        if requests < settings.HOTSOCKET_CIRCUIT_MIN_REQUESTS:
+            return
+        counts = cache.get_many([errors_key, slow_key])
+        if counts.get(errors_key, 0) >= \
+                requests * settings.HOTSOCKET_CIRCUIT_ERROR_RATIO or \
+                counts.get(slow_key, 0) >= \
+                requests * settings.HOTSOCKET_CIRCUIT_SLOW_RATIO:
+            self.trip()
+
+    def trip(self):
+        open_seconds = settings.HOTSOCKET_CIRCUIT_OPEN_SECONDS
+        cache.set(self.key('open'), time.time() + open_seconds,
+                  open_seconds)
+        cache.set(self.key('tripped'), 1, None)
+        cache.delete(self.key('probe'))
+
+    def reset(self):
+        cache.delete_many([self.key('tripped'), self.key('probe')] +
+                          list(self.window_keys()))
+
+    def request_limit(self, limit):
+        """
+        Returns how many requests to start now, out of limit: none while
+        the circuit is open and only the probe while it is half open
+        """
+        state, _ = self.state()
+        if state == OPEN:
+            return 0
+        if state == HALF_OPEN:
+            return min(limit, 1)
+        return limit
+
+
+_breakers = {}
+
+
+def get_breaker(endpoint):
+    """
+    Returns the circuit breaker for a Hotsocket endpoint path
+    """
+    if endpoint not in _breakers:
+        _breakers[endpoint] = CircuitBreaker(endpoint.strip('/'))
+    return _breakers[endpoint]
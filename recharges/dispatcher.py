@@ -0,0 +1,257 @@
+"""
+Asyncio dispatcher that submits recharges to Hotsocket and checks their
+status with many requests in flight from a single process. It needs
+Python 3.4+ and aiohttp, and is run with the dispatch_recharges command.
+
+Requests are built and their results recorded by the same methods the
+hotsocket_get_airtime and hotsocket_check_status tasks use, and due status
+checks are claimed the way hotsocket_poll_status claims them. Database
+work runs on the event loop thread; it takes milliseconds, next to
+seconds for a Hotsocket round trip. Getting a token can take as long as
+a Hotsocket login, so it runs on the loop's executor.
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+import aiohttp
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .circuit import CircuitOpen, get_breaker
+from .hotsocket import SYSTEM_ERROR_CODE, TOKEN_ERROR_CODES, status_code
+from .metrics import observe_hotsocket_request
+from .models import Recharge
+from .ratelimit import get_rate_limiter
+from .tasks import (get_token, hotsocket_check_status, hotsocket_get_airtime,
+                    next_check_time)
+from .tokens import TokenUnavailable, token_provider
+
+logger = logging.getLogger(__name__)
+
+
+class NotConnected(aiohttp.ClientError):
+    """
+    Raised when a request could not connect to Hotsocket, so nothing was
+    sent
+    """
+
+
+class HotsocketConnector(aiohttp.TCPConnector):
+    """
+    Connector that tells a failed connection apart from a request that
+    failed once it may have been sent
+    """
+
+    @asyncio.coroutine
+    def connect(self, *args, **kwargs):
+        try:
+            return (yield from super().connect(*args, **kwargs))
+        except (aiohttp.ClientError, OSError) as e:
+            raise NotConnected(str(e)) from e
+
+
+class AsyncHotsocketDispatcher(object):
+
+    def __init__(self, loop, concurrency, batch_size, poll_interval=1.0):
+        self.loop = loop
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.in_flight = set()
+        self.session = aiohttp.ClientSession(
+            connector=HotsocketConnector(limit=concurrency, loop=loop),
+            loop=loop)
+        self.timeout = (settings.HOTSOCKET_CONNECT_TIMEOUT +
+                        settings.HOTSOCKET_READ_TIMEOUT)
+
+    @asyncio.coroutine
+    def post(self, path, data, network_code=None):
+        """
+        Makes a request under the same circuit breaker and rate limit as
+        HotsocketClient.post, waiting for the rate limit on the loop
+        """
+        limiter = get_rate_limiter()
+        while True:
+            wait = limiter.acquire(path, network_code)
+            if not wait:
+                break
+            yield from asyncio.sleep(wait, loop=self.loop)
+        breaker = get_breaker(path)
+        probe = breaker.allow()
+        url = "%s%s" % (settings.HOTSOCKET_API_ENDPOINT, path)
+        # Form values must be strings, as requests would send them
+        data = dict((key, str(value)) for key, value in data.items())
+        start = time.time()
+        error, code = True, None
+        try:
+            response = yield from asyncio.wait_for(
+                self.session.post(url, data=data), self.timeout,
+                loop=self.loop)
+            try:
+                result = yield from response.json()
+            finally:
+                response.release()
+            code = status_code(result)
+            error = response.status >= 500 or code == SYSTEM_ERROR_CODE
+        finally:
+            # Also when the request is cancelled, so a half open
+            # circuit's probe is always released
+            elapsed = time.time() - start
+            breaker.record(probe, error, elapsed)
+            observe_hotsocket_request(path, code, elapsed)
+        return result
+
+    @asyncio.coroutine
+    def run_blocking(self, func, *args):
+        """
+        Runs a call that may block, such as getting a token while this
+        process or another worker logs in, without stalling the loop
+        """
+        def call():
+            try:
+                return func(*args)
+            finally:
+                # A login may have used the database in the executor thread
+                connections.close_all()
+        return (yield from self.loop.run_in_executor(None, call))
+
+    @asyncio.coroutine
+    def post_with_token(self, path, data, network_code=None):
+        """
+        Replays the request with a new token if Hotsocket rejects the
+        token, like HotsocketClient.post_with_token
+        """
+        result = yield from self.post(path, data, network_code)
+        if status_code(result) in TOKEN_ERROR_CODES:
+            token = yield from self.run_blocking(
+                token_provider.replace_token, data["token"])
+            data = dict(data, token=token)
+            result = yield from self.post(path, data, network_code)
+        return result
+
+    @asyncio.coroutine
+    def submit(self, recharge_id):
+        recharge = Recharge.objects.get(id=recharge_id)
+        if recharge.status not in (0, 5) or \
+                not recharge.claim_for_submission():
+            return
+        try:
+            token = yield from self.run_blocking(get_token)
+            data = hotsocket_get_airtime.prep_hotsocket_data(recharge, token)
+            result = yield from self.post_with_token(
+                "/recharge", data, recharge.network_code)
+        except CircuitOpen:
+            recharge.transition(1, 0)
+        except TokenUnavailable:
+            # Nothing was loaded without a token, so submit it again later
+            logger.error("No Hotsocket token for the recharge for %s",
+                         recharge.msisdn)
+            recharge.transition(1, 0)
+        except NotConnected:
+            logger.warning("Recharge request for %s could not connect",
+                           recharge.msisdn)
+            logger.info(hotsocket_get_airtime.fail_attempt(
+                recharge, None, "Could not connect to Hotsocket",
+                retryable=True))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            # The request may have reached Hotsocket, so leave the
+            # recharge in process and let the status check decide, as
+            # hotsocket_get_airtime does
+            logger.exception("Recharge request for %s failed",
+                             recharge.msisdn)
+            recharge.transition(
+                1, 1, submitted_at=timezone.now(), status_checks=0,
+                next_check_at=next_check_time(recharge, 0))
+        else:
+            logger.info(hotsocket_get_airtime.handle_recharge_result(
+                recharge, result, logger))
+
+    @asyncio.coroutine
+    def check(self, recharge_id):
+        recharge = Recharge.objects.get(id=recharge_id)
+        try:
+            token = yield from self.run_blocking(get_token)
+            data = hotsocket_check_status.status_data(recharge, token)
+            result = yield from self.post_with_token(
+                "/status", data, recharge.network_code)
+        except CircuitOpen as e:
+            recharge.transition(1, 1, next_check_at=timezone.now() +
+                                timedelta(seconds=e.wait))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError,
+                TokenUnavailable):
+            # Checked again when the claim's lease ends
+            logger.exception("Status request for %s failed",
+                             recharge.msisdn)
+        else:
+            logger.info(hotsocket_check_status.handle_status_result(
+                recharge, result, logger))
+
+    def start(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    def claim(self):
+        """
+        Starts status checks that are due and submissions of unprocessed
+        recharges, up to the free request slots. Returns the number
+        claimed.
+        """
+        claimed = 0
+        free = get_breaker("/status").request_limit(
+            self.concurrency - len(self.in_flight))
+        if free > 0:
+            lease_until = timezone.now() + timedelta(
+                seconds=settings.HOTSOCKET_POLL_LEASE)
+            for recharge_id in Recharge.objects.claim_due_checks(
+                    min(free, self.batch_size), lease_until):
+                self.start(self.check(recharge_id))
+                claimed += 1
+        free = get_breaker("/recharge").request_limit(
+            self.concurrency - len(self.in_flight))
+        if free > 0:
+            for recharge_id in Recharge.objects.claim_unprocessed(
+                    min(free, self.batch_size)):
+                self.start(self.submit(recharge_id))
+                claimed += 1
+        return claimed
+
+    @asyncio.coroutine
+    def run(self, once=False):
+        """
+        Claims and sends requests until stopped. With once, returns when
+        nothing is left to claim and the requests in flight are done.
+        """
+        while True:
+            claimed = self.claim()
+            if once and not claimed and not self.in_flight:
+                return
+            yield from asyncio.sleep(self.poll_interval, loop=self.loop)
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Waits for the requests in flight before closing the session
+        """
+        if self.in_flight:
+            yield from asyncio.wait(list(self.in_flight), loop=self.loop)
+        self.session.close()
+
+
+def dispatch(concurrency, batch_size, poll_interval=1.0, once=False):
+    """
+    Runs a dispatcher on the event loop until it is stopped or, with
+    once, until the current backlog is submitted
+    """
+    loop = asyncio.get_event_loop()
+    dispatcher = AsyncHotsocketDispatcher(
+        loop, concurrency, batch_size, poll_interval)
+    try:
+        loop.run_until_complete(dispatcher.run(once))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(dispatcher.close())
@@ -0,0 +1,277 @@
+"""
+Fake Hotsocket API for load and failure testing, following the /login,
+/recharge and /status resources of docs/HotsocketSpec_1_1_4_4.pdf. It has no
+Django dependencies; run it with the run_fake_hotsocket command and point
+HOTSOCKET_API_ENDPOINT at it.
+
+Recharges are kept in memory. A submitted recharge reports recharge status
+0 until its completion time, drawn from the completion latency, and then
+succeeds, or fails with the configured failure rate.
+"""
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+try:
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+NETWORK_CODES = ('VOD', 'MTN', 'CELLC', 'TELKOM')
+PRODUCT_CODES = ('AIRTIME', 'DATA', 'SMS')
+
+# Codes that can be injected into responses, with the messages Hotsocket
+# sends for them
+INJECTED_ERRORS = {
+    887: "Token is invalid, please login again to obtain a new one.",
+    889: "Token has timed out, please login again to obtain a new one.",
+    5000: "System error, please try again later.",
+    6016: "Reference must be unique.",
+}
+# Failure messages from the list of recharge status messages
+FAILURE_MESSAGES = (
+    "MNO reports invalid MSISDN (not prepaid). You have not been billed "
+    "for this.",
+    "MNO returned an unspecified error. You have not been billed for "
+    "this.",
+    "Submission error, retry count reached",
+)
+
+
+class InvalidDistribution(ValueError):
+    pass
+
+
+def parse_latency(spec):
+    """
+    Returns a function that draws a latency in seconds from the
+    distribution spec: "fixed:<s>", "uniform:<min>,<max>",
+    "exponential:<mean>" or "lognormal:<median>,<sigma>"
+    """
+    name, _, args = spec.partition(':')
+    try:
+        args = [float(arg) for arg in args.split(',')] if args else []
+    except ValueError:
+        raise InvalidDistribution("Invalid latency %r" % spec)
+    distributions = {
+        'fixed': (1, lambda value: lambda: value),
+        'uniform': (2, lambda low, high: lambda: random.uniform(low, high)),
+        'exponential': (1, lambda mean: lambda: random.expovariate(
+            1.0 / mean) if mean else 0),
+        'lognormal': (2, lambda median, sigma: lambda: median *
+                      random.lognormvariate(0, sigma)),
+    }
+    if name not in distributions or len(args) != distributions[name][0]:
+        raise InvalidDistribution("Invalid latency %r" % spec)
+    return distributions[name][1](*args)
+
+
+def parse_error_rates(specs):
+    """
+    Returns the injected error rates given as "<code>=<rate>" strings
+    """
+    rates = {}
+    for spec in specs:
+        code, _, rate = spec.partition('=')
+        try:
+            code, rate = int(code), float(rate)
+        except ValueError:
+            raise InvalidDistribution("Invalid error rate %r" % spec)
+        if code not in INJECTED_ERRORS:
+            raise InvalidDistribution(
+                "Only %s can be injected" %
+                ", ".join(str(c) for c in sorted(INJECTED_ERRORS)))
+        rates[code] = rate
+    return rates
+
+
+class FakeHotsocket(object):
+    """
+    WSGI application that simulates the Hotsocket API
+
+    latencies maps 'login', 'recharge' and 'status' to a function that
+    returns the seconds to wait before responding, and completion_latency
+    draws the seconds from submission until a recharge is final.
+    error_rates maps injectable status codes to the fraction of requests
+    that get them.
+    """
+
+    def __init__(self, username=None, password=None, latencies=None,
+                 completion_latency=None, failure_rate=0.0,
+                 error_rates=None, token_lifetime=7200,
+                 clock=time.time, sleep=time.sleep):
+        self.username = username
+        self.password = password
+        self.latencies = latencies or {}
+        self.completion_latency = completion_latency or \
+            parse_latency('uniform:5,60')
+        self.failure_rate = failure_rate
+        self.error_rates = error_rates or {}
+        self.token_lifetime = token_lifetime
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.recharges = {}
+        self.hotsocket_refs = itertools.count(1)
+        self.requests = dict.fromkeys(('login', 'recharge', 'status'), 0)
+
+    def __call__(self, environ, start_response):
+        # The resources are also served under /test/, like the real API's
+        resource = environ.get('PATH_INFO', '').strip('/').split('/')[-1]
+        if resource not in self.requests or \
+                environ['REQUEST_METHOD'] != 'POST':
+            start_response('404 Not Found',
+                           [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length).decode('utf-8')
+        data = dict((key, values[0])
+                    for key, values in parse_qs(body).items())
+        with self.lock:
+            self.requests[resource] += 1
+        latency = self.latencies.get(resource)
+        if latency is not None:
+            self.sleep(max(0, latency()))
+
+        response = getattr(self, 'handle_%s' % resource)(data)
+        if data.get('as_json', '').lower() == 'true':
+            content_type = 'application/json'
+            content = json.dumps({"response": response})
+        else:
+            content_type = 'text/xml'
+            content = "<response>%s</response>" % "".join(
+                "<%s>%s</%s>" % (key, value, key)
+                for key, value in sorted(response.items()))
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [content.encode('utf-8')]
+
+    def inject_error(self, codes):
+        """
+        Returns one of the given codes if its error should be injected
+        """
+        for code in codes:
+            if random.random() < self.error_rates.get(code, 0):
+                return code
+        return None
+
+    def error(self, code, message=None):
+        return {"status": code,
+                "message": message or INJECTED_ERRORS[code]}
+
+    def check_token(self, token):
+        """
+        Returns the code of the error for the token, or None if it is valid
+        """
+        with self.lock:
+            issued_at = self.tokens.get(token)
+        if issued_at is None:
+            return 887
+        if self.clock() - issued_at >= self.token_lifetime:
+            return 889
+        return self.inject_error((887, 889))
+
+    def handle_login(self, data):
+        if self.username is not None and (
+                data.get('username') != self.username or
+                data.get('password') != self.password):
+            return self.error(
+                5010, "Login Failure. Incorrect Username or Password.")
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = self.clock()
+        return {"status": "0000", "message": "Login Successful.",
+                "token": token}
+
+    def handle_recharge(self, data):
+        code = self.check_token(data.get('token')) or \
+            self.inject_error((5000, 6016))
+        if code:
+            return self.error(code)
+
+        msisdn = data.get('recipient_msisdn', '')
+        reference = data.get('reference', '')
+        if not msisdn.isdigit():
+            return self.error(6013, "Recipient MSISDN is not numeric.")
+        if not 10 <= len(msisdn) <= 15:
+            return self.error(6014, "Recipient MSISDN is malformed.")
+        if data.get('product_code') not in PRODUCT_CODES:
+            return self.error(
+                6011, "Unrecognized product code, valid codes are "
+                "AIRTIME, DATA, and SMS.")
+        if data.get('network_code') not in NETWORK_CODES:
+            return self.error(6012, "Unrecognized network code.")
+        if not reference.isdigit():
+            return self.error(6017, "Reference must be a numeric value.")
+
+        now = self.clock()
+        with self.lock:
+            if reference in self.recharges:
+                return self.error(6016)
+            hotsocket_ref = next(self.hotsocket_refs)
+            failed = random.random() < self.failure_rate
+            self.recharges[reference] = {
+                "hotsocket_ref": hotsocket_ref,
+                "completes_at": now + max(0, self.completion_latency()),
+                "failure": random.choice(FAILURE_MESSAGES) if failed
+                else None,
+            }
+        return {"status": "0000",
+                "message": "Successfully submitted recharge.",
+                "hotsocket_ref": hotsocket_ref,
+                "serveport_ref": hotsocket_ref}
+
+    def handle_status(self, data):
+        code = self.check_token(data.get('token')) or \
+            self.inject_error((5000,))
+        if code:
+            return self.error(code)
+
+        with self.lock:
+            recharge = self.recharges.get(data.get('reference', ''))
+        response = {"status": "0000",
+                    "message": "Status lookup successful.",
+                    "running_balance": 0}
+        if recharge is None:
+            # Only recharges rejected on submission have status 1
+            response.update(recharge_status_cd=1,
+                            recharge_status="Unknown reference")
+        elif self.clock() < recharge["completes_at"]:
+            response.update(recharge_status_cd=0,
+                            recharge_status="Submitted to network, "
+                            "waiting for recharge response")
+        elif recharge["failure"]:
+            response.update(recharge_status_cd=2,
+                            recharge_status=recharge["failure"])
+        else:
+            response.update(recharge_status_cd=3,
+                            recharge_status="Successful")
+        return response
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # Requests sleep for their latency, so each gets a thread
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_fake_server(host, port, app, quiet=False):
+    """
+    Returns a threaded server for the fake Hotsocket app
+    """
+    return make_server(
+        host, port, app, server_class=ThreadingWSGIServer,
+        handler_class=QuietRequestHandler if quiet else WSGIRequestHandler)
@@ -0,0 +1,165 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .circuit import get_breaker
+from .metrics import observe_hotsocket_request
+from .ratelimit import get_rate_limiter
+from .tokens import token_provider
+
+# Hotsocket status codes for an invalid and an expired token
+TOKEN_ERROR_CODES = (887, 889)
+SYSTEM_ERROR_CODE = 5000
+
+
+def status_code(result):
+    """
+    Returns the status code of a Hotsocket response as a number. The API
+    sends it as either a string or a number.
+    """
+    try:
+        return int(result["response"]["status"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def never_connected(error):
+    """
+    Returns True if a failed request never connected to Hotsocket, so
+    nothing was sent: the connection timed out, was refused, or the host
+    could not be resolved
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class HotsocketClient(object):
+    """
+    Hotsocket API client that keeps connections to the API open in a
+    pooled session. Use get_client() for the client of this process.
+    """
+
+    def __init__(self, endpoint=None, pool_size=None, connect_timeout=None,
+                 read_timeout=None, status_retries=None):
+        self.endpoint = endpoint or settings.HOTSOCKET_API_ENDPOINT
+        if pool_size is None:
+            pool_size = settings.HOTSOCKET_POOL_SIZE
+        self.timeout = (
+            connect_timeout or settings.HOTSOCKET_CONNECT_TIMEOUT,
+            read_timeout or settings.HOTSOCKET_READ_TIMEOUT)
+        if status_retries is None:
+            status_retries = settings.HOTSOCKET_STATUS_RETRIES
+        self.status_retries = status_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def post(self, path, data, retries=0, network_code=None):
+        """
+        POSTs form data to a Hotsocket endpoint and returns the decoded
+        response. Connection errors and timeouts are retried up to retries
+        times, so only pass retries for requests that are safe to repeat.
+        Each attempt waits for the rate limit of the endpoint and network,
+        or raises RateLimited if that wait would be too long, and raises
+        CircuitOpen while the endpoint's circuit is open.
+        """
+        url = "%s%s" % (self.endpoint, path)
+        limiter = get_rate_limiter()
+        breaker = get_breaker(path)
+        attempt = 0
+        while True:
+            limiter.wait(path, network_code)
+            probe = breaker.allow()
+            start = time.time()
+            error, code = True, None
+            try:
+                response = self.session.post(url, data=data,
+                                             timeout=self.timeout)
+                result = response.json()
+                code = status_code(result)
+                error = response.status_code >= 500 or \
+                    code == SYSTEM_ERROR_CODE
+            except (requests.ConnectionError, requests.Timeout, ValueError):
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                continue
+            finally:
+                # Every request is recorded, so a half open circuit's
+                # probe is always released
+                elapsed = time.time() - start
+                breaker.record(probe, error, elapsed)
+                observe_hotsocket_request(path, code, elapsed)
+            return result
+
+    def post_with_token(self, path, data, retries=0, network_code=None):
+        """
+        POSTs data that carries a token. If the token is rejected it is
+        replaced, once for all workers, and the request is replayed with
+        the new token.
+        """
+        result = self.post(path, data, retries, network_code)
+        if status_code(result) in TOKEN_ERROR_CODES:
+            data = dict(data,
+                        token=token_provider.replace_token(data["token"]))
+            result = self.post(path, data, retries, network_code)
+        return result
+
+    def login(self, data):
+        return self.post("/login", data)
+
+    def recharge(self, data):
+        # Never retried, a repeated request could load airtime twice
+        return self.post_with_token("/recharge", data,
+                                    network_code=data.get("network_code"))
+
+    def status(self, data, network_code=None):
+        return self.post_with_token("/status", data, self.status_retries,
+                                    network_code)
+
+
+_client = []
+
+
+def get_client():
+    """
+    Returns the Hotsocket client of this process
+    """
+    if not _client:
+        _client.append(HotsocketClient())
+    return _client[0]
+
+
+def reset_client():
+    for client in _client:
+        client.close()
+    del _client[:]
+
+
+@worker_process_init.connect
+def init_client(**kwargs):
+    # Connections opened before the fork must not be shared with the parent
+    del _client[:]
+    get_client()
+
+
+@receiver(setting_changed)
+def reset_client_settings(setting, **kwargs):
+    if setting.startswith('HOTSOCKET_'):
+        reset_client()
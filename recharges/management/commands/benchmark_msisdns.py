@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recharges.benchmarks import (check_thresholds, load_thresholds,
+                                  run_benchmarks)
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks msisdn normalisation and network lookup over a "
+            "realistic mix of msisdns, reporting ns and bytes allocated per "
+            "msisdn. With --check, fails if any is above its threshold.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count', type=int, default=10000,
+            help="Msisdns per benchmark")
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help="Timed passes per benchmark, of which the best is used")
+        parser.add_argument(
+            '--check', action='store_true', default=False,
+            help="Fail if a benchmark is above its threshold")
+        parser.add_argument(
+            '--thresholds', default=None,
+            help="JSON file of thresholds, "
+                 "recharges/data/benchmark_thresholds.json by default")
+        parser.add_argument(
+            '--json', action='store_true', default=False,
+            help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(options['count'], options['repeat'])
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            for name, result in sorted(results.items()):
+                bytes_per_op = result["bytes_per_op"]
+                self.stdout.write("%-22s %8.0f ns/op %8s bytes/op" % (
+                    name, result["ns_per_op"],
+                    "-" if bytes_per_op is None else "%.0f" % bytes_per_op))
+
+        if options['check']:
+            failures = check_thresholds(
+                results, load_thresholds(options['thresholds']))
+            if failures:
+                raise CommandError("\n".join(failures))
+            self.stdout.write("All benchmarks within their thresholds")
@@ -0,0 +1,264 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from celery import current_app
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from recharges.fakehotsocket import (FakeHotsocket, InvalidDistribution,
+                                     make_fake_server, parse_error_rates,
+                                     parse_latency)
+from recharges.models import Recharge
+from recharges.tasks import (hotsocket_login, hotsocket_poll_status,
+                             hotsocket_process_queue, ready_recharges)
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def percentile(values, fraction):
+    """
+    Returns the fraction percentile of sorted values, interpolating
+    between the closest ranks
+    """
+    if not values:
+        return None
+    rank = (len(values) - 1) * fraction
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(timings):
+    """
+    Returns the throughput and end to end latency percentiles of a run from
+    the (created_at, completed_at) of its finished recharges. Throughput is
+    measured from the first recharge created to the last one finished.
+    """
+    latencies = sorted((completed_at - created_at).total_seconds()
+                       for created_at, completed_at in timings)
+    span = None
+    if timings:
+        span = (max(completed_at for _, completed_at in timings) -
+                min(created_at for created_at, _ in timings)).total_seconds()
+    return {
+        "completed": len(latencies),
+        "throughput": len(latencies) / span if span else None,
+        "latency": dict(
+            ("p%g" % (fraction * 100), percentile(latencies, fraction))
+            for fraction in (0.5, 0.95, 0.99)),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the recharge pipeline from API POST to final status "
+            "against a fake Hotsocket, for each combination of worker "
+            "count and batch size, and saves the results as JSON. Starts "
+            "its own Celery workers, so only run it against a local broker "
+            "and a scratch database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recharges', type=int, default=1000,
+            help="Recharges posted per run")
+        parser.add_argument(
+            '--workers', type=parse_sizes, default=[1, 4, 8],
+            help="Comma separated Celery worker concurrencies to sweep")
+        parser.add_argument(
+            '--batch-sizes', type=parse_sizes, default=[100, 500],
+            help="Comma separated batch sizes to sweep, used for readying, "
+                 "queueing and status polling")
+        parser.add_argument(
+            '--tick', type=float, default=1.0,
+            help="Seconds between runs of the beat tasks")
+        parser.add_argument(
+            '--timeout', type=float, default=600,
+            help="Seconds to wait for a run's recharges to finish")
+        parser.add_argument('--recharge-latency', default='lognormal:0.3,0.5')
+        parser.add_argument('--status-latency', default='lognormal:0.1,0.5')
+        parser.add_argument('--completion-latency', default='fixed:5')
+        parser.add_argument(
+            '--error-rate', action='append', default=[], metavar='CODE=RATE',
+            help="Fraction of fake Hotsocket responses with status CODE")
+        parser.add_argument(
+            '--output', default=None,
+            help="File to save the results to as JSON")
+        parser.add_argument(
+            '--label', default=None,
+            help="Label saved with the results, e.g. the release")
+        parser.add_argument(
+            '--keep', action='store_true', default=False,
+            help="Keep the benchmark's recharges after each run")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("The pipeline needs PostgreSQL")
+        try:
+            app = FakeHotsocket(
+                latencies={
+                    'recharge': parse_latency(options['recharge_latency']),
+                    'status': parse_latency(options['status_latency']),
+                },
+                completion_latency=parse_latency(
+                    options['completion_latency']),
+                failure_rate=0,
+                error_rates=parse_error_rates(options['error_rate']))
+        except InvalidDistribution as e:
+            raise CommandError(str(e))
+
+        server = make_fake_server('127.0.0.1', 0, app, quiet=True)
+        threading.Thread(target=server.serve_forever).start()
+        endpoint = "http://127.0.0.1:%s" % server.server_port
+
+        results = {
+            "label": options['label'],
+            "started_at": timezone.now().isoformat(),
+            "recharges": options['recharges'],
+            "fake_hotsocket": dict(
+                (name, options[name]) for name in (
+                    'recharge_latency', 'status_latency',
+                    'completion_latency', 'error_rate')),
+            "runs": [],
+        }
+        try:
+            with override_settings(HOTSOCKET_API_ENDPOINT=endpoint):
+                hotsocket_login.apply()
+                for workers in options['workers']:
+                    for batch_size in options['batch_sizes']:
+                        run = self.run_pipeline(
+                            endpoint, workers, batch_size, options)
+                        results["runs"].append(run)
+                        self.report(run)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write("Results saved to %s" % options['output'])
+
+    def report(self, run):
+        latency = run["latency"]
+        self.stdout.write(
+            "workers=%(workers)s batch_size=%(batch_size)s: "
+            "%(completed)s/%(recharges)s finished, %(failed)s failed" % run +
+            (", %.1f recharges/s" % run["throughput"]
+             if run["throughput"] else "") +
+            (", p50 %.2fs p95 %.2fs p99 %.2fs" % (
+                latency["p50"], latency["p95"], latency["p99"])
+             if latency["p50"] is not None else "") +
+            ", %.1f queries/recharge (%s)" % (
+                run["queries_per_recharge"], run["query_source"]))
+
+    def start_worker(self, endpoint, workers, batch_size):
+        env = dict(
+            os.environ, HOTSOCKET_API_ENDPOINT=endpoint,
+            RECHARGE_READY_BATCH_SIZE=str(batch_size),
+            HOTSOCKET_QUEUE_BATCH_SIZE=str(batch_size),
+            HOTSOCKET_POLL_BATCH_SIZE=str(batch_size))
+        hostname = "benchmark-%s" % os.getpid()
+        worker = subprocess.Popen(
+            [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+             'celery', 'worker', '--concurrency', str(workers),
+             '--queues', settings.CELERY_DEFAULT_QUEUE,
+             '--hostname', '%s@%%h' % hostname, '--loglevel', 'WARNING'],
+            env=env)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            replies = current_app.control.ping(timeout=1)
+            if any(name.startswith(hostname)
+                   for reply in replies for name in reply):
+                return worker
+        worker.terminate()
+        raise CommandError("The benchmark worker did not start")
+
+    def query_count(self):
+        """
+        Returns the number of statements run on the database so far and
+        how they were counted: exactly with pg_stat_statements, or as
+        transactions without it
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_stat_clear_snapshot()")
+            cursor.execute("SELECT 1 FROM pg_extension "
+                           "WHERE extname = 'pg_stat_statements'")
+            if cursor.fetchone():
+                cursor.execute(
+                    "SELECT sum(calls) FROM pg_stat_statements WHERE dbid = "
+                    "(SELECT oid FROM pg_database "
+                    "WHERE datname = current_database())")
+                return int(cursor.fetchone()[0] or 0), "pg_stat_statements"
+            cursor.execute("SELECT xact_commit + xact_rollback "
+                           "FROM pg_stat_database "
+                           "WHERE datname = current_database()")
+            return int(cursor.fetchone()[0]), "transactions"
+
+    def post_recharges(self, user, count):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        ids = []
+        for i in range(count):
+            response = client.post('/api/v1/recharges/', {
+                "msisdn": "+2782%07d" % i, "amount": 10}, format='json')
+            if response.status_code != 201:
+                raise CommandError("Recharge POST failed: %s" %
+                                   response.content)
+            ids.append(response.data["id"])
+        return ids
+
+    def run_pipeline(self, endpoint, workers, batch_size, options):
+        current_app.control.purge()
+        worker = self.start_worker(endpoint, workers, batch_size)
+        user, _ = User.objects.get_or_create(username='benchmark')
+        ids = []
+        try:
+            queries_before, query_source = self.query_count()
+            # The statements query_count makes before it counts
+            harness_queries = 2
+            start = time.time()
+            ids = self.post_recharges(user, options['recharges'])
+            finished = Recharge.objects.filter(id__in=ids,
+                                               status__in=(2, 3, 4))
+            while time.time() - start < options['timeout']:
+                # The beat tasks, run more often than the beat schedule
+                for task in (ready_recharges, hotsocket_process_queue,
+                             hotsocket_poll_status):
+                    task.apply_async()
+                time.sleep(options['tick'])
+                harness_queries += 1
+                if finished.count() == len(ids):
+                    break
+            elapsed = time.time() - start
+            results = list(finished.values_list('status', 'created_at',
+                                                'completed_at'))
+            harness_queries += 1
+            # Statistics reach the collector after a short delay
+            time.sleep(1)
+            queries_after, _ = self.query_count()
+        finally:
+            worker.terminate()
+            worker.wait()
+            if not options['keep']:
+                Recharge.objects.filter(id__in=ids).delete()
+
+        run = {"workers": workers, "batch_size": batch_size,
+               "recharges": len(ids), "elapsed": elapsed,
+               "failed": sum(1 for status, _, _ in results if status != 2),
+               "query_source": query_source,
+               "queries_per_recharge": float(
+                   queries_after - queries_before - harness_queries) /
+               (len(ids) or 1)}
+        run.update(summarize([(created_at, completed_at)
+                              for _, created_at, completed_at in results]))
+        return run
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Submits unprocessed recharges to Hotsocket and checks their "
+            "status from one asyncio process, with many requests in "
+            "flight at once. Needs Python 3.4+ and aiohttp.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help="Hotsocket requests in flight at once, "
+                 "HOTSOCKET_DISPATCHER_CONCURRENCY by default")
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help="Recharges claimed per query, HOTSOCKET_QUEUE_BATCH_SIZE "
+                 "by default")
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help="Seconds between claims of unprocessed recharges")
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Send the requests that are due now and exit")
+
+    def handle(self, *args, **options):
+        try:
+            from recharges.dispatcher import dispatch
+        except (ImportError, SyntaxError) as e:
+            raise CommandError("The dispatcher needs Python 3.4+ and "
+                               "aiohttp: %s" % e)
+        dispatch(
+            options['concurrency'] or
+            settings.HOTSOCKET_DISPATCHER_CONCURRENCY,
+            options['batch_size'] or settings.HOTSOCKET_QUEUE_BATCH_SIZE,
+            options['poll_interval'], options['once'])
@@ -0,0 +1,117 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from recharges.models import Account, Recharge
+
+
+# Status mix of the seeded rows: almost everything has finished, with a
+# small active pipeline, like a table that has been running for a while
+SEED_SQL = """
+INSERT INTO recharges_recharge (
+    amount, msisdn, reference, hotsocket_ref, status, status_message,
+    network_code, product_code, created_at, updated_at)
+SELECT
+    (1 + g %% 50)::numeric(9, 2),
+    '+2782' || lpad((g %% 10000000)::text, 7, '0'),
+    g,
+    g,
+    CASE
+        WHEN g %% 10000 = 0 THEN NULL
+        WHEN g %% 10000 = 1 THEN 0
+        WHEN g %% 10000 = 2 THEN 5
+        WHEN g %% 1000 = 3 THEN 1
+        WHEN g %% 50 = 4 THEN 3
+        WHEN g %% 200 = 5 THEN 4
+        ELSE 2
+    END,
+    'Seeded',
+    (ARRAY['VOD', 'MTN', 'CELLC', 'TELKOM'])[1 + g %% 4],
+    'AIRTIME',
+    now() - (%s - g) * interval '1 second',
+    now() - (%s - g) * interval '1 second'
+FROM generate_series(1, %s) AS g
+"""
+
+
+class Command(BaseCommand):
+    help = ("Prints EXPLAIN ANALYZE plans for the recharge pipeline's hot "
+            "queries, optionally seeding the table with synthetic rows "
+            "first. Only seed a scratch database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help="Insert this many synthetic recharges first, "
+                 "e.g. --seed 10000000")
+        parser.add_argument(
+            '--no-analyze', action='store_true', default=False,
+            help="Print estimated plans without running the queries")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Query plans are only meaningful on "
+                               "PostgreSQL")
+        if options['seed']:
+            self.seed(options['seed'])
+
+        explain = "EXPLAIN (FORMAT TEXT) " if options['no_analyze'] \
+            else "EXPLAIN (ANALYZE, BUFFERS, FORMAT TEXT) "
+        with connection.cursor() as cursor:
+            for name, queryset in self.hot_queries():
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute(explain + sql, params)
+                self.stdout.write("== %s" % name)
+                self.stdout.write(cursor.mogrify(sql, params).decode())
+                for row in cursor.fetchall():
+                    self.stdout.write("    %s" % row[0])
+                self.stdout.write("")
+
+    def seed(self, count):
+        self.stdout.write("Seeding %s recharges..." % count)
+        with connection.cursor() as cursor:
+            cursor.execute(SEED_SQL, [count, count, count])
+            cursor.execute("ANALYZE recharges_recharge")
+        for _ in range(24 * 30):
+            Account.objects.create(token='seeded')
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE recharges_account")
+
+    def hot_queries(self):
+        """
+        Returns (name, queryset) pairs for the queries the pipeline and the
+        admin run against the recharge and account tables
+        """
+        now = timezone.now()
+        day_ago = now - timedelta(days=1)
+        recharges = Recharge.objects.all()
+        return [
+            ("ready_recharges claim",
+             recharges.filter(status__isnull=True).order_by('id')
+             .values_list('id', flat=True)[:1000]),
+            ("hotsocket_process_queue claim",
+             recharges.filter(status=0).order_by('id')
+             .values_list('id', flat=True)[:500]),
+            ("hotsocket_process_queue stale queued",
+             recharges.filter(status=5, updated_at__lt=now)
+             .values_list('id', flat=True)),
+            ("hotsocket_poll_status claim",
+             recharges.filter(status=1, next_check_at__lte=now)
+             .order_by('next_check_at').values_list('id', flat=True)[:100]),
+            ("admin status + created_at filter",
+             recharges.filter(status=3, created_at__gte=day_ago)
+             .order_by('-id')[:100]),
+            ("admin network + created_at filter",
+             recharges.filter(network_code='MTN', created_at__gte=day_ago)
+             .order_by('-id')[:100]),
+            ("admin msisdn search",
+             recharges.filter(msisdn__icontains='8212345')
+             .order_by('-id')[:100]),
+            ("admin reference search",
+             recharges.filter(reference__icontains='123456')
+             .order_by('-id')[:100]),
+            ("get_token",
+             Account.objects.order_by('-created_at')[:1]),
+        ]
@@ -0,0 +1,152 @@
+import csv
+import io
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+from recharges.bulk import chunked, get_chunk_size
+from recharges.models import Recharge
+from recharges.msisdn import InvalidMsisdn
+from recharges.tasks import normalize_msisdns, lookup_network_codes
+
+
+class Command(BaseCommand):
+    help = ("Streams a CSV or NDJSON file of msisdn, amount and "
+            "product_code rows into ready to process recharges")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or NDJSON file to import")
+        parser.add_argument(
+            '--format', choices=('csv', 'ndjson'), default=None,
+            help="File format, guessed from the extension by default")
+        parser.add_argument(
+            '--country-code', default=None,
+            help="Country code used to normalise local msisdns, "
+                 "MSISDN_DEFAULT_COUNTRY_CODE by default")
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help="Rows per bulk insert, RECHARGE_BULK_CHUNK_SIZE by default")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or self.guess_format(path)
+        chunk_size = options['chunk_size'] or get_chunk_size()
+        self.country_code = options['country_code']
+        self.rejected = 0
+
+        start = time.time()
+        imported = 0
+        with io.open(path, encoding='utf-8', newline='') as source:
+            rows = self.read_rows(source, file_format)
+            for chunk in chunked(rows, chunk_size):
+                recharges = self.prepare_chunk(chunk)
+                if recharges:
+                    Recharge.objects.bulk_create(recharges)
+                imported += len(recharges)
+        elapsed = max(time.time() - start, 1e-6)
+
+        self.stdout.write(
+            "Imported %s recharges, rejected %s rows in %.2fs "
+            "(%.0f rows/s)" % (imported, self.rejected, elapsed,
+                               (imported + self.rejected) / elapsed))
+
+    def guess_format(self, path):
+        if path.endswith('.csv'):
+            return 'csv'
+        if path.endswith(('.ndjson', '.jsonl')):
+            return 'ndjson'
+        raise CommandError("Cannot guess the format of %s, use --format"
+                           % path)
+
+    def read_rows(self, source, file_format):
+        """
+        Yields (line number, row dict) pairs, reading one line at a time
+        """
+        if file_format == 'csv':
+            for line_number, row in self.read_csv(source):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                if not isinstance(row, dict):
+                    self.reject(line_number, "Invalid JSON object")
+                    continue
+                yield line_number, row
+
+    def read_csv(self, source):
+        """
+        Yields (line number, row dict) pairs of the CSV rows, with text
+        values on Python 2 too
+        """
+        if six.PY2:
+            # The Python 2 csv module only reads bytes, so the decoded lines
+            # are encoded again for it, and its values decoded
+            reader = csv.DictReader(line.encode('utf-8') for line in source)
+            for row in reader:
+                yield reader.line_num, dict(
+                    (self.decode(key), self.decode(value))
+                    for key, value in row.items())
+        else:
+            reader = csv.DictReader(source)
+            for row in reader:
+                yield reader.line_num, row
+
+    def decode(self, value):
+        if isinstance(value, six.binary_type):
+            return value.decode('utf-8')
+        return value
+
+    def prepare_chunk(self, rows):
+        """
+        Returns unsaved, readied Recharge instances for the valid rows,
+        normalising and looking up the whole chunk at once
+        """
+        amount_field = Recharge._meta.get_field('amount')
+        product_field = Recharge._meta.get_field('product_code')
+        candidates = []
+        for line_number, row in rows:
+            try:
+                amount = amount_field.clean(row.get('amount'), None)
+                product_code = product_field.clean(
+                    row.get('product_code') or 'AIRTIME', None)
+            except ValidationError as e:
+                self.reject(line_number, "; ".join(e.messages))
+                continue
+            candidates.append((line_number, amount, product_code,
+                               six.text_type(row.get('msisdn') or '')))
+
+        try:
+            msisdns = normalize_msisdns([c[3] for c in candidates],
+                                        self.country_code)
+        except InvalidMsisdn as e:
+            raise CommandError(six.text_type(e))
+        networks = lookup_network_codes([msisdn or ''
+                                         for msisdn in msisdns])
+
+        recharges = []
+        for candidate, msisdn, network in zip(candidates, msisdns,
+                                              networks):
+            line_number, amount, product_code, raw_msisdn = candidate
+            if msisdn is None:
+                self.reject(line_number, "Invalid msisdn %s" % raw_msisdn)
+            elif not network:
+                self.reject(line_number, "Network lookup failed for %s"
+                            % msisdn)
+            else:
+                recharges.append(Recharge(
+                    amount=amount, msisdn=msisdn, product_code=product_code,
+                    network_code=network, status=0))
+        return recharges
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        self.stderr.write("Rejected line %s: %s" % (line_number, reason))
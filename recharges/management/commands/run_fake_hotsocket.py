@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from recharges.fakehotsocket import (FakeHotsocket, InvalidDistribution,
+                                     make_fake_server, parse_error_rates,
+                                     parse_latency)
+
+
+class Command(BaseCommand):
+    help = ("Runs a fake Hotsocket API for load and failure testing. Point "
+            "HOTSOCKET_API_ENDPOINT at it, e.g. http://localhost:8089. "
+            "Latencies are given as fixed:<s>, uniform:<min>,<max>, "
+            "exponential:<mean> or lognormal:<median>,<sigma>.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument(
+            '--username', default=None,
+            help="Only accept logins with this username and --password")
+        parser.add_argument('--password', default=None)
+        parser.add_argument('--login-latency', default='fixed:0.05')
+        parser.add_argument('--recharge-latency', default='lognormal:0.3,0.5')
+        parser.add_argument('--status-latency', default='lognormal:0.1,0.5')
+        parser.add_argument(
+            '--completion-latency', default='lognormal:20,1',
+            help="Seconds from submission until a recharge is final")
+        parser.add_argument(
+            '--failure-rate', type=float, default=0.02,
+            help="Fraction of submitted recharges that fail")
+        parser.add_argument(
+            '--error-rate', action='append', default=[],
+            metavar='CODE=RATE',
+            help="Fraction of requests answered with status CODE, one of "
+                 "887, 889, 5000 or 6016. May be repeated.")
+        parser.add_argument(
+            '--token-lifetime', type=float, default=7200,
+            help="Seconds until a token expires with status 889")
+        parser.add_argument(
+            '--verbose-requests', action='store_true', default=False,
+            help="Log each request")
+
+    def handle(self, *args, **options):
+        try:
+            app = FakeHotsocket(
+                username=options['username'],
+                password=options['password'],
+                latencies={
+                    'login': parse_latency(options['login_latency']),
+                    'recharge': parse_latency(options['recharge_latency']),
+                    'status': parse_latency(options['status_latency']),
+                },
+                completion_latency=parse_latency(
+                    options['completion_latency']),
+                failure_rate=options['failure_rate'],
+                error_rates=parse_error_rates(options['error_rate']),
+                token_lifetime=options['token_lifetime'])
+        except InvalidDistribution as e:
+            raise CommandError(str(e))
+
+        server = make_fake_server(options['host'], options['port'], app,
+                                  quiet=not options['verbose_requests'])
+        self.stdout.write("Fake Hotsocket listening on http://%s:%s" % (
+            options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write("Requests served: %s" % ", ".join(
+                "%s %s" % (resource, count)
+                for resource, count in sorted(app.requests.items())))
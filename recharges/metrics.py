@@ -0,0 +1,178 @@
+"""
+Prometheus metrics for the recharge pipeline, served on /metrics by the web
+processes and by an exporter in each Celery worker. prometheus_client is
+optional; without it nothing is recorded and /metrics is not found.
+
+Under gunicorn or prefork Celery workers each process records its own
+metrics, so set prometheus_multiproc_dir to an empty directory shared by
+the processes of a server and they are reported together.
+"""
+import logging
+import os
+import time
+
+from celery.signals import (task_postrun, task_prerun, worker_process_shutdown,
+                            worker_ready)
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+try:
+    from prometheus_client import (CollectorRegistry, Counter, Histogram,
+                                   generate_latest, start_http_server)
+    from prometheus_client.core import GaugeMetricFamily
+    from prometheus_client import multiprocess
+except ImportError:
+    multiprocess = None
+    enabled = False
+else:
+    enabled = True
+
+logger = logging.getLogger(__name__)
+
+RECHARGE_COUNTS_CACHE_KEY = 'recharges:metrics:recharge_counts'
+# The Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+if enabled:
+    # Metrics of this process. The recharge counts are shared by all
+    # processes, so they are only reported by /metrics.
+    registry = CollectorRegistry()
+    hotsocket_request_seconds = Histogram(
+        'gopherairtime_hotsocket_request_seconds',
+        'Hotsocket request latency, per attempt',
+        ['endpoint'], registry=registry,
+        buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+    hotsocket_responses = Counter(
+        'gopherairtime_hotsocket_responses_total',
+        'Hotsocket responses by status code, or "error" where the request '
+        'failed',
+        ['endpoint', 'code'], registry=registry)
+    token_refreshes = Counter(
+        'gopherairtime_token_refreshes_total',
+        'Hotsocket logins for a new token',
+        ['result'], registry=registry)
+    task_seconds = Histogram(
+        'gopherairtime_task_seconds',
+        'Celery task run time',
+        ['task', 'state'], registry=registry,
+        buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+
+
+def observe_hotsocket_request(endpoint, code, elapsed):
+    """
+    Records a Hotsocket request that took elapsed seconds and got the
+    status code, or None if it failed
+    """
+    if not enabled:
+        return
+    hotsocket_request_seconds.labels(endpoint).observe(elapsed)
+    hotsocket_responses.labels(
+        endpoint, 'error' if code is None else str(code)).inc()
+
+
+def count_token_refresh(success):
+    if enabled:
+        token_refreshes.labels('success' if success else 'failure').inc()
+
+
+# Start times of the tasks running in this process, by task id
+_task_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    if enabled:
+        _task_started[task_id] = time.time()
+
+
+@task_postrun.connect
+def observe_task(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if enabled and started is not None:
+        task_seconds.labels(task.name, state or 'UNKNOWN').observe(
+            time.time() - started)
+
+
+def get_recharge_counts():
+    """
+    Returns (status, network_code, count) for every status and network,
+    counted at most every METRICS_RECHARGE_COUNTS_TTL seconds
+    """
+    counts = cache.get(RECHARGE_COUNTS_CACHE_KEY)
+    if counts is None:
+        from .models import Recharge
+        counts = list(Recharge.objects.order_by()
+                      .values_list('status', 'network_code')
+                      .annotate(Count('id')))
+        cache.set(RECHARGE_COUNTS_CACHE_KEY, counts,
+                  settings.METRICS_RECHARGE_COUNTS_TTL)
+    return counts
+
+
+class RechargeCollector(object):
+    """
+    Reports the cached recharge counts on each scrape
+    """
+
+    def collect(self):
+        from .models import Recharge
+        statuses = dict(Recharge.status_choices)
+        family = GaugeMetricFamily(
+            'gopherairtime_recharges',
+            'Recharges by status and network',
+            labels=['status', 'network_code'])
+        for status, network_code, count in get_recharge_counts():
+            family.add_metric([statuses.get(status, 'Unreadied'),
+                               network_code or ''], count)
+        yield family
+
+
+def multiprocess_dir():
+    return os.environ.get('prometheus_multiproc_dir') or \
+        os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def process_registry():
+    """
+    Returns the registry of this process' metrics, or of the metrics of
+    all processes in multiprocess mode
+    """
+    if multiprocess_dir():
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return registry
+
+
+def render_metrics():
+    """
+    Returns the metrics for /metrics in the Prometheus text format
+    """
+    recharges = CollectorRegistry()
+    recharges.register(RechargeCollector())
+    return generate_latest(process_registry()) + generate_latest(recharges)
+
+
+@worker_ready.connect
+def start_worker_exporter(**kwargs):
+    """
+    Serves the worker's metrics on METRICS_WORKER_PORT, if it is set. Tasks
+    run in the pool's processes, so their metrics only reach this one, the
+    parent, in multiprocess mode.
+    """
+    if not enabled or not settings.METRICS_WORKER_PORT:
+        return
+    if not multiprocess_dir():
+        logger.error("Not serving worker metrics on port %s: set "
+                     "prometheus_multiproc_dir to collect the metrics of "
+                     "the worker's processes", settings.METRICS_WORKER_PORT)
+        return
+    start_http_server(settings.METRICS_WORKER_PORT,
+                      registry=process_registry())
+
+
+@worker_process_shutdown.connect
+def remove_process_metrics(pid=None, **kwargs):
+    if enabled and multiprocess_dir():
+        multiprocess.mark_process_dead(pid or os.getpid())
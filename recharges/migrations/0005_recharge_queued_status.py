@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0004_auto_20151202_1309'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recharge',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Unprocessed'), (1, 'In Process'), (2, 'Successful'), (3, 'Failed'), (4, 'Unrecoverable'), (5, 'Queued')], blank=True, null=True),
+        ),
+    ]
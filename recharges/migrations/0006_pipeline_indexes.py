@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0005_recharge_queued_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='account',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='recharge',
+            index_together=set([('status', 'created_at'), ('network_code', 'created_at')]),
+        ),
+        # Partial indexes for the pipeline sweeps. Only the active rows are
+        # indexed, so these stay small however large the table grows.
+        migrations.RunSQL(
+            'CREATE INDEX recharges_recharge_unreadied_idx '
+            'ON recharges_recharge (id) WHERE status IS NULL',
+            'DROP INDEX recharges_recharge_unreadied_idx',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX recharges_recharge_unprocessed_idx '
+            'ON recharges_recharge (id) WHERE status = 0',
+            'DROP INDEX recharges_recharge_unprocessed_idx',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX recharges_recharge_queued_idx '
+            'ON recharges_recharge (updated_at) WHERE status = 5',
+            'DROP INDEX recharges_recharge_queued_idx',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0006_pipeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recharge',
+            name='next_check_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # Only In Process recharges are polled, so only they are indexed
+        migrations.RunSQL(
+            'CREATE INDEX recharges_recharge_next_check_idx '
+            'ON recharges_recharge (next_check_at) WHERE status = 1',
+            'DROP INDEX recharges_recharge_next_check_idx',
+        ),
+        # Recharges submitted before this migration were waiting on a
+        # hotsocket_check_status task; poll them instead
+        migrations.RunSQL(
+            'UPDATE recharges_recharge SET next_check_at = updated_at '
+            'WHERE status = 1',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0007_recharge_next_check_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recharge',
+            name='submitted_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='recharge',
+            name='checked_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='recharge',
+            name='completed_at',
+            field=models.DateTimeField(null=True, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='recharge',
+            name='status_checks',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0008_recharge_latency_fields'),
+    ]
+
+    operations = [
+        # Random references could collide. Hotsocket rejected every use of a
+        # reference after the first, so only the oldest recharge keeps it.
+        migrations.RunSQL(
+            'UPDATE recharges_recharge SET reference = NULL WHERE id IN ('
+            'SELECT id FROM ('
+            'SELECT id, row_number() OVER ('
+            'PARTITION BY reference ORDER BY id) AS n '
+            'FROM recharges_recharge WHERE reference IS NOT NULL) d '
+            'WHERE n > 1)',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='recharge',
+            name='reference',
+            field=models.IntegerField(null=True, blank=True, unique=True),
+        ),
+        migrations.RunSQL(
+            'CREATE SEQUENCE recharges_recharge_reference_seq '
+            'MAXVALUE 2147483647',
+            'DROP SEQUENCE recharges_recharge_reference_seq',
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recharges', '0009_recharge_unique_reference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recharge',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recharge',
+            name='attempt_history',
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                default=list, blank=True),
+        ),
+        migrations.AddField(
+            model_name='recharge',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
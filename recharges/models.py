@@ -1,8 +1,97 @@
 import uuid
 
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.db import IntegrityError, connection, models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+from .references import allocate_reference
+
+
+class RechargeManager(models.Manager):
+
+    """
+    Claims Unprocessed recharges for submission so that each one is
+    queued to Hotsocket exactly once
+    """
+
+    def claim_unprocessed(self, limit):
+        """
+        Moves up to limit Unprocessed recharges to Queued and returns their
+        ids. Rows locked by a concurrent claim are skipped, not waited on,
+        as are recharges waiting out the backoff before a retry.
+        """
+        now = timezone.now()
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET status = 5, updated_at = %s "
+                "WHERE id IN ("
+                "SELECT id FROM {table} WHERE status = 0 "
+                "AND (next_attempt_at IS NULL OR next_attempt_at <= %s) "
+                "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+                "RETURNING id".format(table=table),
+                [now, now, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def claim(self, recharge_ids):
+        """
+        Moves the given recharges from Unprocessed to Queued and returns
+        the ids that were claimed
+        """
+        if not recharge_ids:
+            return []
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET status = 5, updated_at = %s "
+                "WHERE id = ANY(%s) AND status = 0 "
+                "RETURNING id".format(table=table),
+                [timezone.now(), list(recharge_ids)])
+            return [row[0] for row in cursor.fetchall()]
+
+    def transition(self, recharge_id, from_statuses, to_status, **fields):
+        """
+        Compare-and-set status transition. Moves the recharge to to_status
+        and writes only the given fields, provided its status is still one
+        of from_statuses. Returns True if this caller won the transition.
+        """
+        if not isinstance(from_statuses, (list, tuple, set, frozenset)):
+            from_statuses = [from_statuses]
+        condition = models.Q(status__in=[s for s in from_statuses
+                                         if s is not None])
+        if None in from_statuses:
+            condition |= models.Q(status__isnull=True)
+        fields['updated_at'] = timezone.now()
+        return self.filter(condition, id=recharge_id).update(
+            status=to_status, **fields) == 1
+
+    def claim_due_checks(self, limit, lease_until):
+        """
+        Claims up to limit In Process recharges whose status check is due
+        by moving their next check to lease_until, and returns their ids.
+        A recharge whose poller dies is checked again once the lease ends.
+        """
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET next_check_at = %s "
+                "WHERE id IN ("
+                "SELECT id FROM {table} "
+                "WHERE status = 1 AND next_check_at <= %s "
+                "ORDER BY next_check_at LIMIT %s FOR UPDATE SKIP LOCKED) "
+                "RETURNING id".format(table=table),
+                [lease_until, timezone.now(), limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def release_stale_queued(self, older_than):
+        """
+        Returns recharges that have been Queued since before older_than to
+        Unprocessed, in case their submission task was lost
+        """
+        return self.filter(status=5, updated_at__lt=older_than).update(
+            status=0, updated_at=timezone.now())
 
 
 class Recharge(models.Model):
@@ -12,14 +101,15 @@ class Recharge(models.Model):
     """
     amount = models.DecimalField(max_digits=9, decimal_places=2)
     msisdn = models.CharField(max_length=20)
-    reference = models.IntegerField(null=True, blank=True)
+    reference = models.IntegerField(null=True, blank=True, unique=True)
     hotsocket_ref = models.IntegerField(default=0)
     status_choices = (
         (0, 'Unprocessed'),
         (1, 'In Process'),
         (2, 'Successful'),
         (3, 'Failed'),
-        (4, 'Unrecoverable'))
+        (4, 'Unrecoverable'),
+        (5, 'Queued'))
     status = models.IntegerField(choices=status_choices, null=True, blank=True)
     status_message = models.CharField(max_length=255, null=True, blank=True)
     network_choice = (
@@ -35,19 +125,74 @@ class Recharge(models.Model):
         ('DATA', 'DATA Bundle'))
     product_code = models.CharField(choices=product_choice,
                                     default='AIRTIME', max_length=20)
+    # When hotsocket_poll_status next looks up an In Process recharge
+    next_check_at = models.DateTimeField(null=True, blank=True)
+    # Submission, last pending status check and final status times, from
+    # which the polling schedule is learned
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True,
+                                        db_index=True)
+    status_checks = models.IntegerField(default=0)
+    # Submissions made so far, with the reference, status code and message
+    # of each, and when a retryable failure is next submitted
+    attempts = models.IntegerField(default=0)
+    attempt_history = JSONField(default=list, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = RechargeManager()
+
+    class Meta:
+        # Admin and reporting filters; the pipeline's per-status sweeps
+        # use partial indexes created in migrations 0006 and 0007
+        index_together = [
+            ['status', 'created_at'],
+            ['network_code', 'created_at'],
+        ]
+
     def __str__(self):  # __unicode__ on Python 2
         return "%s recharge for %s" % (self.amount, self.msisdn)
 
+    def transition(self, from_statuses, to_status, **fields):
+        """
+        Compare-and-set transition of this recharge, see
+        RechargeManager.transition. The instance is updated if it wins.
+        """
+        won = Recharge.objects.transition(self.id, from_statuses, to_status,
+                                          **fields)
+        if won:
+            self.status = to_status
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return won
+
+    def claim_for_submission(self):
+        """
+        Moves an Unprocessed or Queued recharge to In Process and gives it
+        a new Hotsocket reference in the same update. Returns True if this
+        caller won the claim.
+        """
+        while True:
+            try:
+                with transaction.atomic():
+                    return self.transition((0, 5), 1,
+                                           reference=allocate_reference())
+            except IntegrityError:
+                # Taken by a recharge given a random reference before
+                # references were allocated from the sequence
+                continue
+
 
 @receiver(post_save, sender=Recharge)
 def recharge_post_save(sender, instance, created, **kwargs):
     """
-    Post save hook to fire Recharge readying task
+    Post save hook to fire Recharge readying task for recharges that were
+    not readied when they were created. With RECHARGE_SUBMIT_ON_READY the
+    readying task also claims the recharge and queues its submission.
     """
-    if created:
+    if created and instance.status is None:
         from .tasks import ready_recharge
         ready_recharge.apply_async(kwargs={"recharge_id": instance.id})
 
@@ -56,8 +201,19 @@ class Account(models.Model):
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     token = models.CharField(max_length=200)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):  # __unicode__ on Python 2
         return "requested token is: %s" % (self.token)
+
+
+@receiver(post_save, sender=Account)
+def account_post_save(sender, instance, created, **kwargs):
+    """
+    Post save hook to publish a newly issued token to all workers
+    """
+    if created:
+        from .tokens import token_provider, to_timestamp
+        token_provider.set_token(instance.token,
+                                 to_timestamp(instance.created_at))
@@ -0,0 +1,133 @@
+import re
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Everything that is not a digit or '+' is formatting noise
+NOISE = re.compile(r'[^\d+]')
+
+
+class InvalidMsisdn(ValueError):
+    """
+    Raised when an msisdn cannot be normalised under the country rules
+    """
+
+
+class CountryRule(object):
+    """
+    Numbering rules for one country, compiled into a single pattern that
+    accepts the local, trunk, international and E.164 forms of a number
+    """
+
+    def __init__(self, country_code, national_lengths, trunk_prefix='0',
+                 international_prefix='00'):
+        self.country_code = country_code
+        self.national_lengths = tuple(sorted(national_lengths))
+        self.trunk_prefix = trunk_prefix
+        self.international_prefix = international_prefix
+
+        national = '|'.join(r'[1-9]\d{%s}' % (length - 1)
+                            for length in reversed(self.national_lengths))
+        prefixes = [re.escape('+' + country_code),
+                    re.escape(international_prefix + country_code),
+                    re.escape(international_prefix)]
+        if trunk_prefix:
+            prefixes.append(re.escape(trunk_prefix))
+        prefixes.append(re.escape(country_code))
+        # Alternatives are tried in order and backtrack, so a number that
+        # only fits once a prefix is stripped is still accepted
+        self.pattern = re.compile(r'^(?:%s)?(%s)$' % (
+            '|'.join(prefixes), national))
+        self.e164_pattern = re.compile(r'^\+%s(%s)$' % (
+            re.escape(country_code), national))
+
+    def normalize(self, digits):
+        """
+        Returns the E.164 form of stripped digits, or None if they do not
+        form a valid number for this country
+        """
+        match = self.pattern.match(digits)
+        if match is None:
+            return None
+        return '+' + self.country_code + match.group(1)
+
+
+class MsisdnNormalizer(object):
+    """
+    Normalises msisdns to E.164 using a set of per-country rules
+    """
+
+    def __init__(self, rules, default_country_code):
+        self.rules = dict((rule.country_code, rule) for rule in rules)
+        self.default_country_code = default_country_code
+
+    def get_rule(self, country_code):
+        try:
+            return self.rules[country_code]
+        except KeyError:
+            raise InvalidMsisdn(
+                "No numbering rules for country code %s" % country_code)
+
+    def normalize_international(self, digits):
+        for rule in self.rules.values():
+            if rule.e164_pattern.match(digits):
+                return digits
+        return None
+
+    def normalize_digits(self, rule, digits):
+        result = rule.normalize(digits)
+        if result is None:
+            if digits.startswith('+'):
+                result = self.normalize_international(digits)
+            elif digits.startswith(rule.international_prefix):
+                result = self.normalize_international(
+                    '+' + digits[len(rule.international_prefix):])
+        return result
+
+    def normalize(self, msisdn, country_code=None):
+        """
+        Returns msisdn in E.164 form, e.g. '082 111 2222' -> '+27821112222'.
+        Local numbers are read using the rules of country_code, which
+        defaults to MSISDN_DEFAULT_COUNTRY_CODE. Raises InvalidMsisdn.
+        """
+        rule = self.get_rule(country_code or self.default_country_code)
+        result = self.normalize_digits(rule, NOISE.sub('', msisdn))
+        if result is None:
+            raise InvalidMsisdn("%s is not a valid msisdn" % msisdn)
+        return result
+
+    def normalize_many(self, msisdns, country_code=None):
+        """
+        Normalises many msisdns in one call. Returns a list in the same
+        order with None in place of invalid msisdns.
+        """
+        rule = self.get_rule(country_code or self.default_country_code)
+        normalize_digits = self.normalize_digits
+        noise = NOISE.sub
+        return [normalize_digits(rule, noise('', msisdn))
+                for msisdn in msisdns]
+
+
+_normalizer = []
+
+
+def build_normalizer():
+    rules = [CountryRule(code, **options)
+             for code, options in settings.MSISDN_COUNTRY_RULES.items()]
+    return MsisdnNormalizer(rules, settings.MSISDN_DEFAULT_COUNTRY_CODE)
+
+
+def get_normalizer():
+    """
+    Returns the normaliser compiled from MSISDN_COUNTRY_RULES
+    """
+    if not _normalizer:
+        _normalizer.append(build_normalizer())
+    return _normalizer[0]
+
+
+@receiver(setting_changed)
+def reset_normalizer(setting, **kwargs):
+    if setting in ('MSISDN_COUNTRY_RULES', 'MSISDN_DEFAULT_COUNTRY_CODE'):
+        del _normalizer[:]
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_PREFIX_FILE = os.path.join(
+    os.path.dirname(__file__), 'data', 'network_prefixes.json')
+
+
+class NetworkPrefixIndex(object):
+    """
+    Character trie over msisdn prefixes that finds the longest matching
+    prefix in a single pass over the msisdn
+    """
+
+    def __init__(self, prefixes):
+        """
+        prefixes maps a network code to a list of msisdn prefixes
+        """
+        self.root = {}
+        for network, network_prefixes in prefixes.items():
+            for prefix in network_prefixes:
+                node = self.root
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                # None cannot be a character, so it marks a complete prefix
+                node[None] = network
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def lookup(self, msisdn):
+        """
+        Returns the network code of the longest matching prefix, or None
+        """
+        node = self.root
+        network = None
+        for char in msisdn:
+            node = node.get(char)
+            if node is None:
+                break
+            network = node.get(None, network)
+        return network
+
+    def lookup_many(self, msisdns):
+        """
+        Returns a list of network codes (or None) in the order given
+        """
+        lookup = self.lookup
+        return [lookup(msisdn) for msisdn in msisdns]
+
+
+_lock = threading.Lock()
+_state = {
+    'index': None,
+    'path': None,
+    'mtime': None,
+    'checked_at': 0,
+}
+
+
+def get_prefix_file():
+    return getattr(settings, 'NETWORK_PREFIX_FILE', None) or \
+        DEFAULT_PREFIX_FILE
+
+
+def reload_prefix_index():
+    """
+    Rebuilds the prefix index from the prefix file and returns it
+    """
+    path = get_prefix_file()
+    with _lock:
+        mtime = os.path.getmtime(path)
+        index = NetworkPrefixIndex.from_file(path)
+        _state.update(index=index, path=path, mtime=mtime,
+                      checked_at=time.time())
+    return index
+
+
+def get_prefix_index():
+    """
+    Returns the loaded prefix index. The prefix file is checked for
+    changes at most once every NETWORK_PREFIX_RELOAD_INTERVAL seconds,
+    so edits are picked up by running workers without a restart.
+    """
+    index = _state['index']
+    path = get_prefix_file()
+    now = time.time()
+    interval = getattr(settings, 'NETWORK_PREFIX_RELOAD_INTERVAL', 60)
+    if index is not None and path == _state['path'] and \
+            now - _state['checked_at'] < interval:
+        return index
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        if index is None:
+            raise
+        # Keep serving the last good table if the file disappears
+        _state['checked_at'] = now
+        return index
+    if index is None or path != _state['path'] or \
+            mtime != _state['mtime']:
+        return reload_prefix_index()
+    _state['checked_at'] = now
+    return index
@@ -0,0 +1,31 @@
+import json
+
+from django.conf import settings
+from django.utils import six
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline delimited JSON into a list of objects, one per
+    non-blank line
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        rows = []
+        for line_number, line in enumerate(stream, 1):
+            if isinstance(line, six.binary_type):
+                line = line.decode(encoding)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line %s - %s' % (
+                    line_number, six.text_type(exc)))
+        return rows
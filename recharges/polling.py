@@ -0,0 +1,101 @@
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+LATENCY_CACHE_KEY = 'hotsocket:latency-percentiles'
+
+# A recharge became final some time between the last check that found it
+# pending (or its submission) and the check that found it final, so the
+# midpoint is used. Latencies learned from observed times alone could only
+# grow, as nothing is observed before the first check.
+LATENCY_SQL = """
+SELECT network_code, product_code, count(*),
+       percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY
+           extract(epoch FROM completed_at - submitted_at) / 2 +
+           extract(epoch FROM coalesce(checked_at, submitted_at) -
+                   submitted_at) / 2)
+FROM recharges_recharge
+WHERE completed_at >= %s AND submitted_at IS NOT NULL AND status IN (2, 3)
+GROUP BY network_code, product_code
+ORDER BY network_code, product_code
+"""
+
+
+def percentile_key(fraction):
+    return "p%g" % (fraction * 100)
+
+
+def compute_latency_percentiles():
+    """
+    Returns the percentiles of submission to final status latency, in
+    seconds, for each network and product over the recharges completed in
+    the last HOTSOCKET_LATENCY_WINDOW seconds
+    """
+    fractions = list(settings.HOTSOCKET_LATENCY_PERCENTILES)
+    since = timezone.now() - timedelta(
+        seconds=settings.HOTSOCKET_LATENCY_WINDOW)
+    with connection.cursor() as cursor:
+        cursor.execute(LATENCY_SQL, [fractions, since])
+        rows = cursor.fetchall()
+    return [{"network_code": network_code,
+             "product_code": product_code,
+             "samples": samples,
+             "percentiles": dict((percentile_key(fraction), value)
+                                 for fraction, value in zip(fractions,
+                                                            values))}
+            for network_code, product_code, samples, values in rows]
+
+
+def get_latency_percentiles():
+    """
+    Returns the latency percentiles, recomputed at most every
+    HOTSOCKET_LATENCY_CACHE_TTL seconds
+    """
+    stats = cache.get(LATENCY_CACHE_KEY)
+    if stats is None:
+        stats = compute_latency_percentiles()
+        cache.set(LATENCY_CACHE_KEY, stats,
+                  settings.HOTSOCKET_LATENCY_CACHE_TTL)
+    return stats
+
+
+def clamp_delay(delay):
+    return min(max(delay, settings.HOTSOCKET_POLL_MIN_DELAY),
+               settings.HOTSOCKET_POLL_MAX_DELAY)
+
+
+def first_check_delay(network_code, product_code, stats=None):
+    """
+    Returns the seconds from submission to the first status check: the
+    HOTSOCKET_POLL_FIRST_PERCENTILE latency of the network and product,
+    or HOTSOCKET_STATUS_CHECK_DELAY until there are enough samples
+    """
+    if stats is None:
+        stats = get_latency_percentiles()
+    key = percentile_key(settings.HOTSOCKET_POLL_FIRST_PERCENTILE)
+    delay = settings.HOTSOCKET_STATUS_CHECK_DELAY
+    for stat in stats:
+        if stat["network_code"] == network_code and \
+                stat["product_code"] == product_code and \
+                stat["samples"] >= settings.HOTSOCKET_LATENCY_MIN_SAMPLES:
+            delay = stat["percentiles"].get(key, delay)
+            break
+    return clamp_delay(delay)
+
+
+def check_delay(network_code, product_code, checks):
+    """
+    Returns the seconds until the next status check of a recharge that
+    has been found pending checks times. The first delay grows by a factor
+    of HOTSOCKET_POLL_BACKOFF per check and is jittered by up to
+    HOTSOCKET_POLL_JITTER, so checks of a burst of recharges spread out.
+    """
+    # The cap is reached long before the exponent could overflow
+    delay = first_check_delay(network_code, product_code) * \
+        settings.HOTSOCKET_POLL_BACKOFF ** min(checks, 32)
+    jitter = settings.HOTSOCKET_POLL_JITTER
+    return clamp_delay(delay * random.uniform(1 - jitter, 1 + jitter))
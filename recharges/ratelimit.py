@@ -0,0 +1,151 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class RateLimited(Exception):
+    """
+    Raised when a Hotsocket request would have to wait longer than
+    HOTSOCKET_RATE_LIMIT_MAX_WAIT seconds for its rate limit
+    """
+
+    def __init__(self, wait):
+        super(RateLimited, self).__init__(
+            "Rate limited for %.2fs" % wait)
+        self.wait = wait
+
+
+# Refills the bucket for the time since it was last used and takes a
+# token if one is available. Returns the seconds until one is, as a string
+# because Redis truncates Lua numbers to integers.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBucketBackend(object):
+    """
+    Token buckets kept in Redis and shared by every worker
+    """
+
+    def __init__(self, client):
+        self.script = client.register_script(TOKEN_BUCKET_LUA)
+
+    def acquire(self, key, rate, capacity, now):
+        return float(self.script(keys=[key], args=[rate, capacity, now]))
+
+
+class MemoryBucketBackend(object):
+    """
+    Token buckets for a single process, for tests and development
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, rate, capacity, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            return wait
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limits per Hotsocket endpoint and network. limits
+    maps an endpoint path to a dict of network code to (requests per
+    second, burst), where '*' applies to networks that are not listed.
+    """
+
+    def __init__(self, backend, limits):
+        self.backend = backend
+        self.limits = limits
+
+    def get_limit(self, endpoint, network_code):
+        limits = self.limits.get(endpoint, {})
+        if network_code in limits:
+            return network_code, limits[network_code]
+        if '*' in limits:
+            return '*', limits['*']
+        return None, None
+
+    def acquire(self, endpoint, network_code=None, now=None):
+        """
+        Takes a token for a request and returns 0, or returns the seconds
+        until a token is available
+        """
+        bucket, limit = self.get_limit(endpoint, network_code)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        key = "hotsocket:ratelimit:%s:%s" % (endpoint.strip('/'), bucket)
+        if now is None:
+            now = time.time()
+        return self.backend.acquire(key, rate, burst, now)
+
+    def wait(self, endpoint, network_code=None):
+        """
+        Blocks until a request may be made, or raises RateLimited if that
+        would take longer than HOTSOCKET_RATE_LIMIT_MAX_WAIT seconds
+        """
+        waited = 0
+        while True:
+            wait = self.acquire(endpoint, network_code)
+            if not wait:
+                return waited
+            if waited + wait > settings.HOTSOCKET_RATE_LIMIT_MAX_WAIT:
+                raise RateLimited(math.ceil(wait))
+            time.sleep(wait)
+            waited += wait
+
+
+def build_backend():
+    if settings.HOTSOCKET_RATE_LIMIT_BACKEND == 'memory':
+        return MemoryBucketBackend()
+    from django_redis import get_redis_connection
+    return RedisBucketBackend(get_redis_connection('default'))
+
+
+_limiter = []
+
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter configured by HOTSOCKET_RATE_LIMITS
+    """
+    if not _limiter:
+        _limiter.append(RateLimiter(build_backend(),
+                                    settings.HOTSOCKET_RATE_LIMITS))
+    return _limiter[0]
+
+
+@receiver(setting_changed)
+def reset_rate_limiter(setting, **kwargs):
+    if setting.startswith('HOTSOCKET_RATE_LIMIT'):
+        del _limiter[:]
@@ -0,0 +1,58 @@
+import threading
+
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.db import connection
+
+# Created in migration 0009, and limited to the largest reference Hotsocket
+# accepts
+REFERENCE_SEQUENCE = 'recharges_recharge_reference_seq'
+
+
+class ReferenceAllocator(object):
+    """
+    Hands out Hotsocket references from the reference sequence. References
+    are fetched in blocks of HOTSOCKET_REFERENCE_BLOCK_SIZE, so most
+    allocations make no query; references left in a block when the process
+    exits are never used.
+    """
+
+    def __init__(self):
+        self.block = []
+        self.lock = threading.Lock()
+
+    def fetch_block(self, size):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(%s) FROM generate_series(1, %s)",
+                [REFERENCE_SEQUENCE, size])
+            # Popped from the end, so allocated in ascending order
+            return sorted((row[0] for row in cursor.fetchall()),
+                          reverse=True)
+
+    def allocate(self):
+        with self.lock:
+            if not self.block:
+                self.block = self.fetch_block(
+                    settings.HOTSOCKET_REFERENCE_BLOCK_SIZE)
+            return self.block.pop()
+
+    def reset(self):
+        with self.lock:
+            self.block = []
+
+
+reference_allocator = ReferenceAllocator()
+
+
+def allocate_reference():
+    """
+    Returns a Hotsocket reference that no other recharge has been given
+    """
+    return reference_allocator.allocate()
+
+
+@worker_process_init.connect
+def reset_references(**kwargs):
+    # A block fetched before the fork would be handed out by every child
+    reference_allocator.reset()
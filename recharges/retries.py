@@ -0,0 +1,48 @@
+import random
+
+from django.conf import settings
+from django.utils import timezone
+
+from .hotsocket import SYSTEM_ERROR_CODE, TOKEN_ERROR_CODES, status_code
+
+# Recharge request failures that a later attempt may not repeat. Every
+# other failure, such as an invalid product, network or msisdn, or a
+# duplicate reference, is permanent.
+RETRYABLE_CODES = (SYSTEM_ERROR_CODE,) + TOKEN_ERROR_CODES
+
+
+def is_retryable(result):
+    """
+    Returns True if a failed recharge request may be submitted again
+    """
+    return status_code(result) in RETRYABLE_CODES
+
+
+def retry_delay(attempts):
+    """
+    Returns the seconds until a recharge that has failed attempts times is
+    submitted again. The delay grows by a factor of HOTSOCKET_RETRY_BACKOFF
+    per attempt and is jittered by up to HOTSOCKET_RETRY_JITTER, so a burst
+    of failures is not resubmitted as a burst.
+    """
+    delay = settings.HOTSOCKET_RETRY_DELAY * \
+        settings.HOTSOCKET_RETRY_BACKOFF ** min(attempts - 1, 32)
+    jitter = settings.HOTSOCKET_RETRY_JITTER
+    return min(delay, settings.HOTSOCKET_RETRY_MAX_DELAY) * \
+        random.uniform(1 - jitter, 1 + jitter)
+
+
+def can_retry(attempts):
+    return attempts < settings.HOTSOCKET_RETRY_MAX_ATTEMPTS
+
+
+def attempt_entry(recharge, code, message):
+    """
+    Returns the attempt_history entry for a submission of the recharge
+    """
+    return {
+        "at": timezone.now().isoformat(),
+        "reference": recharge.reference,
+        "status": code,
+        "message": message,
+    }
@@ -1,5 +1,9 @@
 from django.contrib.auth.models import User, Group
+from django.utils import six
 from .models import Recharge
+from .msisdn import InvalidMsisdn, get_normalizer
+from .tasks import (prepare_recharge, ready_on_ingest, submit_on_ready,
+                    submit_recharges)
 from rest_framework import serializers
 
 
@@ -19,3 +23,27 @@ class RechargeSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Recharge
         fields = ('url', 'id', 'amount', 'msisdn','network_code')
+
+    def validate_msisdn(self, value):
+        """
+        Rejects msisdns that are not valid under the country rules
+        """
+        try:
+            get_normalizer().normalize(value)
+        except InvalidMsisdn as e:
+            raise serializers.ValidationError(six.text_type(e))
+        return value
+
+    def create(self, validated_data):
+        """
+        Inserts the recharge already readied when RECHARGE_READY_ON_INGEST
+        is set, so no readying task is needed
+        """
+        if not ready_on_ingest():
+            return super(RechargeSerializer, self).create(validated_data)
+        recharge = Recharge(**validated_data)
+        prepare_recharge(recharge)
+        recharge.save()
+        if recharge.status == 0 and submit_on_ready():
+            submit_recharges([recharge.id])
+        return recharge
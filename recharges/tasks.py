@@ -1,28 +1,58 @@
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
 import requests
-import random
 from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
 from celery.task import Task
 from celery.utils.log import get_task_logger
 
+from .circuit import CircuitOpen, get_breaker
+from .hotsocket import (SYSTEM_ERROR_CODE, TOKEN_ERROR_CODES, get_client,
+                        never_connected, status_code)
+from .metrics import count_token_refresh
 from .models import Account, Recharge
+from .msisdn import InvalidMsisdn, get_normalizer
+from .networks import get_prefix_index
+from .polling import check_delay
+from .ratelimit import RateLimited
+from .retries import attempt_entry, can_retry, is_retryable, retry_delay
+from .tokens import TokenUnavailable, token_provider
 
 logger = get_task_logger(__name__)
 
 
 def get_token():
     """
-    Returns the last token entry
+    Returns the current Hotsocket token from the shared token provider
+    """
+    return token_provider.get_token()
+
+
+def next_check_time(recharge, checks):
+    """
+    Returns when an In Process recharge that has been found pending checks
+    times should next be looked up, following the learned polling policy
     """
-    account = Account.objects.order_by('created_at').last()
-    return account.token
+    return timezone.now() + timedelta(seconds=check_delay(
+        recharge.network_code, recharge.product_code, checks))
 
 
-def normalize_msisdn(msisdn, country_code='27'):
+def normalize_msisdn(msisdn, country_code=None):
     """
-    Normalizes msisdn using provided country code.
-    Country code defaults to '27' (South Africa)
+    Normalizes msisdn using the numbering rules of the provided country
+    code, which defaults to MSISDN_DEFAULT_COUNTRY_CODE.
     e.g. '082 111 2222' -> '+27821112222'
+    Numbers that fail the strict rules are tidied up best effort. Readying
+    does not use this, as it marks those numbers unrecoverable.
     """
+    country_code = country_code or settings.MSISDN_DEFAULT_COUNTRY_CODE
+    try:
+        return get_normalizer().normalize(msisdn, country_code)
+    except InvalidMsisdn:
+        pass
     # Don't touch shortcodes
     if len(msisdn) <= 5:
         return msisdn
@@ -40,39 +70,97 @@ def normalize_msisdn(msisdn, country_code='27'):
     return msisdn
 
 
+def normalize_msisdns(msisdns, country_code=None):
+    """
+    Strictly normalizes many msisdns in one call, returning a list in the
+    same order with None in place of invalid msisdns
+    """
+    return get_normalizer().normalize_many(msisdns, country_code)
+
+
 def lookup_network_code(msisdn):
     """
-    Determines the network operator based on the first digits
-    in the msisdn.
-    """
-    mtn = ['+27603', '+27604', '+27605',
-           '+27630', '+27631', '+27632',
-           '+27710',
-           '+27717', '+27718', '+27719',
-           '+27810',
-           '+2783', '+2773', '+2778']
-    cellc = ['+27610', '+27611', '+27612', '+27613',
-             '+27615', '+27616', '+27617',
-             '+27618', '+27619', '+27620', '+27621', '+27622', '+27623',
-             '+27624', '+27625', '+27626', '+27627',
-             '+2784', '+2774']
-    telkom = ['+27614',
-              '+27811', '+27812', '+27813', '+27814', '+27815', '+27816',
-              '+27817']
-    vodacom = ['+27606', '+27607', '+27608', '+27609',
-               '+27711', '+27712', '+27713', '+27714', '+27715', '+27716',
-               '+27818',
-               '+2782', '+2772', '+2776', '+2779']
-    if msisdn[0:5] in mtn or msisdn[0:6] in mtn:
-        return "MTN"
-    elif msisdn[0:5] in cellc or msisdn[0:6] in cellc:
-        return "CELLC"
-    elif msisdn[0:5] in telkom or msisdn[0:6] in telkom:
-        return "TELKOM"
-    elif msisdn[0:5] in vodacom or msisdn[0:6] in vodacom:
-        return "VOD"
-    else:
+    Determines the network operator based on the longest matching
+    prefix of the msisdn. Returns False if no prefix matches.
+    """
+    return get_prefix_index().lookup(msisdn) or False
+
+
+def lookup_network_codes(msisdns):
+    """
+    Determines the network operators for many msisdns at once. Returns a
+    list in the same order with False where no prefix matches.
+    """
+    return [network or False
+            for network in get_prefix_index().lookup_many(msisdns)]
+
+
+def prepare_recharge(recharge):
+    """
+    Readies an unsaved or loaded recharge in memory without saving it:
+    normalises the msisdn, sets the network operator and moves it to
+    Unprocessed, or to Unrecoverable if the msisdn is invalid or the
+    network cannot be determined. Returns the network code or False.
+    """
+    try:
+        recharge.msisdn = get_normalizer().normalize(recharge.msisdn)
+    except InvalidMsisdn:
+        recharge.status = 4
+        recharge.status_message = "Invalid msisdn"
         return False
+    network = lookup_network_code(recharge.msisdn)
+    if network:
+        recharge.network_code = network
+        recharge.status = 0
+    else:
+        recharge.status = 4
+        recharge.status_message = "Network lookup failed"
+    return network
+
+
+def ready_on_ingest():
+    """
+    Returns True if recharges should be readied as they are created
+    rather than by the ready_recharge tasks
+    """
+    return getattr(settings, 'RECHARGE_READY_ON_INGEST', False)
+
+
+def submit_on_ready():
+    """
+    Returns True if readied recharges should be submitted to Hotsocket
+    straight away rather than waiting for the hotsocket_process_queue sweep
+    """
+    return getattr(settings, 'RECHARGE_SUBMIT_ON_READY', False)
+
+
+def queue_submission(recharge_id):
+    """
+    Queues the Hotsocket submission of a Queued recharge. The task expires
+    after HOTSOCKET_QUEUED_TIMEOUT seconds, so a recharge that has been
+    Queued for longer can be released without being submitted twice.
+    """
+    hotsocket_get_airtime.apply_async(
+        args=[recharge_id], expires=settings.HOTSOCKET_QUEUED_TIMEOUT)
+
+
+def stale_queued_cutoff():
+    """
+    Returns the time before which Queued recharges have no submission task
+    left to run: every task queued for them, including rate limited
+    retries, has expired
+    """
+    return timezone.now() - timedelta(
+        seconds=settings.HOTSOCKET_QUEUED_TIMEOUT +
+        settings.HOTSOCKET_RATE_LIMIT_MAX_COUNTDOWN)
+
+
+def submit_recharges(recharge_ids):
+    """
+    Claims ready recharges and queues their Hotsocket submission
+    """
+    for recharge_id in Recharge.objects.claim(recharge_ids):
+        queue_submission(recharge_id)
 
 
 class ReadyRecharge(Task):
@@ -82,33 +170,138 @@ class ReadyRecharge(Task):
     """
     name = "recharges.tasks.ready_recharge"
 
-    def run(self, recharge_id, **kwargs):
-        l = self.get_logger(**kwargs)
-        recharge = Recharge.objects.get(id=recharge_id)
-
-        # Normalize the msisdn
-        recharge.msisdn = normalize_msisdn(recharge.msisdn, '27')
-        recharge.save()
-
-        # Set the network operator
-        network = lookup_network_code(recharge.msisdn)
+    def ready(self, recharge, l):
+        """
+        Readies a single loaded recharge and returns a status message
+        """
+        previous_status = recharge.status
+        network = prepare_recharge(recharge)
+        won = Recharge.objects.transition(
+            recharge.id, previous_status, recharge.status,
+            msisdn=recharge.msisdn, network_code=recharge.network_code,
+            status_message=recharge.status_message)
+        if not won:
+            return "Recharge for %s already readied" % recharge.msisdn
         if not network:
-            # If no network is found, mark the recharge unrecoverable
+            # If no network is found, the recharge is unrecoverable
             l.info("Marking recharge as unrecoverable")
-            recharge.status = 4
-            recharge.status_message = "Network lookup failed"
-            recharge.save()
+            if recharge.status_message == "Invalid msisdn":
+                return "Invalid msisdn %s" % recharge.msisdn
             return "Mobile network operator could not be determined for "\
                    "%s" % recharge.msisdn
         else:
-            recharge.network_code = network
-            recharge.status = 0
-            recharge.save()
+            if submit_on_ready():
+                # Claimed first, so hotsocket_process_queue cannot queue
+                # it as well
+                submit_recharges([recharge.id])
             return "Recharge ready to process"
 
+    def run(self, recharge_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        recharge = Recharge.objects.get(id=recharge_id)
+        return self.ready(recharge, l)
+
 ready_recharge = ReadyRecharge()
 
 
+class ReadyRecharges(Task):
+    """
+    Task to ready a batch of recharges in a handful of queries. Readies
+    the given recharge ids, or claims unreadied recharges if none are
+    given. Used by the bulk creation paths and as a periodic sweep.
+    """
+    name = "recharges.tasks.ready_recharges"
+
+    def get_batch_size(self):
+        return getattr(settings, 'RECHARGE_READY_BATCH_SIZE', 1000)
+
+    def claim_ids(self):
+        """
+        Returns a batch of recharge ids that have not been readied
+        """
+        return list(Recharge.objects.filter(status__isnull=True)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:self.get_batch_size()])
+
+    def msisdn_case(self, rows):
+        """
+        Returns an expression that sets each row's msisdn in one UPDATE
+        """
+        return Case(*[When(id=recharge_id, then=Value(msisdn))
+                      for recharge_id, msisdn in rows],
+                    output_field=CharField())
+
+    def ready_batch(self, recharge_ids):
+        """
+        Readies a batch of recharges, returning the ids of the ready
+        recharges and the numbers of recharges this batch readied and
+        marked unrecoverable. Rows readied concurrently are not counted.
+        """
+        rows = list(Recharge.objects.filter(id__in=recharge_ids,
+                                            status__isnull=True)
+                    .values_list('id', 'msisdn'))
+        msisdns = normalize_msisdns([msisdn for _, msisdn in rows])
+        networks = lookup_network_codes([msisdn or '' for msisdn in msisdns])
+
+        ready = {}
+        invalid = []
+        unrecoverable = []
+        for (recharge_id, _), msisdn, network in zip(rows, msisdns,
+                                                     networks):
+            if msisdn is None:
+                invalid.append(recharge_id)
+            elif network:
+                ready.setdefault(network, []).append((recharge_id, msisdn))
+            else:
+                unrecoverable.append((recharge_id, msisdn))
+
+        now = timezone.now()
+        ready_count, unrecoverable_count = 0, 0
+        with transaction.atomic():
+            for network, network_rows in ready.items():
+                ready_count += Recharge.objects.filter(
+                    id__in=[recharge_id for recharge_id, _ in network_rows],
+                    status__isnull=True,
+                ).update(status=0, network_code=network, updated_at=now,
+                         msisdn=self.msisdn_case(network_rows))
+            if unrecoverable:
+                unrecoverable_count = Recharge.objects.filter(
+                    id__in=[recharge_id for recharge_id, _ in unrecoverable],
+                    status__isnull=True,
+                ).update(status=4, status_message="Network lookup failed",
+                         updated_at=now,
+                         msisdn=self.msisdn_case(unrecoverable))
+            if invalid:
+                unrecoverable_count += Recharge.objects.filter(
+                    id__in=invalid, status__isnull=True,
+                ).update(status=4, status_message="Invalid msisdn",
+                         updated_at=now)
+        ready_ids = [recharge_id for network_rows in ready.values()
+                     for recharge_id, _ in network_rows]
+        return ready_ids, ready_count, unrecoverable_count
+
+    def run(self, recharge_ids=None, **kwargs):
+        l = self.get_logger(**kwargs)
+        if recharge_ids is None:
+            recharge_ids = self.claim_ids()
+        ready_count, unrecoverable_count = 0, 0
+        batch_size = self.get_batch_size()
+        for start in range(0, len(recharge_ids), batch_size):
+            ready_ids, ready, unrecoverable = self.ready_batch(
+                recharge_ids[start:start + batch_size])
+            if submit_on_ready():
+                submit_recharges(ready_ids)
+            ready_count += ready
+            unrecoverable_count += unrecoverable
+        if unrecoverable_count:
+            l.info("Marked %s recharges as unrecoverable"
+                   % unrecoverable_count)
+        return "%s recharges ready to process, %s unrecoverable" % (
+            ready_count, unrecoverable_count)
+
+ready_recharges = ReadyRecharges()
+
+
 class HotsocketLogin(Task):
     """
     Task to get the username and password verified then produce a token
@@ -129,10 +322,17 @@ class HotsocketLogin(Task):
         Hotsocket login via post request
         """
         login_data = self.prep_login_data()
-        login_post = requests.post("%s/login" %
-                                   settings.HOTSOCKET_API_ENDPOINT,
-                                   data=login_data)
-        return login_post.json()
+        return get_client().login(login_data)
+
+    def prune_accounts(self, current):
+        """
+        Deletes tokens older than HOTSOCKET_ACCOUNT_RETENTION seconds,
+        always keeping the current one
+        """
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.HOTSOCKET_ACCOUNT_RETENTION)
+        Account.objects.filter(created_at__lt=cutoff).exclude(
+            id=current.id).delete()
 
     def run(self, **kwargs):
 
@@ -142,10 +342,14 @@ class HotsocketLogin(Task):
         # Check the result
         if status == settings.HOTSOCKET_CODES["LOGIN_SUCCESSFUL"]:
             l.info("Successful login to hotsocket")
-            Account.objects.create(token=login_result["response"]["token"])
+            account = Account.objects.create(
+                token=login_result["response"]["token"])
+            self.prune_accounts(account)
+            count_token_refresh(True)
             return True
         else:
             l.error("Failed login to hotsocket")
+            count_token_refresh(False)
             return False
 
 hotsocket_login = HotsocketLogin()
@@ -153,8 +357,9 @@ hotsocket_login = HotsocketLogin()
 
 class HotsocketProcessQueue(Task):
     """
-    Task to get the get all unprocessed recharges and create tasks to
-    submit them to hotsocket
+    Task to claim unprocessed recharges in batches and create tasks to
+    submit them to hotsocket. Only claimed recharges are queued, so each
+    recharge is sent to the broker once however often this runs.
     """
     name = "recharges.tasks.hotsocket_process_queue"
 
@@ -163,11 +368,38 @@ class HotsocketProcessQueue(Task):
         Returns the number of submitted requests
         """
         l = self.get_logger(**kwargs)
-        l.info("Looking up the unprocessed requests")
-        queued = Recharge.objects.filter(status=0)
-        for recharge in queued:
-            hotsocket_get_airtime.apply_async(args=[recharge.id])
-        return "%s requests queued to Hotsocket" % queued.count()
+        released = Recharge.objects.release_stale_queued(
+            stale_queued_cutoff())
+        if released:
+            l.warning("Released %s stale queued recharges" % released)
+
+        # Shed load while Hotsocket is failing, queueing only the probe
+        # while its circuit is half open
+        max_per_run = get_breaker("/recharge").request_limit(
+            settings.HOTSOCKET_QUEUE_MAX_PER_RUN)
+        if not max_per_run:
+            return "Hotsocket circuit open, 0 requests queued"
+        # Queue no more than the rate limit submits before queued tasks
+        # expire, or the rest would expire and be queued again
+        backlog = Recharge.objects.filter(status=5).count()
+        max_per_run = min(max_per_run,
+                          settings.HOTSOCKET_QUEUED_MAX - backlog)
+        if max_per_run <= 0:
+            return "%s recharges already queued, 0 requests queued" % (
+                backlog)
+
+        l.info("Claiming the unprocessed requests")
+        batch_size = settings.HOTSOCKET_QUEUE_BATCH_SIZE
+        queued = 0
+        while queued < max_per_run:
+            recharge_ids = Recharge.objects.claim_unprocessed(
+                min(batch_size, max_per_run - queued))
+            for recharge_id in recharge_ids:
+                queue_submission(recharge_id)
+            queued += len(recharge_ids)
+            if len(recharge_ids) < batch_size:
+                break
+        return "%s requests queued to Hotsocket" % queued
 
 hotsocket_process_queue = HotsocketProcessQueue()
 
@@ -179,20 +411,20 @@ class HotsocketGetAirtime(Task):
     """
     name = "recharges.tasks.hotsocket_get_airtime"
 
-    def prep_hotsocket_data(self, recharge):
+    def prep_hotsocket_data(self, recharge, token=None):
 
         """
         Constructs the dict needed to make a hotsocket airtime request
         msisdn needs no + for HS
         denomination needs to be in cents for HS
+        The reference is given when the recharge is claimed for submission
+        The current token is used unless one is given
         """
-        recharge.reference = random.randint(1, 2147483647)  # max integer val
-        recharge.save()
         hotsocket_data = {
             'username': settings.HOTSOCKET_API_USERNAME,
             'password': settings.HOTSOCKET_API_PASSWORD,
             'as_json': True,
-            'token': get_token(),
+            'token': token or get_token(),
             'recipient_msisdn': recharge.msisdn[1:],
             'product_code': recharge.product_code,
             'network_code': recharge.network_code,
@@ -206,10 +438,66 @@ class HotsocketGetAirtime(Task):
         Makes hotsocket airtime request
         """
         hotsocket_data = self.prep_hotsocket_data(recharge)
-        recharge_post = requests.post("%s/recharge" %
-                                      settings.HOTSOCKET_API_ENDPOINT,
-                                      data=hotsocket_data)
-        return recharge_post.json()
+        return get_client().recharge(hotsocket_data)
+
+    def attempt_fields(self, recharge, code, message):
+        """
+        Returns the fields that record a submission of the recharge
+        """
+        return {
+            "attempts": recharge.attempts + 1,
+            "attempt_history": recharge.attempt_history + [
+                attempt_entry(recharge, code, message)],
+        }
+
+    def fail_attempt(self, recharge, code, message, retryable):
+        """
+        Records a failed submission of an in process recharge. Retryable
+        failures return it to Unprocessed, to be claimed again by
+        hotsocket_process_queue once its backoff ends, until
+        HOTSOCKET_RETRY_MAX_ATTEMPTS submissions have failed. Returns a
+        message for the task result.
+        """
+        fields = self.attempt_fields(recharge, code, message)
+        attempts = fields["attempts"]
+        if retryable and can_retry(attempts):
+            recharge.transition(
+                1, 0, status_message=message,
+                next_attempt_at=timezone.now() + timedelta(
+                    seconds=retry_delay(attempts)), **fields)
+            return "Recharge for %s: Hotsocket failure, attempt %s of %s "\
+                "scheduled" % (recharge.msisdn, attempts + 1,
+                               settings.HOTSOCKET_RETRY_MAX_ATTEMPTS)
+        recharge.transition(1, 3, status_message=message,
+                            completed_at=timezone.now(), **fields)
+        return "Recharge for %s: Hotsocket failure" % (
+               recharge.msisdn)
+
+    def handle_recharge_result(self, recharge, result, l):
+        """
+        Records the result of a recharge request for an in process
+        recharge, scheduling its first status check if Hotsocket accepted
+        it. Returns a message for the task result.
+        """
+        code = status_code(result)
+        if "hotsocket_ref" in result["response"]:
+            recharge.transition(
+                1, 1, hotsocket_ref=result["response"]["hotsocket_ref"],
+                submitted_at=timezone.now(), status_checks=0,
+                next_check_at=next_check_time(recharge, 0),
+                **self.attempt_fields(recharge, code,
+                                      result["response"].get("message")))
+            return "Recharge for %s: Queued at Hotsocket "\
+                "#%s" % (recharge.msisdn, recharge.hotsocket_ref)
+        else:
+            if "message" in result["response"]:
+                l.info("Hotsocket error: %s" % (
+                    result["response"]["message"]))
+                status_message = result["response"]["message"]
+            else:
+                status_message = "Unknown Hotsocket error"
+            return self.fail_attempt(recharge, code, status_message,
+                                     is_retryable(result))
 
     def run(self, recharge_id, **kwargs):
         """
@@ -218,31 +506,53 @@ class HotsocketGetAirtime(Task):
         l = self.get_logger(**kwargs)
         recharge = Recharge.objects.get(id=recharge_id)
         status = recharge.status
-        if status == 0:
-            # Set status to In Process
-            recharge.status = 1
-            recharge.save()
-
+        if status in (0, 5) and not recharge.claim_for_submission():
+            # Another worker claimed it between our read and the update
+            status = 1
+        if status in (0, 5):
             l.info("Making hotsocket recharge request")
-            result = self.request_hotsocket_recharge(recharge)
-            if "hotsocket_ref" in result["response"]:
-                recharge.hotsocket_ref = result["response"]["hotsocket_ref"]
-                recharge.save()
-                hotsocket_check_status.apply_async(args=[recharge_id],
-                                                   countdown=5*60)
-                return "Recharge for %s: Queued at Hotsocket "\
-                    "#%s" % (recharge.msisdn, recharge.hotsocket_ref)
-            else:
-                if "message" in result["response"]:
-                    l.info("Hotsocket error: %s" % (
-                        result["response"]["message"]))
-                    recharge.status_message = result["response"]["message"]
-                else:
-                    recharge.status_message = "Unknown Hotsocket error"
-                recharge.status = 3
-                recharge.save()
-                return "Recharge for %s: Hotsocket failure" % (
-                       recharge.msisdn)
+            try:
+                result = self.request_hotsocket_recharge(recharge)
+            except RateLimited as e:
+                # Nothing was sent, so queue it again for when the rate
+                # limit allows, for as long as it is limited. The retry
+                # expires like any queued submission.
+                countdown = min(e.wait,
+                                settings.HOTSOCKET_RATE_LIMIT_MAX_COUNTDOWN)
+                recharge.transition(1, 5)
+                self.retry(args=[recharge_id], countdown=countdown,
+                           max_retries=None,
+                           expires=countdown +
+                           settings.HOTSOCKET_QUEUED_TIMEOUT)
+            except CircuitOpen:
+                # Nothing was sent; hotsocket_process_queue submits it again
+                # once the circuit closes
+                recharge.transition(1, 0)
+                return "Hotsocket unavailable, recharge for %s left "\
+                    "unprocessed" % recharge.msisdn
+            except TokenUnavailable:
+                # Nothing was loaded without a token; hotsocket_process_queue
+                # submits it again once a login succeeds
+                l.error("No Hotsocket token for the recharge request")
+                recharge.transition(1, 0)
+                return "No Hotsocket token, recharge for %s left "\
+                    "unprocessed" % recharge.msisdn
+            except (requests.RequestException, ValueError) as e:
+                if never_connected(e):
+                    # The connection was never made, so nothing was sent
+                    l.warning("Hotsocket recharge request could not connect")
+                    return self.fail_attempt(
+                        recharge, None, "Could not connect to Hotsocket",
+                        retryable=True)
+                # The request may have reached Hotsocket, so look up its
+                # status rather than failing or resubmitting it
+                l.exception("Hotsocket recharge request failed")
+                recharge.transition(
+                    1, 1, submitted_at=timezone.now(), status_checks=0,
+                    next_check_at=next_check_time(recharge, 0))
+                return "Recharge for %s: Hotsocket request failed, status "\
+                    "check scheduled" % recharge.msisdn
+            return self.handle_recharge_result(recharge, result, l)
 
         elif status == 1:
             return "airtime request for %s already in process by another"\
@@ -261,106 +571,222 @@ class HotsocketCheckStatus(Task):
     """
     Task to check hotsocket recharge request and set the recharge model
     status to successful if the airtime has been loaded to the user's phone.
+    Checks are normally made in batches by hotsocket_poll_status.
     """
     name = "recharges.tasks.hotsocket_check_status"
 
-    def prep_hotsocket_status_dict(self, recharge_id):
+    def status_data(self, recharge, token):
         """
         Constructs the dict needed to make a hotsocket recharge status request
         """
-        recharge = Recharge.objects.get(id=recharge_id)
         hotsocket_data = {
             'username': settings.HOTSOCKET_API_USERNAME,
             'as_json': True,
-            'token': get_token(),
+            'token': token,
             'reference': recharge.reference,
         }
         return hotsocket_data
 
-    def request_hotsocket_status(self, recharge_id):
+    def prep_hotsocket_status_dict(self, recharge_id):
+        """
+        Constructs the status request for a recharge id with the current
+        token
+        """
+        recharge = Recharge.objects.get(id=recharge_id)
+        return self.status_data(recharge, get_token())
+
+    def request_hotsocket_status(self, recharge):
         """
         Makes the POST request to the Hotsocket API
         """
-        hotsocket_data = self.prep_hotsocket_status_dict(recharge_id)
-        recharge_status_post = requests.post("%s/status" %
-                                             settings.HOTSOCKET_API_ENDPOINT,
-                                             data=hotsocket_data)
-        return recharge_status_post.json()
+        hotsocket_data = self.status_data(recharge, get_token())
+        return get_client().status(hotsocket_data, recharge.network_code)
 
-    def run(self, recharge_id, **kwargs):
-        l = self.get_logger(**kwargs)
-        l.info("Looking up Hotsocket status")
-        hs_status = self.request_hotsocket_status(recharge_id)
-        hs_status_code = hs_status["response"]["status"]
+    def not_in_process(self, recharge):
+        """
+        Message for a status result that lost the race to another worker
+        """
+        return "Recharge for %s is no longer in process" % recharge.msisdn
+
+    def check_again(self, recharge, **fields):
+        """
+        Records a check that found the recharge pending and schedules the
+        next one, backing off with each check
+        """
+        checks = recharge.status_checks + 1
+        return recharge.transition(
+            1, 1, checked_at=timezone.now(), status_checks=checks,
+            next_check_at=next_check_time(recharge, checks), **fields)
 
-        if hs_status_code == "0000":
+    def handle_status_result(self, recharge, hs_status, l):
+        """
+        Records the result of a status lookup, scheduling the next check
+        if the recharge is still pending. Returns a message for the task
+        result.
+        """
+        hs_status_code = status_code(hs_status)
+
+        if hs_status_code == 0:
             # recharge status lookup successful
             hs_recharge_status_cd = hs_status["response"]["recharge_status_cd"]
-            recharge = Recharge.objects.get(id=recharge_id)
+            status_message = hs_status["response"]["recharge_status"]
             if hs_recharge_status_cd == 3:
                 # Success
-                recharge.status = 2
-                recharge.status_message = hs_status["response"][
-                    "recharge_status"]
-                recharge.save()
+                if not recharge.transition(1, 2,
+                                           status_message=status_message,
+                                           completed_at=timezone.now()):
+                    return self.not_in_process(recharge)
                 return "Recharge for %s successful" % recharge.msisdn
             elif hs_recharge_status_cd == 2:
                 # Failed
-                recharge.status = 3
-                recharge.status_message = hs_status["response"][
-                    "recharge_status"]
-                recharge.save()
+                if not recharge.transition(1, 3,
+                                           status_message=status_message,
+                                           completed_at=timezone.now()):
+                    return self.not_in_process(recharge)
                 return "Recharge for %s failed. Reason: %s" % (
-                    recharge.msisdn, hs_status["response"]["recharge_status"])
+                    recharge.msisdn, status_message)
             elif hs_recharge_status_cd == 1:
                 # Pre-submission error.
-                recharge.status = 4
-                recharge.status_message = hs_status["response"][
-                    "recharge_status"]
-                recharge.save()
+                if not recharge.transition(1, 4,
+                                           status_message=status_message,
+                                           completed_at=timezone.now()):
+                    return self.not_in_process(recharge)
                 return "Recharge pre-submission for %s errored" % (
                     recharge.msisdn)
             elif hs_recharge_status_cd == 0:
                 # Submitted, not yet successful.
-                recharge.status = 1
-                recharge.status_message = hs_status["response"][
-                    "recharge_status"]
-                recharge.save()
-                # requeue in 5 mins
-                self.retry(args=[recharge_id], countdown=5*60)
+                if not self.check_again(recharge,
+                                        status_message=status_message):
+                    return self.not_in_process(recharge)
                 return "Recharge for %s pending. Check requeued." % (
                     recharge.msisdn,)
-        elif hs_status_code == 887:
-            # invalid token
-            pass
-        elif hs_status_code == 889:
-            # expired token
-            pass
-        elif hs_status_code == 5000:
-            # system error
-            pass
-        elif hs_status_code == 6011:
-            # invalid product
-            pass
-        elif hs_status_code == 6012:
-            # invalid network code
-            pass
-        elif hs_status_code == 6013:
-            # non-numeric msisdn
-            pass
-        elif hs_status_code == 6014:
-            # malformed msisdn
-            pass
-        elif hs_status_code == 6016:
-            # duplicate reference
-            pass
-        elif hs_status_code == 6017:
-            # non-numeric reference
-            pass
-        elif hs_status_code == 6020:
-            # invalid network + product + denomination combination
-            pass
+        elif hs_status_code in TOKEN_ERROR_CODES:
+            # The token was rejected again after being replaced, so check
+            # again later rather than stalling the recharge
+            l.error("Hotsocket rejected a fresh token")
+            if not self.check_again(recharge):
+                return self.not_in_process(recharge)
+            return "Hotsocket rejected the token. Check requeued."
+        elif hs_status_code == SYSTEM_ERROR_CODE:
+            # system error, so check again later, but not forever
+            status_message = hs_status["response"].get(
+                "message", "Hotsocket system error")
+            if recharge.status_checks + 1 >= \
+                    settings.HOTSOCKET_STATUS_MAX_CHECKS:
+                if not recharge.transition(1, 3,
+                                           status_message=status_message,
+                                           completed_at=timezone.now()):
+                    return self.not_in_process(recharge)
+                return "Recharge status for %s unknown after %s checks" % (
+                    recharge.msisdn, recharge.status_checks + 1)
+            if not self.check_again(recharge):
+                return self.not_in_process(recharge)
+            return "Hotsocket system error. Check requeued."
+        elif hs_status_code in (
+                6011,  # invalid product
+                6012,  # invalid network code
+                6013,  # non-numeric msisdn
+                6014,  # malformed msisdn
+                6016,  # duplicate reference
+                6017,  # non-numeric reference
+                6020,  # invalid network + product + denomination combination
+        ):
+            # Checking again will not help
+            status_message = hs_status["response"].get(
+                "message", "Unknown Hotsocket error")
+            if not recharge.transition(1, 3, status_message=status_message,
+                                       completed_at=timezone.now()):
+                return self.not_in_process(recharge)
+            return "Recharge status lookup for %s rejected. Reason: %s" % (
+                recharge.msisdn, status_message)
 
         return "recharge is successful"
 
+    def run(self, recharge_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        l.info("Looking up Hotsocket status")
+        recharge = Recharge.objects.get(id=recharge_id)
+        try:
+            hs_status = self.request_hotsocket_status(recharge)
+        except (RateLimited, CircuitOpen) as e:
+            self.retry(args=[recharge_id], countdown=e.wait)
+        return self.handle_status_result(recharge, hs_status, l)
+
 hotsocket_check_status = HotsocketCheckStatus()
+
+
+class HotsocketPollStatus(Task):
+    """
+    Task to look up the status of In Process recharges whose check is due.
+    Due recharges are claimed in bounded batches and each batch is looked
+    up concurrently, so no delayed status tasks wait in the broker.
+    """
+    name = "recharges.tasks.hotsocket_poll_status"
+
+    def lookup(self, request):
+        """
+        Makes a status lookup in a pool thread. Returns the response, the
+        RateLimited or CircuitOpen error if it was not made, or None if it
+        failed.
+        """
+        hotsocket_data, network_code = request
+        try:
+            return get_client().status(hotsocket_data, network_code)
+        except (RateLimited, CircuitOpen) as e:
+            return e
+        except (requests.RequestException, ValueError):
+            logger.exception("Hotsocket status lookup failed")
+            return None
+        finally:
+            # A token refresh may have used the database in this thread
+            connections.close_all()
+
+    def poll_batch(self, pool, recharge_ids, l):
+        """
+        Looks up a batch of recharges concurrently and records the results
+        on this thread. Failed lookups are retried when the lease ends, and
+        ones that were not made once the rate limit or circuit allows.
+        """
+        recharges = Recharge.objects.in_bulk(recharge_ids)
+        token = get_token()
+        results = pool.map(self.lookup, [
+            (hotsocket_check_status.status_data(recharges[recharge_id],
+                                                token),
+             recharges[recharge_id].network_code)
+            for recharge_id in recharge_ids])
+        for recharge_id, result in zip(recharge_ids, results):
+            recharge = recharges[recharge_id]
+            if isinstance(result, (RateLimited, CircuitOpen)):
+                recharge.transition(1, 1, next_check_at=timezone.now() +
+                                    timedelta(seconds=result.wait))
+            elif result is not None:
+                l.info(hotsocket_check_status.handle_status_result(
+                    recharge, result, l))
+
+    def run(self, **kwargs):
+        """
+        Returns the number of recharges checked
+        """
+        l = self.get_logger(**kwargs)
+        batch_size = settings.HOTSOCKET_POLL_BATCH_SIZE
+        max_per_run = get_breaker("/status").request_limit(
+            settings.HOTSOCKET_POLL_MAX_PER_RUN)
+        checked = 0
+        pool = ThreadPool(settings.HOTSOCKET_POLL_CONCURRENCY)
+        try:
+            while checked < max_per_run:
+                lease_until = timezone.now() + timedelta(
+                    seconds=settings.HOTSOCKET_POLL_LEASE)
+                recharge_ids = Recharge.objects.claim_due_checks(
+                    min(batch_size, max_per_run - checked), lease_until)
+                if recharge_ids:
+                    self.poll_batch(pool, recharge_ids, l)
+                checked += len(recharge_ids)
+                if len(recharge_ids) < batch_size:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        return "%s recharge statuses checked" % checked
+
+hotsocket_poll_status = HotsocketPollStatus()
@@ -1,26 +1,89 @@
 import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO
+from unittest import skipIf
+from wsgiref.util import setup_testing_defaults
+import requests
+from requests.packages.urllib3.exceptions import (MaxRetryError,
+                                                  NewConnectionError)
 import responses
-import pytest
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from django.utils.six.moves.urllib.parse import urlencode
 from django.db.models.signals import post_save
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
-from celery import exceptions
+from celery.app.task import Task as BaseTask
+from celery.exceptions import Retry
 
 try:
     from unittest.mock import patch
 except ImportError:
     from mock import patch
 
+try:
+    import asyncio
+    import aiohttp
+    from recharges.dispatcher import AsyncHotsocketDispatcher, NotConnected
+except (ImportError, SyntaxError):
+    AsyncHotsocketDispatcher = None
+
+try:
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
+
 
 from recharges.models import Recharge, Account, recharge_post_save
-from recharges.tasks import (hotsocket_login, hotsocket_process_queue,
+from recharges.tasks import (ready_recharge, ready_recharges,
+                             hotsocket_login, hotsocket_process_queue,
                              hotsocket_get_airtime, get_token,
-                             hotsocket_check_status,
-                             normalize_msisdn, lookup_network_code)
+                             hotsocket_check_status, hotsocket_poll_status,
+                             normalize_msisdn, lookup_network_code,
+                             lookup_network_codes, normalize_msisdns)
+from recharges.msisdn import InvalidMsisdn, get_normalizer
+from recharges.hotsocket import HotsocketClient, get_client
+from recharges import metrics
+from recharges.networks import NetworkPrefixIndex
+from recharges.circuit import CircuitOpen, get_breaker
+from recharges.benchmarks import (check_thresholds, load_thresholds,
+                                  make_msisdns, run_benchmarks)
+from recharges.management.commands.benchmark_pipeline import (
+    percentile, summarize)
+from recharges.fakehotsocket import (FakeHotsocket, InvalidDistribution,
+                                     make_fake_server, parse_error_rates,
+                                     parse_latency)
+from recharges.retries import is_retryable, retry_delay
+from recharges.references import allocate_reference, reference_allocator
+from recharges.ratelimit import (MemoryBucketBackend, RateLimited,
+                                 RateLimiter, get_rate_limiter)
+from recharges.polling import (check_delay, first_check_delay,
+                               get_latency_percentiles)
+from recharges.tokens import TokenUnavailable, token_provider
+
+
+def count_queries_and_publishes(func):
+    """
+    Calls func and returns the number of queries it made and the names of
+    the tasks it published, in order. Published tasks are not run.
+    """
+    with CaptureQueriesContext(connection) as queries, \
+            patch.object(BaseTask, 'apply_async', autospec=True) as publish:
+        func()
+    return len(queries), [call[0][0].name for call in publish.call_args_list]
 
 
 class FencedTestCase(TestCase):
@@ -46,6 +109,9 @@ class FencedTestCase(TestCase):
     def setUp(self):
         super(FencedTestCase, self).setUp()
         self._replace_post_save_hooks()
+        cache.clear()
+        token_provider.reset()
+        reference_allocator.reset()
 
     def tearDown(self):
         self._restore_post_save_hooks()
@@ -71,6 +137,21 @@ class TaskTestCase(FencedTestCase):
             amount=amount, msisdn=msisdn, status=status)
         return recharge.id
 
+    def add_response_sequence(self, path, *bodies):
+        """
+        Mocks a Hotsocket endpoint that returns bodies in order, repeating
+        the last one
+        """
+        bodies = list(bodies)
+
+        def callback(request):
+            body = bodies.pop(0) if len(bodies) > 1 else bodies[0]
+            return (200, {}, json.dumps(body))
+
+        responses.add_callback(
+            responses.POST, "http://test-hotsocket%s" % path,
+            callback=callback, content_type='application/json')
+
     def setUp(self):
         super(TaskTestCase, self).setUp()
 
@@ -121,6 +202,56 @@ class TestRechargeAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.status, None)
         self.assertEqual(d.hotsocket_ref, 0)
 
+    def test_create_recharge_ready_on_ingest(self):
+        post_data = {
+            "amount": "10.0",
+            "msisdn": "084 123 4023"
+        }
+        post_save.connect(recharge_post_save, sender=Recharge)
+        try:
+            with self.settings(RECHARGE_READY_ON_INGEST=True), \
+                    patch("recharges.tasks.ready_recharge.apply_async") as \
+                    ready:
+                response = self.client.post('/api/v1/recharges/',
+                                            json.dumps(post_data),
+                                            content_type='application/json')
+        finally:
+            post_save.disconnect(recharge_post_save, sender=Recharge)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ready.call_count, 0)
+        d = Recharge.objects.last()
+        self.assertEqual(d.msisdn, "+27841234023")
+        self.assertEqual(d.network_code, "CELLC")
+        self.assertEqual(d.status, 0)
+
+    def test_create_recharge_bad_msisdn(self):
+        post_data = {
+            "amount": "10.0",
+            "msisdn": "084 123 402"
+        }
+        response = self.client.post('/api/v1/recharges/',
+                                    json.dumps(post_data),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("msisdn", response.data)
+        self.assertEqual(Recharge.objects.all().count(), 0)
+
+    def test_create_recharge_bad_msisdn_non_ascii(self):
+        post_data = {
+            "amount": "10.0",
+            "msisdn": u"084 123 40\u00e9"
+        }
+        response = self.client.post('/api/v1/recharges/',
+                                    json.dumps(post_data),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["msisdn"],
+                         [u"084 123 40\u00e9 is not a valid msisdn"])
+        self.assertEqual(Recharge.objects.all().count(), 0)
+
     def test_create_recharge_bad_model_data(self):
         post_data = {
             "amount": "99999999999888888650.00",
@@ -136,6 +267,120 @@ class TestRechargeAPI(AuthenticatedAPITestCase):
         self.assertEqual(d, 0)
 
 
+class TestLatencyAPI(AuthenticatedAPITestCase):
+    """Learned latency endpoint testing"""
+
+    def test_latency_list(self):
+        # Setup
+        now = timezone.now()
+        for _ in range(20):
+            Recharge.objects.create(
+                amount=10, msisdn="+27830000000", network_code="MTN",
+                status=2, submitted_at=now - timedelta(seconds=40),
+                completed_at=now)
+        # Execute
+        response = self.client.get('/api/v1/latency/')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]["network_code"], "MTN")
+        self.assertEqual(response.data[0]["product_code"], "AIRTIME")
+        self.assertEqual(response.data[0]["samples"], 20)
+        self.assertAlmostEqual(response.data[0]["percentiles"]["p50"], 20)
+        self.assertAlmostEqual(response.data[0]["first_check_delay"], 20)
+
+    def test_latency_requires_auth(self):
+        # Setup
+        self.client.credentials()
+        # Execute
+        response = self.client.get('/api/v1/latency/')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TestBulkRechargeAPI(AuthenticatedAPITestCase):
+    """Bulk recharge creation testing"""
+
+    def test_bulk_create_json(self):
+        post_data = [
+            {"amount": "10.0", "msisdn": "0724455545"},
+            {"amount": "99999999999888888650.00", "msisdn": "0724455545"},
+            {"amount": "20.0", "msisdn": "+27844525677"},
+        ]
+        with self.settings(RECHARGE_BULK_CHUNK_SIZE=1):
+            response = self.client.post('/api/v1/recharges/bulk/',
+                                        json.dumps(post_data),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["errors"], 1)
+        results = response.data["results"]
+        self.assertEqual([r["row"] for r in results], [0, 1, 2])
+        self.assertIn("amount", results[1]["errors"])
+
+        r1 = Recharge.objects.get(id=results[0]["id"])
+        self.assertEqual(r1.msisdn, "+27724455545")
+        self.assertEqual(r1.network_code, "MTN")
+        self.assertEqual(r1.status, 0)
+        r3 = Recharge.objects.get(id=results[2]["id"])
+        self.assertEqual(r3.amount, 20.0)
+        self.assertEqual(r3.network_code, "CELLC")
+
+    def test_bulk_create_ndjson(self):
+        body = '{"amount": "10.0", "msisdn": "0724455545"}\n' \
+               '\n' \
+               '{"amount": "5.0", "msisdn": "0844525677"}\n'
+        with patch("recharges.tasks.ready_recharges.apply_async") as ready:
+            response = self.client.post('/api/v1/recharges/bulk/', body,
+                                        content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(Recharge.objects.all().count(), 2)
+        # one readying task for the whole chunk
+        self.assertEqual(ready.call_count, 1)
+        ids = [r["id"] for r in response.data["results"]]
+        self.assertEqual(ready.call_args[1]["args"], [ids])
+
+    def test_bulk_create_ready_on_ingest(self):
+        post_data = [
+            {"amount": "10.0", "msisdn": "0724455545"},
+            {"amount": "10.0", "msisdn": "0214567890"},
+        ]
+        with self.settings(RECHARGE_READY_ON_INGEST=True), \
+                patch("recharges.tasks.ready_recharges.apply_async") as ready:
+            response = self.client.post('/api/v1/recharges/bulk/',
+                                        json.dumps(post_data),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ready.call_count, 0)
+        results = response.data["results"]
+        r1 = Recharge.objects.get(id=results[0]["id"])
+        self.assertEqual((r1.msisdn, r1.network_code, r1.status),
+                         ("+27724455545", "MTN", 0))
+        r2 = Recharge.objects.get(id=results[1]["id"])
+        self.assertEqual((r2.status, r2.status_message),
+                         (4, "Network lookup failed"))
+
+    def test_bulk_create_bad_ndjson(self):
+        body = '{"amount": "10.0", "msisdn": "0724455545"}\n{"amount": '
+        response = self.client.post('/api/v1/recharges/bulk/', body,
+                                    content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Recharge.objects.all().count(), 0)
+
+    def test_bulk_create_not_a_list(self):
+        response = self.client.post('/api/v1/recharges/bulk/',
+                                    json.dumps({"amount": "10.0"}),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Recharge.objects.all().count(), 0)
+
+
 class TestHelpers(TaskTestCase):
     """Testing helpers defined for TaskTestCase"""
 
@@ -170,17 +415,266 @@ class TestPostSaveHooks(TaskTestCase):
         # Setup
         # restore post_save hook for this test
         post_save.connect(recharge_post_save, sender=Recharge)
-        recharge_id = self.make_recharge(msisdn="272134567890")
+        recharge_id = self.make_recharge(msisdn="0214567890")
         # Execute
         recharge = Recharge.objects.get(id=recharge_id)
         # Check
-        self.assertEqual(recharge.msisdn, "+272134567890")
+        self.assertEqual(recharge.msisdn, "+27214567890")
         self.assertEqual(recharge.status, 4)
         self.assertEqual(recharge.status_message, "Network lookup failed")
         # Teardown
         # disconnect post_save hook again
         post_save.disconnect(recharge_post_save, sender=Recharge)
 
+    def test_make_recharge_readies_data_invalid_msisdn(self):
+        # Setup
+        # restore post_save hook for this test
+        post_save.connect(recharge_post_save, sender=Recharge)
+        recharge_id = self.make_recharge(msisdn="0821234")
+        # Execute
+        recharge = Recharge.objects.get(id=recharge_id)
+        # Check
+        self.assertEqual(recharge.msisdn, "0821234")
+        self.assertEqual(recharge.network_code, None)
+        self.assertEqual(recharge.status, 4)
+        self.assertEqual(recharge.status_message, "Invalid msisdn")
+        # Teardown
+        # disconnect post_save hook again
+        post_save.disconnect(recharge_post_save, sender=Recharge)
+
+
+class TestReadyRecharges(TaskTestCase):
+    """Test related to the batch ready_recharges task"""
+
+    def test_ready_recharges_ids(self):
+        # Setup
+        r1_id = self.make_recharge(msisdn="0724455545")
+        r2_id = self.make_recharge(msisdn="272134567890")
+        r3_id = self.make_recharge(msisdn="084 452 5677")
+        r4_id = self.make_recharge(msisdn="0724455545", status=2)
+        r5_id = self.make_recharge(msisdn="0724455545")
+        r6_id = self.make_recharge(msisdn="0214567890")
+        # Execute
+        result = ready_recharges.apply_async(
+            args=[[r1_id, r2_id, r3_id, r4_id, r6_id]])
+        # Check
+        self.assertEqual(result.get(),
+                         "2 recharges ready to process, 2 unrecoverable")
+        r1 = Recharge.objects.get(id=r1_id)
+        self.assertEqual((r1.msisdn, r1.network_code, r1.status),
+                         ("+27724455545", "MTN", 0))
+        r2 = Recharge.objects.get(id=r2_id)
+        self.assertEqual((r2.msisdn, r2.status, r2.status_message),
+                         ("272134567890", 4, "Invalid msisdn"))
+        r3 = Recharge.objects.get(id=r3_id)
+        self.assertEqual((r3.msisdn, r3.network_code, r3.status),
+                         ("+27844525677", "CELLC", 0))
+        r4 = Recharge.objects.get(id=r4_id)
+        self.assertEqual((r4.msisdn, r4.status), ("0724455545", 2))
+        r5 = Recharge.objects.get(id=r5_id)
+        self.assertEqual(r5.status, None)
+        r6 = Recharge.objects.get(id=r6_id)
+        self.assertEqual((r6.msisdn, r6.status, r6.status_message),
+                         ("+27214567890", 4, "Network lookup failed"))
+
+    def test_ready_recharges_claims_unreadied(self):
+        # Setup
+        r1_id = self.make_recharge(msisdn="0724455545")
+        r2_id = self.make_recharge(msisdn="0844525677")
+        r3_id = self.make_recharge(msisdn="0761000001")
+        # Execute
+        with self.settings(RECHARGE_READY_BATCH_SIZE=2):
+            result = ready_recharges.apply_async()
+        # Check
+        self.assertEqual(result.get(),
+                         "2 recharges ready to process, 0 unrecoverable")
+        self.assertEqual(Recharge.objects.get(id=r1_id).status, 0)
+        self.assertEqual(Recharge.objects.get(id=r2_id).status, 0)
+        self.assertEqual(Recharge.objects.get(id=r3_id).status, None)
+
+    def test_ready_recharges_counts_updated_rows(self):
+        # Setup
+        r1_id = self.make_recharge(msisdn="0724455545")
+        r2_id = self.make_recharge(msisdn="0844525677")
+
+        def lookup_racing_sweep(msisdns):
+            # Another sweep readies r2 after this one read it
+            Recharge.objects.filter(id=r2_id).update(
+                status=0, network_code="VOD")
+            return lookup_network_codes(msisdns)
+        # Execute
+        with patch("recharges.tasks.lookup_network_codes",
+                   lookup_racing_sweep):
+            result = ready_recharges.apply_async(args=[[r1_id, r2_id]])
+        # Check
+        self.assertEqual(result.get(),
+                         "1 recharges ready to process, 0 unrecoverable")
+        self.assertEqual(Recharge.objects.get(id=r2_id).network_code, "VOD")
+
+
+class TestSubmitOnReady(TaskTestCase):
+    """Test readying chains straight into Hotsocket submission"""
+
+    @responses.activate
+    def test_make_recharge_submits_when_ready(self):
+        # Setup
+        self.make_account()
+        expected_response_good = {
+            "response": {
+                "hotsocket_ref": 4487,
+                "serveport_ref": 4487,
+                "message": "Successfully submitted recharge",
+                "status": "0000",
+            }
+        }
+        responses.add(
+            responses.POST,
+            "http://test-hotsocket/recharge",
+            json.dumps(expected_response_good),
+            status=200, content_type='application/json')
+        post_save.connect(recharge_post_save, sender=Recharge)
+        try:
+            with self.settings(RECHARGE_SUBMIT_ON_READY=True):
+                # Execute
+                recharge_id = self.make_recharge(msisdn="0724455545")
+        finally:
+            post_save.disconnect(recharge_post_save, sender=Recharge)
+        # Check
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertEqual(recharge.hotsocket_ref, 4487)
+        self.assertIsNotNone(recharge.next_check_at)
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_ready_recharge_claims_before_submitting(self):
+        # Setup
+        recharge_id = self.make_recharge(msisdn="0724455545")
+        # Execute
+        with self.settings(RECHARGE_SUBMIT_ON_READY=True), \
+                patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            ready_recharge.apply_async(kwargs={"recharge_id": recharge_id})
+            result = hotsocket_process_queue.apply_async(args=[])
+        # Check
+        # Queued once, and not again by the sweep
+        submit.assert_called_once_with(args=[recharge_id], expires=900)
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 5)
+        self.assertEqual(result.get(), "0 requests queued to Hotsocket")
+
+    def test_make_recharge_unrecoverable_not_submitted(self):
+        # Setup
+        post_save.connect(recharge_post_save, sender=Recharge)
+        try:
+            with self.settings(RECHARGE_SUBMIT_ON_READY=True):
+                # Execute
+                recharge_id = self.make_recharge(msisdn="0214567890")
+        finally:
+            post_save.disconnect(recharge_post_save, sender=Recharge)
+        # Check
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 4)
+
+    def test_ready_recharges_submits_ready(self):
+        # Setup
+        r1_id = self.make_recharge(msisdn="0724455545")
+        r2_id = self.make_recharge(msisdn="0214567890")
+        # Execute
+        with self.settings(RECHARGE_SUBMIT_ON_READY=True), \
+                patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            ready_recharges.apply_async(args=[[r1_id, r2_id]])
+        # Check
+        submit.assert_called_once_with(args=[r1_id], expires=900)
+
+    def test_ready_recharges_waits_for_sweep(self):
+        # Setup
+        r1_id = self.make_recharge(msisdn="0724455545")
+        # Execute
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            ready_recharges.apply_async(args=[[r1_id]])
+        # Check
+        self.assertEqual(submit.call_count, 0)
+
+
+class TestRechargeTransition(TaskTestCase):
+    """Test compare-and-set status transitions"""
+
+    def test_transition_wins_once(self):
+        # Setup
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        first = Recharge.objects.transition(recharge_id, (0, 5), 1,
+                                            reference=1234)
+        second = Recharge.objects.transition(recharge_id, (0, 5), 1,
+                                             reference=5678)
+        # Check
+        self.assertTrue(first)
+        self.assertFalse(second)
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertEqual(recharge.reference, 1234)
+
+    def test_transition_from_none(self):
+        # Setup
+        recharge_id = self.make_recharge()
+        recharge = Recharge.objects.get(id=recharge_id)
+        # Execute
+        won = recharge.transition(None, 4, status_message="Nope")
+        # Check
+        self.assertTrue(won)
+        self.assertEqual(recharge.status, 4)
+        self.assertEqual(recharge.status_message, "Nope")
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 4)
+
+    def test_claim_for_submission(self):
+        # Setup
+        recharge = Recharge.objects.get(id=self.make_recharge(status=5))
+        other = Recharge.objects.get(id=self.make_recharge(status=0))
+        # Execute
+        with self.assertNumQueries(4):
+            # A block of references, then a savepoint around each claim
+            won = recharge.claim_for_submission()
+        other_won = other.claim_for_submission()
+        # Check
+        self.assertTrue(won)
+        self.assertTrue(other_won)
+        self.assertEqual(recharge.status, 1)
+        self.assertIsNotNone(recharge.reference)
+        self.assertEqual(other.reference, recharge.reference + 1)
+        self.assertEqual(Recharge.objects.get(id=recharge.id).reference,
+                         recharge.reference)
+        # A claimed recharge is not claimed again
+        self.assertFalse(recharge.claim_for_submission())
+
+    def test_claim_for_submission_skips_taken_reference(self):
+        # Setup
+        reference = allocate_reference()
+        # A recharge given a random reference before the sequence existed
+        legacy_id = self.make_recharge(status=2)
+        Recharge.objects.filter(id=legacy_id).update(reference=reference + 1)
+        reference_allocator.block = [reference + 2, reference + 1]
+        recharge = Recharge.objects.get(id=self.make_recharge(status=0))
+        # Execute
+        won = recharge.claim_for_submission()
+        # Check
+        self.assertTrue(won)
+        self.assertEqual(recharge.reference, reference + 2)
+
+    def test_hotsocket_get_airtime_lost_claim(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(msisdn="+277244555", status=0)
+        # Another worker claims the recharge after it has been read
+        with patch("recharges.models.Recharge.transition",
+                   return_value=False):
+            # Execute
+            result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(),
+                         "airtime request for +277244555 already in process"
+                         " by another worker")
+
 
 class TestTaskUtils(TaskTestCase):
     """Test standalone functions defined in tasks"""
@@ -233,6 +727,48 @@ class TestTaskUtils(TaskTestCase):
         # Check
         self.assertEqual(result, "+27724455545")
 
+    def test_normalize_msisdn_strict(self):
+        normalizer = get_normalizer()
+        self.assertEqual(normalizer.normalize("0027724455545"),
+                         "+27724455545")
+        self.assertEqual(normalizer.normalize("724455545"), "+27724455545")
+        self.assertEqual(normalizer.normalize("+27 (72) 445-5545"),
+                         "+27724455545")
+        for msisdn in ["+2772", "072445554", "07244555450", "0024455545",
+                       "+447700900123", "not a number"]:
+            with self.assertRaises(InvalidMsisdn):
+                normalizer.normalize(msisdn)
+        with self.assertRaises(InvalidMsisdn):
+            normalizer.normalize("0724455545", country_code="44")
+
+    def test_normalize_msisdn_multi_country(self):
+        rules = {
+            '27': {'national_lengths': [9]},
+            '254': {'national_lengths': [9], 'trunk_prefix': '0'},
+            '1': {'national_lengths': [10], 'trunk_prefix': '1',
+                  'international_prefix': '011'},
+        }
+        with self.settings(MSISDN_COUNTRY_RULES=rules):
+            self.assertEqual(normalize_msisdn("0712345678", '254'),
+                             "+254712345678")
+            self.assertEqual(normalize_msisdn("0724455545"),
+                             "+27724455545")
+            self.assertEqual(normalize_msisdn("+254712345678"),
+                             "+254712345678")
+            self.assertEqual(normalize_msisdn("011 27 72 445 5545", '1'),
+                             "+27724455545")
+            self.assertEqual(normalize_msisdn("1 (212) 555-0123", '1'),
+                             "+12125550123")
+        with self.assertRaises(InvalidMsisdn):
+            get_normalizer().normalize("+254712345678")
+
+    def test_normalize_msisdns(self):
+        result = normalize_msisdns(
+            ["0724455545", "+27844525677", "00724455545", "123", ""])
+        self.assertEqual(
+            result, ["+27724455545", "+27844525677", "+27724455545",
+                     None, None])
+
     def test_lookup_network_code(self):
         msisdn_cellc = '+27844525677'
         cellc = lookup_network_code(msisdn_cellc)
@@ -270,6 +806,122 @@ class TestTaskUtils(TaskTestCase):
         unknown = lookup_network_code(msisdn_unknown)
         self.assertEqual(unknown, False)
 
+    def test_lookup_network_codes(self):
+        result = lookup_network_codes(
+            ['+27844525677', '+278110000001', '+272134567890', ''])
+        self.assertEqual(result, ["CELLC", "TELKOM", False, False])
+
+    def test_network_prefix_index_longest_match(self):
+        index = NetworkPrefixIndex({"A": ["+2782"], "B": ["+27821"]})
+        self.assertEqual(index.lookup("+27821234567"), "B")
+        self.assertEqual(index.lookup("+27822234567"), "A")
+        self.assertEqual(index.lookup("+278"), None)
+        self.assertEqual(index.lookup_many(["+27821", "+2783"]), ["B", None])
+
+    def test_lookup_network_code_prefix_file(self):
+        # Setup
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"TELKOM": ["+2721"]}, f)
+        self.addCleanup(os.remove, path)
+        # Execute
+        with self.settings(NETWORK_PREFIX_FILE=path):
+            network = lookup_network_code('+272134567890')
+        # Check
+        self.assertEqual(network, "TELKOM")
+        self.assertEqual(lookup_network_code('+272134567890'), False)
+
+
+class TestImportRecharges(TaskTestCase):
+    """Test the import_recharges management command"""
+
+    def write_file(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def import_file(self, path, **kwargs):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_recharges', path, stdout=stdout, stderr=stderr,
+                     **kwargs)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_csv(self):
+        # Setup
+        path = self.write_file('.csv', (
+            "msisdn,amount,product_code\n"
+            "0724455545,10.00,AIRTIME\n"
+            "0844525677,5.50,\n"
+            "0214567890,10.00,AIRTIME\n"
+            "0724455545,lots,AIRTIME\n"
+            "0724455545,10.00,PINS\n"))
+        # Execute
+        out, err = self.import_file(path, chunk_size=1)
+        # Check
+        self.assertIn("Imported 2 recharges, rejected 3 rows", out)
+        self.assertIn("rows/s", out)
+        self.assertIn("Rejected line 4: Network lookup failed", err)
+        self.assertIn("Rejected line 5:", err)
+        self.assertIn("Rejected line 6:", err)
+        recharges = Recharge.objects.order_by('id')
+        self.assertEqual(
+            [(r.msisdn, r.network_code, r.status, r.product_code)
+             for r in recharges],
+            [("+27724455545", "MTN", 0, "AIRTIME"),
+             ("+27844525677", "CELLC", 0, "AIRTIME")])
+
+    def test_import_csv_utf8(self):
+        # Setup
+        path = self.write_file('.csv', (
+            u"msisdn,amount,product_code,name\n"
+            u"0724455545,10.00,AIRTIME,Zo\u00eb Ndlovu\n"
+            u"072445554\u00e9,10.00,AIRTIME,Th\u00e9o\n"))
+        # Execute
+        out, err = self.import_file(path)
+        # Check
+        self.assertIn("Imported 1 recharges, rejected 1 rows", out)
+        self.assertIn(u"Rejected line 3: Invalid msisdn 072445554\u00e9", err)
+        recharge = Recharge.objects.get()
+        self.assertEqual(recharge.msisdn, "+27724455545")
+
+    def test_import_ndjson(self):
+        # Setup
+        path = self.write_file('.ndjson', (
+            '{"msisdn": "0724455545", "amount": "10.00"}\n'
+            '\n'
+            'not json\n'
+            '{"msisdn": "+27761000001", "amount": 20, '
+            '"product_code": "DATA"}\n'))
+        # Execute
+        out, err = self.import_file(path)
+        # Check
+        self.assertIn("Imported 2 recharges, rejected 1 rows", out)
+        self.assertIn("Rejected line 3: Invalid JSON object", err)
+        recharge = Recharge.objects.get(msisdn="+27761000001")
+        self.assertEqual(recharge.network_code, "VOD")
+        self.assertEqual(recharge.product_code, "DATA")
+        self.assertEqual(recharge.status, 0)
+
+
+class TestExplainHotQueries(TaskTestCase):
+    """Test the explain_hot_queries management command"""
+
+    def test_explain_hot_queries(self):
+        # Setup
+        stdout = StringIO()
+        # Execute
+        call_command('explain_hot_queries', seed=10, stdout=stdout)
+        # Check
+        output = stdout.getvalue()
+        self.assertIn("== hotsocket_process_queue claim", output)
+        self.assertIn("== get_token", output)
+        self.assertIn("Execution", output)
+        self.assertEqual(Recharge.objects.count(), 10)
+
 
 class TestHotsocketLogin(TaskTestCase):
     """Test related to hotsocket_login task"""
@@ -356,70 +1008,471 @@ class TestHotsocketLogin(TaskTestCase):
         tokens = Account.objects.all().count()
         self.assertEqual(tokens, 0)
 
-
-class TestHotsocketProcessQueue(TaskTestCase):
-    """Test related to hotsocket_process_queue task"""
-
     @responses.activate
-    def test_hotsocket_process_queue(self):
+    def test_refresh_hotsocket_token_prunes_accounts(self):
         # Setup
-        with patch("recharges.tasks.hotsocket_check_status.apply_async",
-                   lambda args, countdown: True):
-            self.make_account()
-            r1_id = self.make_recharge(status=0)
-            r2_id = self.make_recharge(status=1)
-            r3_id = self.make_recharge(status=2)
-            r4_id = self.make_recharge(status=0)
-
-            recharge_ids = [r1_id, r2_id, r3_id, r4_id]
-            for recharge_id in recharge_ids:
-                recharge = Recharge.objects.get(id=recharge_id)
-                recharge.network_code = "VOD"
-                recharge.save()
-
-            expected_response_good = {
-                "response": {
-                    "hotsocket_ref": 4487,
-                    "serveport_ref": 4487,
-                    "message": "Successfully submitted recharge",
-                    "status": "0000",
-                    "token": "myprocessqueue"
-                }
-            }
-            responses.add(
-                responses.POST,
-                "http://test-hotsocket/recharge",
-                json.dumps(expected_response_good),
-                status=200, content_type='application/json')
+        self.make_account(token='old')
+        self.make_account(token='recent')
+        Account.objects.filter(token='old').update(
+            created_at=timezone.now() - timedelta(days=2))
+        responses.add(
+            responses.POST,
+            "http://test-hotsocket/login",
+            json.dumps({"response": {"message": "Login Successful.",
+                                     "status": "0000",
+                                     "token": "mytesttoken"}}),
+            status=200, content_type='application/json')
 
-            # Execute
-            result = hotsocket_process_queue.apply_async(args=[])
-            # Check
-            self.assertEqual(result.get(), "2 requests queued to Hotsocket")
-            r1 = Recharge.objects.get(id=r1_id)
-            r2 = Recharge.objects.get(id=r2_id)
-            r3 = Recharge.objects.get(id=r3_id)
-            r4 = Recharge.objects.get(id=r4_id)
-            self.assertEqual(r1.status, 1)
-            self.assertEqual(r2.status, 1)
-            self.assertEqual(r3.status, 2)
-            self.assertEqual(r4.status, 1)
+        # Execute
+        result = hotsocket_login.apply_async(args=[])
+        # Check
+        self.assertEqual(result.get(), True)
+        self.assertEqual(
+            sorted(Account.objects.values_list('token', flat=True)),
+            ["mytesttoken", "recent"])
 
-            self.assertEqual(len(responses.calls), 2)
 
+class TestTokenProvider(TaskTestCase):
+    """Test the shared Hotsocket token provider"""
 
-class TestHotsocketGetAirtime(TaskTestCase):
-    """Test related to hotsocket_get_airtime task"""
+    def add_login_response(self, status="0000", token="mytesttoken"):
+        responses.add(
+            responses.POST,
+            "http://test-hotsocket/login",
+            json.dumps({"response": {"message": "Login",
+                                     "status": status,
+                                     "token": token}}),
+            status=200, content_type='application/json')
 
-    def test_prep_hotsocket_data(self):
+    def test_get_token_cached(self):
         # Setup
         self.make_account()
-        recharge_id = self.make_recharge()
+        token_provider.reset()
+        cache.clear()
+        # Execute
+        self.assertEqual(token_provider.get_token(), '1234')
+        # Check
+        with self.assertNumQueries(0):
+            self.assertEqual(token_provider.get_token(), '1234')
+        token_provider.reset()
+        with self.assertNumQueries(0):
+            self.assertEqual(token_provider.get_token(), '1234')
+
+    @responses.activate
+    def test_get_token_logs_in_without_token(self):
+        # Setup
+        self.add_login_response()
+        # Execute
+        token = token_provider.get_token()
+        # Check
+        self.assertEqual(token, "mytesttoken")
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_get_token_refreshes_ahead_of_expiry(self):
+        # Setup
+        self.add_login_response()
+        token_provider.set_token('1234', time.time() -
+                                 token_provider.lifetime + 60)
+        # Execute
+        token = token_provider.get_token()
+        # Check
+        self.assertEqual(token, "mytesttoken")
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(cache.get(token_provider.cache_key)['token'],
+                         "mytesttoken")
+        self.assertIsNone(cache.get(token_provider.lock_key))
+
+    @responses.activate
+    def test_get_token_refresh_locked(self):
+        # Setup
+        token_provider.set_token('1234', time.time() -
+                                 token_provider.lifetime + 60)
+        cache.add(token_provider.lock_key, 1)
+        # Execute
+        token = token_provider.get_token()
+        # Check
+        self.assertEqual(token, '1234')
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_get_token_unavailable(self):
+        # Setup
+        self.add_login_response(status="5010")
+        # Execute
+        # Check
+        self.assertRaises(TokenUnavailable, token_provider.get_token)
+
+    def test_invalidate_keeps_replaced_token(self):
+        # Setup
+        token_provider.set_token('5555')
+        # Execute
+        token_provider.invalidate('1234')
+        # Check
+        self.assertEqual(cache.get(token_provider.cache_key)['token'],
+                         '5555')
+
+        # Execute
+        token_provider.invalidate('5555')
+        # Check
+        self.assertIsNone(cache.get(token_provider.cache_key))
+
+
+class TestHotsocketClient(TaskTestCase):
+    """Test the pooled Hotsocket client"""
+
+    def add_connection_error(self, path):
+        responses.add(
+            responses.POST, "http://test-hotsocket%s" % path,
+            body=requests.ConnectionError("Connection refused"))
+
+    def test_get_client_shared(self):
+        # Execute
+        client = get_client()
+        # Check
+        self.assertIs(get_client(), client)
+        self.assertEqual(client.endpoint, "http://test-hotsocket")
+        adapter = client.session.get_adapter("http://test-hotsocket")
+        self.assertEqual(adapter._pool_maxsize, 10)
+
+    @responses.activate
+    def test_status_retried_on_connection_error(self):
+        # Setup
+        client = HotsocketClient(status_retries=1)
+        self.add_connection_error("/status")
+        self.add_response_sequence(
+            "/status", {"response": {"status": "0000"}})
+        # Execute
+        result = client.status({"token": "1234", "reference": 1})
+        # Check
+        self.assertEqual(result["response"]["status"], "0000")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_status_retries_limited(self):
+        # Setup
+        client = HotsocketClient(status_retries=2)
+        self.add_connection_error("/status")
+        # Execute
+        # Check
+        self.assertRaises(requests.ConnectionError, client.status,
+                          {"token": "1234", "reference": 1})
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_recharge_not_retried(self):
+        # Setup
+        client = HotsocketClient(status_retries=2)
+        self.add_connection_error("/recharge")
+        # Execute
+        # Check
+        self.assertRaises(requests.ConnectionError, client.recharge,
+                          {"token": "1234", "reference": 1})
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_timeouts(self):
+        # Setup
+        client = HotsocketClient(connect_timeout=1, read_timeout=2)
+        with patch.object(client.session, "post") as post:
+            post.return_value.json.return_value = {"response": {}}
+            # Execute
+            client.login({"username": "user"})
+        # Check
+        post.assert_called_once_with("http://test-hotsocket/login",
+                                     data={"username": "user"},
+                                     timeout=(1, 2))
+
+
+@skipIf(AsyncHotsocketDispatcher is None, "Needs Python 3.4+ and aiohttp")
+class TestAsyncHotsocketDispatcher(TaskTestCase):
+    """Test the asyncio dispatcher with the HTTP calls replaced"""
+
+    def make_dispatcher(self, *results):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        dispatcher = AsyncHotsocketDispatcher(
+            loop, concurrency=10, batch_size=10, poll_interval=0)
+        results = list(results)
+        self.posted = []
+
+        def post(path, data, network_code=None):
+            self.posted.append((path, data))
+            future = asyncio.Future(loop=loop)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+            return future
+
+        dispatcher.post = post
+        return loop, dispatcher
+
+    def test_run_once_submits_backlog(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=0)
+        done_id = self.make_recharge(status=2)
+        loop, dispatcher = self.make_dispatcher(
+            {"response": {"hotsocket_ref": 4487, "status": "0000"}})
+        # Execute
+        loop.run_until_complete(dispatcher.run(once=True))
+        loop.run_until_complete(dispatcher.close())
+        # Check
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertEqual(recharge.hotsocket_ref, 4487)
+        self.assertGreater(recharge.next_check_at, timezone.now())
+        self.assertEqual(Recharge.objects.get(id=done_id).status, 2)
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(self.posted[0][0], "/recharge")
+        self.assertEqual(self.posted[0][1]["token"], "1234")
+
+    def test_submit_failure(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        loop, dispatcher = self.make_dispatcher(
+            {"response": {"message": "Invalid product", "status": 6011}})
+        # Execute
+        loop.run_until_complete(dispatcher.submit(recharge_id))
+        # Check
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 3)
+        self.assertEqual(recharge.status_message, "Invalid product")
+        self.assertIsNone(recharge.next_check_at)
+
+    def test_submit_request_failed(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        loop, dispatcher = self.make_dispatcher(
+            aiohttp.ClientResponseError("Server disconnected"))
+        # Execute
+        loop.run_until_complete(dispatcher.submit(recharge_id))
+        # Check
+        # It may have been sent, so its status is checked
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertIsNotNone(recharge.submitted_at)
+        self.assertEqual(recharge.status_checks, 0)
+        self.assertGreater(recharge.next_check_at, timezone.now())
+
+    def test_submit_not_connected(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        loop, dispatcher = self.make_dispatcher(
+            NotConnected("Cannot connect to host"))
+        # Execute
+        loop.run_until_complete(dispatcher.submit(recharge_id))
+        # Check
+        # Nothing was sent, so it is submitted again after a backoff
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 0)
+        self.assertEqual(recharge.attempts, 1)
+        self.assertIsNotNone(recharge.next_attempt_at)
+        self.assertIsNone(recharge.next_check_at)
+
+    def test_submit_without_token(self):
+        # Setup
+        recharge_id = self.make_recharge(status=5)
+        loop, dispatcher = self.make_dispatcher()
+        # Execute
+        with patch("recharges.dispatcher.get_token",
+                   side_effect=TokenUnavailable("Hotsocket login failed")):
+            loop.run_until_complete(dispatcher.submit(recharge_id))
+        # Check
+        self.assertEqual(self.posted, [])
+        # Submitted again once a login succeeds
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 0)
+
+    def test_token_refresh_does_not_block_loop(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        loop, dispatcher = self.make_dispatcher(
+            {"response": {"status": 887, "message": "Invalid token"}},
+            {"response": {"hotsocket_ref": 4487, "status": "0000"}})
+        ticks = []
+
+        def tick():
+            ticks.append(time.time())
+            if len(ticks) < 5:
+                loop.call_later(0.01, tick)
+
+        def slow_replace_token(rejected):
+            time.sleep(0.2)
+            return "5678"
+        # Execute
+        with patch("recharges.dispatcher.token_provider.replace_token",
+                   slow_replace_token):
+            loop.call_soon(tick)
+            loop.run_until_complete(dispatcher.submit(recharge_id))
+        # Check
+        # The loop kept running while the token was replaced
+        self.assertLess(ticks[-1] - ticks[0], 0.15)
+        self.assertEqual(self.posted[1][1]["token"], "5678")
+        self.assertEqual(Recharge.objects.get(id=recharge_id).hotsocket_ref,
+                         4487)
+
+    def test_run_once_checks_due(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        Recharge.objects.filter(id=recharge_id).update(
+            next_check_at=timezone.now())
+        loop, dispatcher = self.make_dispatcher(
+            {"response": {"status": "0000",
+                          "recharge_status": "Successful",
+                          "recharge_status_cd": 3}})
+        # Execute
+        loop.run_until_complete(dispatcher.run(once=True))
+        loop.run_until_complete(dispatcher.close())
+        # Check
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 2)
+        self.assertEqual(self.posted[0][0], "/status")
+
+
+class TestHotsocketProcessQueue(TaskTestCase):
+    """Test related to hotsocket_process_queue task"""
+
+    @responses.activate
+    def test_hotsocket_process_queue(self):
+        # Setup
+        with patch("recharges.tasks.hotsocket_check_status.apply_async",
+                   lambda args, countdown: True):
+            self.make_account()
+            r1_id = self.make_recharge(status=0)
+            r2_id = self.make_recharge(status=1)
+            r3_id = self.make_recharge(status=2)
+            r4_id = self.make_recharge(status=0)
+
+            recharge_ids = [r1_id, r2_id, r3_id, r4_id]
+            for recharge_id in recharge_ids:
+                recharge = Recharge.objects.get(id=recharge_id)
+                recharge.network_code = "VOD"
+                recharge.save()
+
+            expected_response_good = {
+                "response": {
+                    "hotsocket_ref": 4487,
+                    "serveport_ref": 4487,
+                    "message": "Successfully submitted recharge",
+                    "status": "0000",
+                    "token": "myprocessqueue"
+                }
+            }
+            responses.add(
+                responses.POST,
+                "http://test-hotsocket/recharge",
+                json.dumps(expected_response_good),
+                status=200, content_type='application/json')
+
+            # Execute
+            result = hotsocket_process_queue.apply_async(args=[])
+            # Check
+            self.assertEqual(result.get(), "2 requests queued to Hotsocket")
+            r1 = Recharge.objects.get(id=r1_id)
+            r2 = Recharge.objects.get(id=r2_id)
+            r3 = Recharge.objects.get(id=r3_id)
+            r4 = Recharge.objects.get(id=r4_id)
+            self.assertEqual(r1.status, 1)
+            self.assertEqual(r2.status, 1)
+            self.assertEqual(r3.status, 2)
+            self.assertEqual(r4.status, 1)
+
+            self.assertEqual(len(responses.calls), 2)
+
+    def test_hotsocket_process_queue_claims_once(self):
+        # Setup
+        r1_id = self.make_recharge(status=0)
+        r2_id = self.make_recharge(status=0)
+        r3_id = self.make_recharge(status=1)
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            # Execute
+            with self.settings(HOTSOCKET_QUEUE_BATCH_SIZE=1):
+                first = hotsocket_process_queue.apply_async(args=[])
+            second = hotsocket_process_queue.apply_async(args=[])
+        # Check
+        self.assertEqual(first.get(), "2 requests queued to Hotsocket")
+        self.assertEqual(second.get(), "0 requests queued to Hotsocket")
+        self.assertEqual(
+            sorted(c[1]["args"][0] for c in submit.call_args_list),
+            [r1_id, r2_id])
+        self.assertEqual(Recharge.objects.get(id=r1_id).status, 5)
+        self.assertEqual(Recharge.objects.get(id=r2_id).status, 5)
+        self.assertEqual(Recharge.objects.get(id=r3_id).status, 1)
+
+    def test_hotsocket_process_queue_max_per_run(self):
+        # Setup
+        for _ in range(3):
+            self.make_recharge(status=0)
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async"):
+            # Execute
+            with self.settings(HOTSOCKET_QUEUE_BATCH_SIZE=2,
+                               HOTSOCKET_QUEUE_MAX_PER_RUN=2):
+                result = hotsocket_process_queue.apply_async(args=[])
+        # Check
+        self.assertEqual(result.get(), "2 requests queued to Hotsocket")
+        self.assertEqual(Recharge.objects.filter(status=0).count(), 1)
+
+    def test_hotsocket_process_queue_queued_max(self):
+        # Setup
+        self.make_recharge(status=5)
+        for _ in range(3):
+            self.make_recharge(status=0)
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async"):
+            with self.settings(HOTSOCKET_QUEUED_MAX=3):
+                # Execute
+                first = hotsocket_process_queue.apply_async(args=[])
+                second = hotsocket_process_queue.apply_async(args=[])
+        # Check
+        self.assertEqual(first.get(), "2 requests queued to Hotsocket")
+        self.assertEqual(second.get(),
+                         "3 recharges already queued, 0 requests queued")
+        self.assertEqual(Recharge.objects.filter(status=0).count(), 1)
+
+    def test_hotsocket_process_queue_releases_stale(self):
+        # Setup
+        r1_id = self.make_recharge(status=5)
+        r2_id = self.make_recharge(status=5)
+        r3_id = self.make_recharge(status=5)
+        Recharge.objects.filter(id=r1_id).update(
+            updated_at=timezone.now() - timedelta(hours=1))
+        # A rate limited retry may still be waiting to run
+        Recharge.objects.filter(id=r3_id).update(
+            updated_at=timezone.now() - timedelta(minutes=15, seconds=30))
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            # Execute
+            result = hotsocket_process_queue.apply_async(args=[])
+        # Check
+        self.assertEqual(result.get(), "1 requests queued to Hotsocket")
+        submit.assert_called_once_with(args=[r1_id], expires=900)
+        self.assertEqual(Recharge.objects.get(id=r2_id).status, 5)
+        self.assertEqual(Recharge.objects.get(id=r3_id).status, 5)
+
+
+class TestHotsocketGetAirtime(TaskTestCase):
+    """Test related to hotsocket_get_airtime task"""
+
+    def test_prep_hotsocket_data(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=0)
         recharge = Recharge.objects.get(id=recharge_id)
         recharge.network_code = "VOD"
         recharge.save()
+        recharge.claim_for_submission()
+        token_provider.get_token()
         # Execute
-        hotsocket_data = hotsocket_get_airtime.prep_hotsocket_data(recharge)
+        with self.assertNumQueries(0):
+            # The reference was written by the claim
+            hotsocket_data = hotsocket_get_airtime.prep_hotsocket_data(
+                recharge)
         # Check
         # Plus should be dropped
         self.assertEqual(hotsocket_data["recipient_msisdn"], "27820003453")
@@ -429,6 +1482,7 @@ class TestHotsocketGetAirtime(TaskTestCase):
         self.assertEqual(hotsocket_data["product_code"], 'AIRTIME')
         self.assertEqual(hotsocket_data["network_code"], 'VOD')
         recharge = Recharge.objects.get(id=recharge_id)
+        self.assertIsNotNone(recharge.reference)
         self.assertEqual(hotsocket_data["reference"], recharge.reference)
 
     @responses.activate
@@ -495,6 +1549,8 @@ class TestHotsocketGetAirtime(TaskTestCase):
             self.assertEqual(recharge.status, 1)
             self.assertEqual(recharge.hotsocket_ref, 4487)
             self.assertIsNotNone(recharge.reference)
+            self.assertIsNotNone(recharge.submitted_at)
+            self.assertEqual(recharge.status_checks, 0)
             # test for the correct URL request
             self.assertEqual(len(responses.calls), 1)
             self.assertEqual(responses.calls[0].request.url,
@@ -502,6 +1558,39 @@ class TestHotsocketGetAirtime(TaskTestCase):
             self.assertEqual(recharge.msisdn, '+27711455657')
             self.assertEqual(recharge.network_code, 'VOD')
 
+    @responses.activate
+    def test_hotsocket_get_airtime_invalid_token(self):
+        # Setup
+        with patch("recharges.tasks.hotsocket_check_status.apply_async",
+                   lambda args, countdown: True):
+            self.make_account()
+            self.add_response_sequence(
+                "/recharge",
+                {"response": {"message": "Invalid token", "status": 887}},
+                {"response": {"hotsocket_ref": 4487,
+                              "message": "Successfully submitted recharge",
+                              "status": "0000"}})
+            self.add_response_sequence(
+                "/login",
+                {"response": {"message": "Login Successful.",
+                              "status": "0000",
+                              "token": "mynewtoken"}})
+            recharge_id = self.make_recharge(status=0)
+            Recharge.objects.filter(id=recharge_id).update(
+                network_code="VOD")
+            # Execute
+            result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+            # Check
+            self.assertEqual(result.get(), "Recharge for +27820003453: "
+                             "Queued at Hotsocket #4487")
+            urls = [call.request.url for call in responses.calls]
+            self.assertEqual(urls, ["http://test-hotsocket/recharge",
+                                    "http://test-hotsocket/login",
+                                    "http://test-hotsocket/recharge"])
+            self.assertIn("token=1234", responses.calls[0].request.body)
+            self.assertIn("token=mynewtoken", responses.calls[2].request.body)
+            self.assertEqual(get_token(), "mynewtoken")
+
     @responses.activate
     def test_hotsocket_get_airtime_fails_no_message(self):
         # Setup
@@ -574,6 +1663,149 @@ class TestHotsocketGetAirtime(TaskTestCase):
             self.assertEqual(responses.calls[0].request.url,
                              "http://test-hotsocket/recharge")
 
+    @responses.activate
+    def test_hotsocket_get_airtime_system_error_retried(self):
+        # Setup
+        self.make_account()
+        self.add_response_sequence(
+            "/recharge",
+            {"response": {"status": 5000, "message": "System error"}},
+            {"response": {"status": "0000", "hotsocket_ref": 4487,
+                          "message": "Successfully submitted recharge"}})
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket failure, attempt 2 of 5 scheduled")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 0)
+        self.assertEqual(recharge.status_message, "System error")
+        self.assertEqual(recharge.attempts, 1)
+        self.assertGreater(recharge.next_attempt_at,
+                           timezone.now() + timedelta(seconds=10))
+        first_reference = recharge.reference
+        self.assertEqual(recharge.attempt_history[0]["reference"],
+                         first_reference)
+        self.assertEqual(recharge.attempt_history[0]["status"], 5000)
+        # Not claimed again until its backoff ends
+        self.assertEqual(Recharge.objects.claim_unprocessed(10), [])
+
+        # Execute
+        Recharge.objects.filter(id=recharge_id).update(
+            next_attempt_at=timezone.now())
+        self.assertEqual(Recharge.objects.claim_unprocessed(10),
+                         [recharge_id])
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Queued at Hotsocket #4487")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertEqual(recharge.attempts, 2)
+        # Each attempt is made with a new reference
+        self.assertNotEqual(recharge.reference, first_reference)
+        self.assertEqual(
+            [(a["reference"], a["status"]) for a in recharge.attempt_history],
+            [(first_reference, 5000), (recharge.reference, 0)])
+
+    @responses.activate
+    def test_hotsocket_get_airtime_retries_exhausted(self):
+        # Setup
+        self.make_account()
+        self.add_response_sequence(
+            "/recharge",
+            {"response": {"status": 5000, "message": "System error"}})
+        recharge_id = self.make_recharge(status=0)
+        Recharge.objects.filter(id=recharge_id).update(attempts=4)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket failure")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 3)
+        self.assertEqual(recharge.attempts, 5)
+        self.assertIsNotNone(recharge.completed_at)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_permanent_error(self):
+        # Setup
+        self.make_account()
+        self.add_response_sequence(
+            "/recharge",
+            {"response": {"status": 6013, "message": "Non-numeric msisdn"}})
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket failure")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 3)
+        self.assertEqual(recharge.attempts, 1)
+        self.assertIsNone(recharge.next_attempt_at)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_connect_timeout_retried(self):
+        # Setup
+        self.make_account()
+        responses.add(
+            responses.POST, "http://test-hotsocket/recharge",
+            body=requests.ConnectTimeout("Connection timed out"))
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket failure, attempt 2 of 5 scheduled")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 0)
+        self.assertEqual(recharge.attempt_history[0]["status"], None)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_connection_refused_retried(self):
+        # Setup
+        self.make_account()
+        refused = NewConnectionError(None, "Connection refused")
+        responses.add(
+            responses.POST, "http://test-hotsocket/recharge",
+            body=requests.ConnectionError(MaxRetryError(
+                None, "/recharge", refused)))
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket failure, attempt 2 of 5 scheduled")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 0)
+        self.assertIsNone(recharge.next_check_at)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_login_down(self):
+        # Setup
+        responses.add(
+            responses.POST, "http://test-hotsocket/login",
+            json.dumps({"response": {
+                "status": "5010",
+                "message": "Login Failure. Incorrect Username or "
+                           "Password."}}),
+            status=200, content_type='application/json')
+        recharge_id = self.make_recharge(status=0)
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "No Hotsocket token, recharge for "
+                         "+27820003453 left unprocessed")
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(responses.calls[0].request.url,
+                         "http://test-hotsocket/login")
+        # Claimed again by hotsocket_process_queue
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 0)
+        self.assertEqual(Recharge.objects.claim_unprocessed(10),
+                         [recharge_id])
+
     def test_hotsocket_get_airtime_in_process(self):
         # Setup
         self.make_account()
@@ -653,7 +1885,8 @@ class TestHotsocketCheckStatus(TaskTestCase):
             json.dumps(expected_response_good),
             status=200, content_type='application/json')
         # Execute
-        result = hotsocket_check_status.request_hotsocket_status(recharge_id)
+        result = hotsocket_check_status.request_hotsocket_status(
+            Recharge.objects.get(id=recharge_id))
         # Check
         self.assertEqual(result["response"]["status"], "0000")
         self.assertEqual(len(responses.calls), 1)
@@ -664,7 +1897,7 @@ class TestHotsocketCheckStatus(TaskTestCase):
     def test_check_hotsocket_status_submitted(self):
         # Setup
         self.make_account()
-        recharge_id = self.make_recharge()
+        recharge_id = self.make_recharge(status=1)
 
         expected_response = {
             "response": {
@@ -681,25 +1914,88 @@ class TestHotsocketCheckStatus(TaskTestCase):
             json.dumps(expected_response),
             status=200, content_type='application/json')
 
-        # Execute and catch loop
-        with pytest.raises(exceptions.MaxRetriesExceededError) as excinfo:
-            hotsocket_check_status.apply_async(args=[recharge_id])
-        assert "Can't retry recharges.tasks.hotsocket_check_status" in \
-            str(excinfo.value)
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
 
         # Check
-        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(result.get(),
+                         "Recharge for +27820003453 pending. Check requeued.")
+        self.assertEqual(len(responses.calls), 1)
         recharge = Recharge.objects.get(id=recharge_id)
         self.assertEqual(recharge.status, 1)
         self.assertEqual(recharge.status_message, "Successful")
+        self.assertEqual(recharge.status_checks, 1)
+        self.assertIsNotNone(recharge.checked_at)
+        # The poller checks it again after a backed off delay
+        self.assertGreater(recharge.next_check_at,
+                           timezone.now() + timedelta(seconds=90))
         self.assertEqual(responses.calls[0].request.url,
                          "http://test-hotsocket/status")
 
+    @responses.activate
+    def test_check_hotsocket_status_expired_token(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        self.add_response_sequence(
+            "/status",
+            {"response": {"message": "Token expired", "status": "889"}},
+            {"response": {"status": "0000",
+                          "message": "Status lookup successful.",
+                          "recharge_status": "Successful",
+                          "running_balance": 0,
+                          "recharge_status_cd": 3}})
+        self.add_response_sequence(
+            "/login",
+            {"response": {"message": "Login Successful.",
+                          "status": "0000",
+                          "token": "mynewtoken"}})
+
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
+
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453 successful")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 2)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertIn("token=mynewtoken", responses.calls[2].request.body)
+
+    @responses.activate
+    def test_check_hotsocket_status_token_refreshed_once(self):
+        # Setup
+        self.make_account()
+        token_provider.set_token("mynewtoken")
+        recharge_id = self.make_recharge(status=1)
+        self.add_response_sequence(
+            "/status",
+            {"response": {"message": "Invalid token", "status": 887}},
+            {"response": {"status": "0000",
+                          "message": "Status lookup successful.",
+                          "recharge_status": "Successful",
+                          "running_balance": 0,
+                          "recharge_status_cd": 3}})
+
+        # Execute
+        # Another worker already replaced the rejected token, so there is
+        # no second login
+        hotsocket_data = hotsocket_check_status.prep_hotsocket_status_dict(
+            recharge_id)
+        hotsocket_data["token"] = "1234"
+        result = get_client().status(hotsocket_data)
+
+        # Check
+        self.assertEqual(result["response"]["recharge_status_cd"], 3)
+        urls = [call.request.url for call in responses.calls]
+        self.assertEqual(urls, ["http://test-hotsocket/status",
+                                "http://test-hotsocket/status"])
+        self.assertIn("token=mynewtoken", responses.calls[1].request.body)
+
     @responses.activate
     def test_check_hotsocket_status_presuberror(self):
         # Setup
         self.make_account()
-        recharge_id = self.make_recharge()
+        recharge_id = self.make_recharge(status=1)
 
         expected_response = {
             "response": {
@@ -732,7 +2028,7 @@ class TestHotsocketCheckStatus(TaskTestCase):
     def test_check_hotsocket_status_failed(self):
         # Setup
         self.make_account()
-        recharge_id = self.make_recharge()
+        recharge_id = self.make_recharge(status=1)
         status_message = "MNO reports invalid MSISDN (not prepaid). "\
                          "You have not been billed for this."
 
@@ -765,11 +2061,84 @@ class TestHotsocketCheckStatus(TaskTestCase):
         self.assertEqual(responses.calls[0].request.url,
                          "http://test-hotsocket/status")
 
+    @responses.activate
+    def test_check_hotsocket_status_system_error(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        self.add_response_sequence("/status", {"response": {
+            "status": 5000, "message": "System error"}})
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(),
+                         "Hotsocket system error. Check requeued.")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        self.assertEqual(recharge.status_checks, 1)
+        self.assertGreater(recharge.next_check_at, timezone.now())
+
+    @responses.activate
+    def test_check_hotsocket_status_system_error_checks_exhausted(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        Recharge.objects.filter(id=recharge_id).update(status_checks=19)
+        self.add_response_sequence("/status", {"response": {
+            "status": 5000, "message": "System error"}})
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge status for +27820003453 "
+                         "unknown after 20 checks")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 3)
+        self.assertEqual(recharge.status_message, "System error")
+        self.assertIsNotNone(recharge.completed_at)
+
+    def test_check_hotsocket_status_token_rejected_lost_race(self):
+        # Setup
+        recharge_id = self.make_recharge(status=1)
+        recharge = Recharge.objects.get(id=recharge_id)
+        # Completed by another worker meanwhile
+        Recharge.objects.filter(id=recharge_id).update(status=2)
+        # Execute
+        result = hotsocket_check_status.handle_status_result(
+            recharge, {"response": {"status": 887}},
+            hotsocket_check_status.get_logger())
+        # Check
+        self.assertEqual(result, "Recharge for +27820003453 is no longer "
+                         "in process")
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status_checks,
+                         0)
+
+    @responses.activate
+    def test_check_hotsocket_status_rejected(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        self.add_response_sequence("/status", {"response": {
+            "status": 6017, "message": "Reference must be a numeric value."}})
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(),
+                         "Recharge status lookup for +27820003453 rejected. "
+                         "Reason: Reference must be a numeric value.")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 3)
+        self.assertEqual(recharge.status_message,
+                         "Reference must be a numeric value.")
+        self.assertIsNotNone(recharge.completed_at)
+        # Not recorded as a failed submission
+        self.assertEqual(recharge.attempts, 0)
+        self.assertEqual(recharge.attempt_history, [])
+
     @responses.activate
     def test_check_hotsocket_status_success(self):
         # Setup
         self.make_account()
-        recharge_id = self.make_recharge()
+        recharge_id = self.make_recharge(status=1)
 
         expected_response = {
             "response": {
@@ -797,3 +2166,1072 @@ class TestHotsocketCheckStatus(TaskTestCase):
         self.assertEqual(recharge.status_message, "Successful")
         self.assertEqual(responses.calls[0].request.url,
                          "http://test-hotsocket/status")
+
+    @responses.activate
+    def test_check_hotsocket_status_not_in_process(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=2)
+
+        expected_response = {
+            "response": {
+                "status": "0000",
+                "message": "Status lookup successful.",
+                "recharge_status": "MNO returned an unspecified error.",
+                "running_balance": 0,
+                "recharge_status_cd": 2,
+            }
+        }
+        responses.add(
+            responses.POST,
+            "http://test-hotsocket/status",
+            json.dumps(expected_response),
+            status=200, content_type='application/json')
+
+        # Execute
+        result = hotsocket_check_status.apply_async(args=[recharge_id])
+
+        # Check
+        self.assertEqual(result.get(),
+                         "Recharge for +27820003453 is no longer in process")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 2)
+        self.assertEqual(recharge.status_message, None)
+
+
+class TestHotsocketPollStatus(TaskTestCase):
+    """Test related to hotsocket_poll_status task"""
+
+    def make_in_process(self, next_check_at, status=1):
+        recharge_id = self.make_recharge(status=status)
+        Recharge.objects.filter(id=recharge_id).update(
+            reference=recharge_id, next_check_at=next_check_at)
+        return recharge_id
+
+    def add_status_response(self, recharge_status_cd):
+        responses.add(
+            responses.POST,
+            "http://test-hotsocket/status",
+            json.dumps({"response": {
+                "status": "0000",
+                "message": "Status lookup successful.",
+                "recharge_status": "Status %s" % recharge_status_cd,
+                "running_balance": 0,
+                "recharge_status_cd": recharge_status_cd}}),
+            status=200, content_type='application/json')
+
+    @responses.activate
+    def test_hotsocket_poll_status(self):
+        # Setup
+        self.make_account()
+        now = timezone.now()
+        due_ids = [self.make_in_process(now - timedelta(seconds=1)),
+                   self.make_in_process(now - timedelta(minutes=10))]
+        later_id = self.make_in_process(now + timedelta(minutes=5))
+        done_id = self.make_in_process(now - timedelta(minutes=1), status=2)
+        self.add_status_response(3)
+
+        # Execute
+        result = hotsocket_poll_status.apply_async(args=[])
+
+        # Check
+        self.assertEqual(result.get(), "2 recharge statuses checked")
+        self.assertEqual(len(responses.calls), 2)
+        for recharge_id in due_ids:
+            recharge = Recharge.objects.get(id=recharge_id)
+            self.assertEqual(recharge.status, 2)
+            self.assertIsNotNone(recharge.completed_at)
+        self.assertEqual(Recharge.objects.get(id=later_id).status, 1)
+        self.assertEqual(Recharge.objects.get(id=done_id).status, 2)
+
+    @responses.activate
+    def test_hotsocket_poll_status_batches(self):
+        # Setup
+        self.make_account()
+        for _ in range(5):
+            self.make_in_process(timezone.now())
+        self.add_status_response(0)
+
+        # Execute
+        with self.settings(HOTSOCKET_POLL_BATCH_SIZE=2,
+                           HOTSOCKET_POLL_MAX_PER_RUN=4):
+            result = hotsocket_poll_status.apply_async(args=[])
+
+        # Check
+        self.assertEqual(result.get(), "4 recharge statuses checked")
+        self.assertEqual(len(responses.calls), 4)
+        # Pending recharges are not due again for five minutes
+        self.assertEqual(Recharge.objects.filter(
+            next_check_at__lte=timezone.now()).count(), 1)
+
+    @responses.activate
+    def test_hotsocket_poll_status_lookup_failed(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_in_process(timezone.now())
+        responses.add(
+            responses.POST, "http://test-hotsocket/status",
+            body=requests.ConnectionError("Connection refused"))
+
+        # Execute
+        result = hotsocket_poll_status.apply_async(args=[])
+
+        # Check
+        self.assertEqual(result.get(), "1 recharge statuses checked")
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        # Checked again when the lease ends
+        self.assertGreater(recharge.next_check_at,
+                           timezone.now() + timedelta(minutes=4))
+
+
+class TestPollingPolicy(TaskTestCase):
+    """Test the learned status polling schedule"""
+
+    def make_completed(self, count, latency, checked_after=None,
+                       network_code="VOD", status=2):
+        now = timezone.now()
+        submitted_at = now - timedelta(seconds=latency)
+        checked_at = None
+        if checked_after is not None:
+            checked_at = submitted_at + timedelta(seconds=checked_after)
+        for _ in range(count):
+            Recharge.objects.create(
+                amount=10, msisdn="+27820000000", network_code=network_code,
+                status=status, submitted_at=submitted_at,
+                checked_at=checked_at, completed_at=now)
+
+    def test_first_check_delay_default(self):
+        # Setup
+        self.make_completed(19, 40)
+        # Execute
+        # Check
+        # Too few samples to learn from
+        self.assertEqual(first_check_delay("VOD", "AIRTIME"), 60)
+        self.assertEqual(first_check_delay("MTN", "AIRTIME"), 60)
+
+    def test_first_check_delay_learned(self):
+        # Setup
+        # Found final at 40s, after being pending at 10s, so estimated
+        # final at 25s
+        self.make_completed(10, 40, checked_after=10)
+        self.make_completed(10, 40, checked_after=10, status=3)
+        self.make_completed(20, 600, network_code="MTN")
+        # Execute
+        delay = first_check_delay("VOD", "AIRTIME")
+        # Check
+        self.assertAlmostEqual(delay, 25)
+        self.assertAlmostEqual(first_check_delay("MTN", "AIRTIME"), 300)
+        self.assertEqual(first_check_delay("VOD", "DATA"), 60)
+
+    def test_latency_percentiles_cached(self):
+        # Setup
+        self.make_completed(20, 40)
+        get_latency_percentiles()
+        # Execute
+        # Check
+        with self.assertNumQueries(0):
+            self.assertAlmostEqual(first_check_delay("VOD", "AIRTIME"), 20)
+
+    def test_check_delay_backs_off(self):
+        # Setup
+        # Execute
+        with self.settings(HOTSOCKET_POLL_JITTER=0):
+            delays = [check_delay("VOD", "AIRTIME", checks)
+                      for checks in (0, 1, 2, 10, 1000)]
+        # Check
+        self.assertEqual(delays, [60, 120, 240, 30 * 60, 30 * 60])
+
+    def test_check_delay_jitter(self):
+        # Setup
+        # Execute
+        delays = [check_delay("VOD", "AIRTIME", 1) for _ in range(50)]
+        # Check
+        self.assertTrue(all(96 <= delay <= 144 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+
+class TestRateLimiter(TaskTestCase):
+    """Test the Hotsocket token bucket rate limits"""
+
+    limits = {
+        '/recharge': {'*': (1, 2), 'MTN': (10, 1)},
+    }
+
+    def test_token_bucket(self):
+        # Setup
+        limiter = RateLimiter(MemoryBucketBackend(), self.limits)
+        # Execute
+        waits = [limiter.acquire('/recharge', 'VOD', now=100)
+                 for _ in range(3)]
+        # Check
+        # The burst is used up, then tokens refill at the rate
+        self.assertEqual(waits, [0, 0, 1])
+        self.assertEqual(limiter.acquire('/recharge', 'VOD', now=100.5),
+                         0.5)
+        self.assertEqual(limiter.acquire('/recharge', 'VOD', now=101), 0)
+
+    def test_buckets_per_endpoint_and_network(self):
+        # Setup
+        limiter = RateLimiter(MemoryBucketBackend(), self.limits)
+        # Execute
+        # Check
+        self.assertEqual(limiter.acquire('/recharge', 'MTN', now=100), 0)
+        self.assertAlmostEqual(
+            limiter.acquire('/recharge', 'MTN', now=100), 0.1)
+        # Networks without their own limit share the default bucket
+        self.assertEqual(limiter.acquire('/recharge', 'VOD', now=100), 0)
+        self.assertEqual(limiter.acquire('/recharge', 'CELLC', now=100), 0)
+        self.assertEqual(limiter.acquire('/recharge', 'TELKOM', now=100), 1)
+        # Endpoints without limits are not limited
+        self.assertEqual(limiter.acquire('/login', None, now=100), 0)
+
+    def test_wait_rate_limited(self):
+        # Setup
+        limiter = RateLimiter(MemoryBucketBackend(), self.limits)
+        limiter.acquire('/recharge', 'MTN')
+        # Execute
+        # Check
+        with self.settings(HOTSOCKET_RATE_LIMIT_MAX_WAIT=0):
+            self.assertRaises(RateLimited, limiter.wait, '/recharge', 'MTN')
+        with self.settings(HOTSOCKET_RATE_LIMIT_MAX_WAIT=1):
+            self.assertGreater(limiter.wait('/recharge', 'MTN'), 0)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_rate_limited(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        Recharge.objects.filter(id=recharge_id).update(network_code="VOD")
+        with self.settings(HOTSOCKET_RATE_LIMITS=self.limits,
+                           HOTSOCKET_RATE_LIMIT_MAX_WAIT=0):
+            get_rate_limiter().acquire('/recharge', 'VOD')
+            get_rate_limiter().acquire('/recharge', 'VOD')
+            # Execute
+            with patch.object(hotsocket_get_airtime, "retry",
+                              side_effect=Retry()) as retry:
+                self.assertRaises(Retry, hotsocket_get_airtime.run,
+                                  recharge_id)
+        # Check
+        retry.assert_called_once_with(args=[recharge_id], countdown=1,
+                                      max_retries=None, expires=901)
+        self.assertEqual(len(responses.calls), 0)
+        # Queued again, to be claimed by the retry
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 5)
+
+    @responses.activate
+    def test_hotsocket_poll_status_rate_limited(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=1)
+        Recharge.objects.filter(id=recharge_id).update(
+            network_code="VOD", next_check_at=timezone.now())
+        limits = {'/status': {'*': (0.1, 1)}}
+        with self.settings(HOTSOCKET_RATE_LIMITS=limits,
+                           HOTSOCKET_RATE_LIMIT_MAX_WAIT=0):
+            get_rate_limiter().acquire('/status', 'VOD')
+            # Execute
+            result = hotsocket_poll_status.apply_async(args=[])
+        # Check
+        self.assertEqual(result.get(), "1 recharge statuses checked")
+        self.assertEqual(len(responses.calls), 0)
+        recharge = Recharge.objects.get(id=recharge_id)
+        self.assertEqual(recharge.status, 1)
+        # Due again when the bucket has a token, not when the lease ends
+        self.assertLess(recharge.next_check_at,
+                        timezone.now() + timedelta(seconds=11))
+
+
+class TestCircuitBreaker(TaskTestCase):
+    """Test the shared Hotsocket circuit breakers"""
+
+    def fail_requests(self, breaker, count, elapsed=0.1):
+        for _ in range(count):
+            breaker.record(breaker.allow(), True, elapsed)
+
+    def test_opens_on_errors(self):
+        # Setup
+        breaker = get_breaker("/recharge")
+        for _ in range(10):
+            breaker.record(breaker.allow(), False, 0.1)
+        # Execute
+        self.fail_requests(breaker, 9)
+        # Check
+        self.assertEqual(breaker.state()[0], "closed")
+        self.fail_requests(breaker, 1)
+        self.assertEqual(breaker.state()[0], "open")
+        self.assertRaises(CircuitOpen, breaker.allow)
+        # Other endpoints are not affected
+        self.assertEqual(get_breaker("/status").state()[0], "closed")
+
+    def test_opens_on_slow_responses(self):
+        # Setup
+        breaker = get_breaker("/status")
+        # Execute
+        for _ in range(20):
+            breaker.record(breaker.allow(), False, 10)
+        # Check
+        self.assertEqual(breaker.state()[0], "open")
+
+    def test_half_open_probe(self):
+        # Setup
+        breaker = get_breaker("/recharge")
+        breaker.trip()
+        cache.delete(breaker.key("open"))
+        # Execute
+        probe = breaker.allow()
+        # Check
+        self.assertTrue(probe)
+        self.assertEqual(breaker.state()[0], "half-open")
+        self.assertEqual(breaker.request_limit(500), 1)
+        # Only one probe at a time
+        self.assertRaises(CircuitOpen, breaker.allow)
+
+        # Execute
+        breaker.record(probe, False, 0.1)
+        # Check
+        self.assertEqual(breaker.state()[0], "closed")
+        self.assertEqual(breaker.request_limit(500), 500)
+        self.assertFalse(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        # Setup
+        breaker = get_breaker("/recharge")
+        breaker.trip()
+        cache.delete(breaker.key("open"))
+        # Execute
+        breaker.record(breaker.allow(), True, 0.1)
+        # Check
+        self.assertEqual(breaker.state()[0], "open")
+        self.assertEqual(breaker.request_limit(500), 0)
+
+    @responses.activate
+    def test_client_releases_probe(self):
+        # Setup
+        breaker = get_breaker("/status")
+        breaker.trip()
+        cache.delete(breaker.key("open"))
+        responses.add(
+            responses.POST, "http://test-hotsocket/status",
+            body=requests.exceptions.ChunkedEncodingError("Truncated"))
+        client = HotsocketClient()
+        # Execute
+        with patch("recharges.ratelimit.RateLimiter.wait",
+                   side_effect=RateLimited(60)):
+            self.assertRaises(RateLimited, client.status,
+                              {"token": "1234", "reference": 1})
+        self.assertRaises(requests.exceptions.ChunkedEncodingError,
+                          client.status, {"token": "1234", "reference": 1})
+        # Check
+        # The rate limited request never took the probe, and the failed
+        # probe opened the circuit again rather than holding it half open
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(breaker.state()[0], "open")
+
+    @responses.activate
+    def test_client_records_system_errors(self):
+        # Setup
+        self.add_response_sequence(
+            "/status", {"response": {"status": 5000,
+                                     "message": "System error"}})
+        client = HotsocketClient()
+        # Execute
+        for _ in range(20):
+            client.status({"token": "1234", "reference": 1})
+        # Check
+        self.assertEqual(len(responses.calls), 20)
+        self.assertRaises(CircuitOpen, client.status,
+                          {"token": "1234", "reference": 1})
+        self.assertEqual(len(responses.calls), 20)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_circuit_open(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        get_breaker("/recharge").trip()
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Hotsocket unavailable, recharge "
+                         "for +27820003453 left unprocessed")
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(Recharge.objects.get(id=recharge_id).status, 0)
+
+    @responses.activate
+    def test_hotsocket_get_airtime_connection_error(self):
+        # Setup
+        self.make_account()
+        recharge_id = self.make_recharge(status=5)
+        responses.add(
+            responses.POST, "http://test-hotsocket/recharge",
+            body=requests.ConnectionError("Connection reset"))
+        # Execute
+        result = hotsocket_get_airtime.apply_async(args=[recharge_id])
+        # Check
+        self.assertEqual(result.get(), "Recharge for +27820003453: "
+                         "Hotsocket request failed, status check scheduled")
+        recharge = Recharge.objects.get(id=recharge_id)
+        # Left in process for the status poller rather than failed
+        self.assertEqual(recharge.status, 1)
+        self.assertIsNotNone(recharge.next_check_at)
+
+    def test_hotsocket_process_queue_sheds_load(self):
+        # Setup
+        self.make_recharge(status=0)
+        self.make_recharge(status=0)
+        breaker = get_breaker("/recharge")
+        breaker.trip()
+        # Execute
+        with patch("recharges.tasks.hotsocket_get_airtime.apply_async") \
+                as submit:
+            result = hotsocket_process_queue.apply_async(args=[])
+            # Check
+            self.assertEqual(result.get(),
+                             "Hotsocket circuit open, 0 requests queued")
+            self.assertEqual(submit.call_count, 0)
+
+            # Execute
+            cache.delete(breaker.key("open"))
+            result = hotsocket_process_queue.apply_async(args=[])
+            # Check
+            # Only the probe is queued while half open
+            self.assertEqual(result.get(), "1 requests queued to Hotsocket")
+            self.assertEqual(submit.call_count, 1)
+
+
+class TestRetryPolicy(TaskTestCase):
+    """Test the backoff between submissions of a failed recharge"""
+
+    def test_retry_delay(self):
+        with self.settings(HOTSOCKET_RETRY_JITTER=0):
+            self.assertEqual(retry_delay(1), 30)
+            self.assertEqual(retry_delay(3), 120)
+            self.assertEqual(retry_delay(100), 1800)
+
+    def test_retry_delay_jitter(self):
+        delays = set(retry_delay(1) for _ in range(20))
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertTrue(15 <= delay <= 45)
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable({"response": {"status": "5000"}}))
+        self.assertTrue(is_retryable({"response": {"status": 889}}))
+        self.assertFalse(is_retryable({"response": {"status": 6016}}))
+        self.assertFalse(is_retryable({"response": {}}))
+
+
+class TestFakeHotsocket(TestCase):
+    """Test the fake Hotsocket API used for load testing"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.app = FakeHotsocket(
+            username="user", password="pass",
+            completion_latency=parse_latency("fixed:30"),
+            clock=lambda: self.now, sleep=lambda seconds: None)
+
+    def post(self, path, **data):
+        data.setdefault("as_json", "true")
+        body = urlencode(data).encode("utf-8")
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            "REQUEST_METHOD": "POST", "PATH_INFO": path,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": BytesIO(body)})
+        statuses = []
+        content = b"".join(self.app(
+            environ, lambda status, headers: statuses.append(status)))
+        self.assertEqual(statuses, ["200 OK"])
+        return json.loads(content.decode("utf-8"))["response"]
+
+    def login(self):
+        return self.post("/login", username="user", password="pass")["token"]
+
+    def recharge(self, token, reference=1):
+        return self.post(
+            "/recharge", token=token, username="user",
+            recipient_msisdn="27820003453", product_code="AIRTIME",
+            network_code="VOD", denomination=100, reference=reference)
+
+    def test_login(self):
+        self.assertEqual(
+            self.post("/login", username="user", password="nope")["status"],
+            5010)
+        response = self.post("/test/login/", username="user",
+                             password="pass")
+        self.assertEqual(response["status"], "0000")
+        self.assertTrue(response["token"])
+
+    def test_recharge_progresses_to_success(self):
+        # Setup
+        token = self.login()
+        # Execute
+        response = self.recharge(token, reference=42)
+        # Check
+        self.assertEqual(response["status"], "0000")
+        self.assertEqual(response["hotsocket_ref"], 1)
+        status = self.post("/status", token=token, reference=42)
+        self.assertEqual(status["recharge_status_cd"], 0)
+        self.now += 30
+        status = self.post("/status", token=token, reference=42)
+        self.assertEqual(status["recharge_status_cd"], 3)
+        self.assertEqual(status["recharge_status"], "Successful")
+        # References must be unique
+        self.assertEqual(self.recharge(token, reference=42)["status"], 6016)
+
+    def test_recharge_failure(self):
+        # Setup
+        self.app.failure_rate = 1
+        token = self.login()
+        self.recharge(token)
+        self.now += 30
+        # Execute
+        status = self.post("/status", token=token, reference=1)
+        # Check
+        self.assertEqual(status["recharge_status_cd"], 2)
+
+    def test_token_errors(self):
+        # Setup
+        token = self.login()
+        # Execute
+        invalid = self.recharge("nope")
+        self.now += 7200
+        expired = self.recharge(token)
+        # Check
+        self.assertEqual(invalid["status"], 887)
+        self.assertEqual(expired["status"], 889)
+        self.assertEqual(self.app.recharges, {})
+
+    def test_injected_errors(self):
+        # Setup
+        self.app.error_rates = parse_error_rates(["5000=1"])
+        token = self.login()
+        # Execute
+        response = self.recharge(token)
+        # Check
+        self.assertEqual(response["status"], 5000)
+        self.assertEqual(self.app.requests["recharge"], 1)
+        self.assertRaises(InvalidDistribution, parse_error_rates,
+                          ["6020=0.1"])
+        self.assertRaises(InvalidDistribution, parse_latency, "normal:1")
+
+    def test_latency(self):
+        # Setup
+        slept = []
+        self.app.sleep = slept.append
+        self.app.latencies = {"login": parse_latency("uniform:0.1,0.2")}
+        # Execute
+        self.login()
+        # Check
+        self.assertEqual(len(slept), 1)
+        self.assertTrue(0.1 <= slept[0] <= 0.2)
+
+
+class TestBenchmarkPipeline(TestCase):
+    """Test the pipeline benchmark's statistics"""
+
+    def test_percentile(self):
+        values = [1, 2, 3, 4, 5]
+        self.assertEqual(percentile(values, 0.5), 3)
+        self.assertAlmostEqual(percentile(values, 0.95), 4.8)
+        self.assertEqual(percentile(values, 1), 5)
+        self.assertEqual(percentile([], 0.5), None)
+
+    def test_summarize(self):
+        # Setup
+        start = timezone.now()
+        timings = [(start + timedelta(seconds=i),
+                    start + timedelta(seconds=i + 10)) for i in range(10)]
+        # Execute
+        summary = summarize(timings)
+        # Check
+        self.assertEqual(summary["completed"], 10)
+        # 10 recharges finished in the 19s from the first created
+        self.assertAlmostEqual(summary["throughput"], 10 / 19.0)
+        self.assertEqual(summary["latency"],
+                         {"p50": 10, "p95": 10, "p99": 10})
+
+
+class TestMsisdnBenchmarks(TestCase):
+    """Test the msisdn normalisation and network lookup benchmarks"""
+
+    def test_make_msisdns(self):
+        msisdns = make_msisdns(200, seed=1)
+        self.assertEqual(msisdns, make_msisdns(200, seed=1))
+        self.assertTrue(any(m.startswith("+27") for m in msisdns))
+        self.assertTrue(any(m.startswith("0027") for m in msisdns))
+        self.assertTrue(any(len(m) <= 5 for m in msisdns))
+
+    @skipIf(not os.environ.get("RUN_BENCHMARKS"),
+            "Timing check, run with RUN_BENCHMARKS=1")
+    def test_within_thresholds(self):
+        # Execute
+        results = run_benchmarks(count=2000, repeat=3)
+        # Check
+        self.assertEqual(sorted(results), ["lookup_network_code",
+                                           "lookup_network_codes",
+                                           "normalize_msisdn",
+                                           "normalize_msisdns"])
+        self.assertEqual(check_thresholds(results, load_thresholds()), [])
+
+    def test_slower_implementation_fails(self):
+        # Setup
+        def slow_lookup(msisdn):
+            time.sleep(0.0001)
+            return "VOD"
+        # Execute
+        with patch("recharges.benchmarks.lookup_network_code", slow_lookup):
+            with self.assertRaises(CommandError) as cm:
+                call_command("benchmark_msisdns", "--count", "50",
+                             "--repeat", "1", "--check", stdout=StringIO())
+        # Check
+        self.assertIn("lookup_network_code ns_per_op", str(cm.exception))
+        self.assertNotIn("normalize_msisdn", str(cm.exception))
+
+
+class TestTaskQueryCounts(TaskTestCase):
+    """
+    Pin the queries and broker publishes of each task for batches of N
+    recharges, so an N+1 pattern or an extra save fails here
+    """
+    sizes = (1, 10)
+
+    def cold_start(self):
+        """
+        Drops the per-worker token, latency and reference caches, as in a
+        freshly started worker
+        """
+        cache.clear()
+        token_provider.reset()
+        reference_allocator.reset()
+
+    def make_recharges(self, n, status=None):
+        return [self.make_recharge(status=status) for _ in range(n)]
+
+    def make_in_process(self, n, next_check_at=None):
+        recharge_ids = self.make_recharges(n, status=1)
+        for recharge_id in recharge_ids:
+            Recharge.objects.filter(id=recharge_id).update(
+                reference=recharge_id, network_code="VOD",
+                next_check_at=next_check_at or timezone.now())
+        return recharge_ids
+
+    def add_status_response(self, recharge_status_cd):
+        self.add_response_sequence("/status", {"response": {
+            "status": "0000",
+            "message": "Status lookup successful.",
+            "recharge_status": "Status %s" % recharge_status_cd,
+            "running_balance": 0,
+            "recharge_status_cd": recharge_status_cd}})
+
+    def test_ready_recharge(self):
+        for n in self.sizes:
+            recharge_ids = self.make_recharges(n)
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: [ready_recharge.apply(args=[recharge_id])
+                         for recharge_id in recharge_ids])
+            # Check
+            # A get and a transition per recharge
+            self.assertEqual(queries, 2 * n)
+            self.assertEqual(published, [])
+
+    def test_ready_recharges(self):
+        for n in self.sizes:
+            recharge_ids = self.make_recharges(n)
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: ready_recharges.apply(args=[recharge_ids]))
+            # Check
+            # The rows, then one UPDATE per network inside a savepoint
+            self.assertEqual(queries, 4)
+            self.assertEqual(published, [])
+
+    def test_ready_recharges_sweep(self):
+        for n in self.sizes:
+            self.make_recharges(n)
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: ready_recharges.apply())
+            # Check
+            # Plus the query for unreadied ids
+            self.assertEqual(queries, 5)
+            self.assertEqual(published, [])
+
+    def test_ready_recharges_submit_on_ready(self):
+        for n in self.sizes:
+            recharge_ids = self.make_recharges(n)
+            # Execute
+            with self.settings(RECHARGE_SUBMIT_ON_READY=True):
+                queries, published = count_queries_and_publishes(
+                    lambda: ready_recharges.apply(args=[recharge_ids]))
+            # Check
+            # Plus the claim of the ready recharges
+            self.assertEqual(queries, 5)
+            self.assertEqual(published,
+                             [hotsocket_get_airtime.name] * n)
+
+    @responses.activate
+    def test_hotsocket_login(self):
+        self.add_response_sequence("/login", {"response": {
+            "message": "Login Successful.",
+            "status": "0000",
+            "token": "mytesttoken"}})
+        for n in self.sizes:
+            for _ in range(n):
+                self.make_account()
+            Account.objects.update(
+                created_at=timezone.now() - timedelta(days=30))
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: hotsocket_login.apply())
+            # Check
+            # The INSERT and a single DELETE of the old accounts
+            self.assertEqual(queries, 2)
+            self.assertEqual(published, [])
+            self.assertEqual(Account.objects.count(), 1)
+
+    def test_hotsocket_process_queue(self):
+        for n in self.sizes:
+            self.make_recharges(n, status=0)
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: hotsocket_process_queue.apply())
+            # Check
+            # Releasing stale queued recharges, counting the queued ones,
+            # then one claim
+            self.assertEqual(queries, 3)
+            self.assertEqual(published, [hotsocket_get_airtime.name] * n)
+
+    @responses.activate
+    def test_hotsocket_get_airtime(self):
+        self.make_account()
+        self.add_response_sequence("/recharge", {"response": {
+            "hotsocket_ref": 4487,
+            "serveport_ref": 4487,
+            "message": "Successfully submitted recharge",
+            "status": "0000"}})
+        for n in self.sizes:
+            recharge_ids = self.make_recharges(n, status=0)
+            self.cold_start()
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: [hotsocket_get_airtime.apply(args=[recharge_id])
+                         for recharge_id in recharge_ids])
+            # Check
+            # The token, a block of references and the latency stats once,
+            # then a get, a claim in a savepoint and a transition each
+            self.assertEqual(queries, 3 + 5 * n)
+            self.assertEqual(published, [])
+            self.assertEqual(Recharge.objects.filter(
+                id__in=recharge_ids, status=1).count(), n)
+
+    @responses.activate
+    def test_hotsocket_check_status(self):
+        self.make_account()
+        self.add_status_response(3)
+        for n in self.sizes:
+            recharge_ids = self.make_in_process(n)
+            self.cold_start()
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: [hotsocket_check_status.apply(args=[recharge_id])
+                         for recharge_id in recharge_ids])
+            # Check
+            # The token once, then a get and a transition each
+            self.assertEqual(queries, 1 + 2 * n)
+            self.assertEqual(published, [])
+
+    @responses.activate
+    def test_hotsocket_check_status_pending(self):
+        self.make_account()
+        self.add_status_response(0)
+        for n in self.sizes:
+            recharge_ids = self.make_in_process(n)
+            self.cold_start()
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: [hotsocket_check_status.apply(args=[recharge_id])
+                         for recharge_id in recharge_ids])
+            # Check
+            # Plus the latency stats for the next check
+            self.assertEqual(queries, 2 + 2 * n)
+            self.assertEqual(published, [])
+
+    @responses.activate
+    def test_hotsocket_poll_status(self):
+        self.make_account()
+        self.add_status_response(3)
+        for n in self.sizes:
+            self.make_in_process(n)
+            self.cold_start()
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: hotsocket_poll_status.apply())
+            # Check
+            # The token, the claim and the recharges once, then a
+            # transition each
+            self.assertEqual(queries, 3 + n)
+            self.assertEqual(published, [])
+
+    @responses.activate
+    def test_hotsocket_poll_status_pending(self):
+        self.make_account()
+        self.add_status_response(0)
+        for n in self.sizes:
+            recharge_ids = self.make_in_process(n)
+            self.cold_start()
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: hotsocket_poll_status.apply())
+            # Check
+            # Plus the latency stats for the next check
+            self.assertEqual(queries, 4 + n)
+            self.assertEqual(published, [])
+            # Not due again in this test
+            Recharge.objects.filter(id__in=recharge_ids).update(status=2)
+
+    def test_hotsocket_poll_status_nothing_due(self):
+        # Execute
+        queries, published = count_queries_and_publishes(
+            lambda: hotsocket_poll_status.apply())
+        # Check
+        self.assertEqual(queries, 1)
+        self.assertEqual(published, [])
+
+
+class TestAPIQueryCounts(AuthenticatedAPITestCase):
+    """
+    Pin the queries and broker publishes of each REST endpoint for N
+    recharges. Token authentication costs one query per request.
+    """
+    sizes = (1, 10)
+
+    def test_recharge_list(self):
+        for n in self.sizes:
+            for _ in range(n):
+                Recharge.objects.create(amount=10, msisdn="+27820003453")
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: self.client.get('/api/v1/recharges/'))
+            # Check
+            self.assertEqual(queries, 2)
+            self.assertEqual(published, [])
+
+    def test_recharge_detail(self):
+        recharge = Recharge.objects.create(amount=10, msisdn="+27820003453")
+        # Execute
+        queries, published = count_queries_and_publishes(
+            lambda: self.client.get('/api/v1/recharges/%s/' % recharge.id))
+        # Check
+        self.assertEqual(queries, 2)
+        self.assertEqual(published, [])
+
+    def test_recharge_create(self):
+        # restore post_save hook for this test
+        post_save.connect(recharge_post_save, sender=Recharge)
+        try:
+            for n in self.sizes:
+                # Execute
+                queries, published = count_queries_and_publishes(
+                    lambda: [self.client.post(
+                        '/api/v1/recharges/',
+                        {"amount": 10, "msisdn": "0820003453"},
+                        format='json') for _ in range(n)])
+                # Check
+                # Authentication and the INSERT, readied by one task each
+                self.assertEqual(queries, 2 * n)
+                self.assertEqual(published, [ready_recharge.name] * n)
+        finally:
+            post_save.disconnect(recharge_post_save, sender=Recharge)
+
+    def test_bulk_create(self):
+        for n in self.sizes:
+            rows = [{"amount": 10, "msisdn": "0820003453"}] * n
+            # Execute
+            queries, published = count_queries_and_publishes(
+                lambda: self.client.post('/api/v1/recharges/bulk/', rows,
+                                         format='json'))
+            # Check
+            # Ids allocated and inserted in one chunk, readied by one task
+            self.assertEqual(queries, 3)
+            self.assertEqual(published, [ready_recharges.name])
+
+    def test_bulk_create_chunks(self):
+        for n in self.sizes:
+            rows = [{"amount": 10, "msisdn": "0820003453"}] * n
+            # Execute
+            with self.settings(RECHARGE_BULK_CHUNK_SIZE=1):
+                queries, published = count_queries_and_publishes(
+                    lambda: self.client.post('/api/v1/recharges/bulk/',
+                                             rows, format='json'))
+            # Check
+            self.assertEqual(queries, 1 + 2 * n)
+            self.assertEqual(published, [ready_recharges.name] * n)
+
+    def test_latency_list(self):
+        # Execute
+        cold = count_queries_and_publishes(
+            lambda: self.client.get('/api/v1/latency/'))
+        cached = count_queries_and_publishes(
+            lambda: self.client.get('/api/v1/latency/'))
+        # Check
+        self.assertEqual(cold, (2, []))
+        self.assertEqual(cached, (1, []))
+
+
+@skipIf(not metrics.enabled, "prometheus_client is not installed")
+class TestMetrics(TaskTestCase):
+    """Test the Prometheus metrics"""
+
+    def sample(self, name, **labels):
+        return metrics.registry.get_sample_value(name, labels) or 0
+
+    def recharge_counts(self, response):
+        """
+        Returns the recharge counts on a /metrics response by status and
+        network
+        """
+        return dict(
+            ((sample[1]["status"], sample[1]["network_code"]), sample[2])
+            for family in text_string_to_metric_families(
+                response.content.decode('utf-8'))
+            if family.name == "gopherairtime_recharges"
+            for sample in family.samples)
+
+    def test_metrics_endpoint(self):
+        # Setup
+        self.make_recharge(status=0)
+        self.make_recharge(status=0)
+        self.make_recharge(msisdn="0724455545", status=None)
+        Recharge.objects.filter(status=0).update(network_code="VOD")
+        # Execute
+        response = self.client.get('/metrics')
+        # Check
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        counts = self.recharge_counts(response)
+        self.assertEqual(counts[("Unprocessed", "VOD")], 2)
+        self.assertEqual(counts[("Unreadied", "")], 1)
+        self.assertIn(b"gopherairtime_hotsocket_request_seconds",
+                      response.content)
+
+    def test_recharge_counts_cached(self):
+        # Setup
+        self.make_recharge(status=0)
+        self.client.get('/metrics')
+        self.make_recharge(status=0)
+        # Execute
+        with self.assertNumQueries(0):
+            response = self.client.get('/metrics')
+        # Check
+        self.assertEqual(self.recharge_counts(response),
+                         {("Unprocessed", ""): 1})
+
+    @responses.activate
+    def test_hotsocket_request_metrics(self):
+        # Setup
+        responses.add(
+            responses.POST, "http://test-hotsocket/login",
+            json.dumps({"response": {"status": "0000",
+                                     "message": "Login Successful.",
+                                     "token": "mytesttoken"}}),
+            status=200, content_type='application/json')
+        responses.add(
+            responses.POST, "http://test-hotsocket/status",
+            body=requests.ConnectionError("Connection refused"))
+        client = HotsocketClient()
+        requests_before = self.sample(
+            "gopherairtime_hotsocket_request_seconds_count",
+            endpoint="/status")
+        errors_before = self.sample(
+            "gopherairtime_hotsocket_responses_total",
+            endpoint="/status", code="error")
+        refreshes_before = self.sample(
+            "gopherairtime_token_refreshes_total", result="success")
+        # Execute
+        hotsocket_login.apply()
+        with self.assertRaises(requests.ConnectionError):
+            client.post("/status", {}, retries=1)
+        # Check
+        self.assertGreater(self.sample(
+            "gopherairtime_hotsocket_responses_total",
+            endpoint="/login", code="0"), 0)
+        self.assertEqual(self.sample(
+            "gopherairtime_token_refreshes_total", result="success"),
+            refreshes_before + 1)
+        self.assertEqual(self.sample(
+            "gopherairtime_hotsocket_request_seconds_count",
+            endpoint="/status"), requests_before + 2)
+        self.assertEqual(self.sample(
+            "gopherairtime_hotsocket_responses_total",
+            endpoint="/status", code="error"), errors_before + 2)
+
+    @skipIf(AsyncHotsocketDispatcher is None, "Needs Python 3.4+ and aiohttp")
+    def test_dispatcher_request_metrics(self):
+        # Setup
+        server = make_fake_server('127.0.0.1', 0, FakeHotsocket(),
+                                  quiet=True)
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        dispatcher = AsyncHotsocketDispatcher(loop, concurrency=1,
+                                              batch_size=1)
+        before = self.sample("gopherairtime_hotsocket_responses_total",
+                             endpoint="/login", code="0")
+        # Execute
+        with self.settings(HOTSOCKET_API_ENDPOINT="http://127.0.0.1:%s" %
+                           server.server_port):
+            result = loop.run_until_complete(
+                dispatcher.post("/login", {"as_json": True}))
+        loop.run_until_complete(dispatcher.close())
+        # Check
+        self.assertEqual(result["response"]["message"], "Login Successful.")
+        self.assertEqual(self.sample(
+            "gopherairtime_hotsocket_responses_total",
+            endpoint="/login", code="0"), before + 1)
+
+    def test_worker_exporter_needs_multiprocess_dir(self):
+        # Setup
+        environ = dict((key, value) for key, value in os.environ.items()
+                       if key.lower() != 'prometheus_multiproc_dir')
+        # Execute
+        with self.settings(METRICS_WORKER_PORT=9102), \
+                patch.dict(os.environ, environ, clear=True), \
+                patch("recharges.metrics.start_http_server") as start, \
+                patch("recharges.metrics.logger") as logger:
+            metrics.start_worker_exporter()
+        # Check
+        self.assertEqual(start.call_count, 0)
+        self.assertEqual(logger.error.call_count, 1)
+
+    def test_worker_exporter(self):
+        # Setup
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        # Execute
+        with self.settings(METRICS_WORKER_PORT=9102), \
+                patch.dict(os.environ, prometheus_multiproc_dir=directory), \
+                patch("recharges.metrics.start_http_server") as start:
+            metrics.start_worker_exporter()
+        # Check
+        self.assertEqual(start.call_count, 1)
+        self.assertEqual(start.call_args[0], (9102,))
+
+    def test_task_run_time(self):
+        # Setup
+        recharge_id = self.make_recharge()
+        before = self.sample("gopherairtime_task_seconds_count",
+                             task="recharges.tasks.ready_recharge",
+                             state="SUCCESS")
+        # Execute
+        ready_recharge.apply_async(kwargs={"recharge_id": recharge_id})
+        # Check
+        self.assertEqual(self.sample("gopherairtime_task_seconds_count",
+                                     task="recharges.tasks.ready_recharge",
+                                     state="SUCCESS"), before + 1)
@@ -0,0 +1,147 @@
+import calendar
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class TokenUnavailable(Exception):
+    """
+    Raised when no valid Hotsocket token can be obtained
+    """
+
+
+def to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+class TokenProvider(object):
+    """
+    Serves the current Hotsocket token from process memory, backed by the
+    shared cache and then the Account table. The token is refreshed ahead
+    of its expiry by whichever worker takes the refresh lock first; the
+    others keep using the current token in the meantime.
+    """
+    cache_key = 'hotsocket:token'
+    lock_key = 'hotsocket:token:lock'
+
+    def __init__(self):
+        self.local = None
+
+    @property
+    def lifetime(self):
+        return settings.HOTSOCKET_TOKEN_LIFETIME
+
+    def reset(self):
+        """
+        Forgets the token held in process memory
+        """
+        self.local = None
+
+    def set_token(self, token, issued_at=None):
+        """
+        Publishes a new token to the shared cache and this process
+        """
+        if issued_at is None:
+            issued_at = time.time()
+        entry = {'token': token, 'issued_at': issued_at}
+        cache.set(self.cache_key, entry, self.lifetime)
+        self.local = dict(entry, fetched_at=time.time())
+
+    def invalidate(self, token=None):
+        """
+        Drops the cached token, or only if it is still token so that a
+        token another worker has already replaced is kept
+        """
+        entry = cache.get(self.cache_key)
+        if token is None or (entry and entry['token'] == token):
+            cache.delete(self.cache_key)
+        if token is None or (self.local and self.local['token'] == token):
+            self.local = None
+
+    def load_entry(self):
+        """
+        Returns the shared token entry, seeding the cache from the newest
+        Account if needed
+        """
+        entry = cache.get(self.cache_key)
+        if entry is None:
+            from .models import Account
+            account = Account.objects.order_by('created_at').last()
+            if account is not None:
+                entry = {'token': account.token,
+                         'issued_at': to_timestamp(account.created_at)}
+                if not self.expired(entry):
+                    cache.set(self.cache_key, entry, self.lifetime)
+        return entry
+
+    def expired(self, entry, margin=0):
+        return time.time() - entry['issued_at'] >= self.lifetime - margin
+
+    def refresh(self):
+        """
+        Logs in to Hotsocket if this worker wins the refresh lock. Returns
+        True if a login was attempted.
+        """
+        if not cache.add(self.lock_key, 1,
+                         settings.HOTSOCKET_TOKEN_LOCK_TIMEOUT):
+            return False
+        try:
+            from .tasks import hotsocket_login
+            # The Account post_save hook publishes the new token
+            hotsocket_login.apply()
+        finally:
+            cache.delete(self.lock_key)
+        return True
+
+    def wait_for_token(self, rejected=None):
+        """
+        Returns a valid token, logging in or waiting for the worker that
+        is logging in. A token Hotsocket has rejected is never returned.
+        """
+        deadline = time.time() + settings.HOTSOCKET_TOKEN_LOCK_TIMEOUT
+        while True:
+            entry = self.load_entry()
+            if entry is not None and entry['token'] != rejected and \
+                    not self.expired(entry):
+                self.local = dict(entry, fetched_at=time.time())
+                return entry['token']
+            if self.refresh():
+                entry = cache.get(self.cache_key)
+                if entry is None or entry['token'] == rejected:
+                    raise TokenUnavailable("Hotsocket login failed")
+                continue
+            if time.time() > deadline:
+                raise TokenUnavailable(
+                    "Timed out waiting for a Hotsocket token")
+            time.sleep(0.2)
+
+    def replace_token(self, rejected):
+        """
+        Returns a new token after Hotsocket rejected one as invalid or
+        expired. Only one worker logs in; the rest pick up its token.
+        """
+        self.invalidate(rejected)
+        return self.wait_for_token(rejected)
+
+    def get_token(self):
+        """
+        Returns the current token, refreshing it if it is about to expire
+        """
+        now = time.time()
+        entry = self.local
+        if entry is None or \
+                now - entry['fetched_at'] > settings.HOTSOCKET_TOKEN_LOCAL_TTL:
+            entry = self.load_entry()
+            if entry is not None:
+                entry = dict(entry, fetched_at=now)
+                self.local = entry
+        if entry is None or self.expired(entry):
+            return self.wait_for_token()
+        if self.expired(entry, settings.HOTSOCKET_TOKEN_REFRESH_MARGIN):
+            self.refresh()
+            return (self.local or entry)['token']
+        return entry['token']
+
+
+token_provider = TokenProvider()
@@ -6,6 +6,7 @@ router = routers.DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'groups', views.GroupViewSet)
 router.register(r'recharges', views.RechargeViewSet)
+router.register(r'latency', views.LatencyViewSet, base_name='latency')
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
@@ -1,9 +1,21 @@
 from django.contrib.auth.models import User, Group
+from django.http import Http404, HttpResponse
 from .models import Recharge
-from rest_framework import viewsets
+from rest_framework import viewsets, status
+from rest_framework.decorators import list_route
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from recharges.bulk import bulk_insert_recharges, chunked, get_chunk_size
+from recharges.metrics import CONTENT_TYPE, enabled as metrics_enabled, \
+    render_metrics
+from recharges.parsers import NDJSONParser
+from recharges.polling import first_check_delay, get_latency_percentiles
 from recharges.serializers import (UserSerializer, GroupSerializer,
                                    RechargeSerializer)
+from recharges.tasks import (prepare_recharge, ready_on_ingest,
+                             ready_recharges, submit_on_ready,
+                             submit_recharges)
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -32,3 +44,84 @@ class RechargeViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = Recharge.objects.all()
     serializer_class = RechargeSerializer
+
+    @list_route(methods=['post'], parser_classes=(JSONParser, NDJSONParser))
+    def bulk(self, request):
+        """
+        Creates many recharges from a JSON array or NDJSON body. Valid rows
+        are inserted in chunks and readied with one task per chunk, or
+        before they are inserted if RECHARGE_READY_ON_INGEST is set.
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response(
+                {"detail": "Expected a list of recharges."},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        created = 0
+        inline = ready_on_ingest()
+        valid = self.validate_rows(rows, results)
+        for chunk in chunked(valid, get_chunk_size()):
+            recharges = [recharge for _, recharge in chunk]
+            if inline:
+                for recharge in recharges:
+                    prepare_recharge(recharge)
+            ids = bulk_insert_recharges(recharges)
+            if not inline:
+                ready_recharges.apply_async(args=[ids])
+            elif submit_on_ready():
+                submit_recharges([recharge.id for recharge in recharges
+                                  if recharge.status == 0])
+            for (row, _), recharge_id in zip(chunk, ids):
+                results.append({"row": row, "id": recharge_id})
+            created += len(ids)
+
+        results.sort(key=lambda result: result["row"])
+        response_status = status.HTTP_201_CREATED
+        if rows and not created:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({"created": created,
+                         "errors": len(rows) - created,
+                         "results": results},
+                        status=response_status)
+
+    def validate_rows(self, rows, results):
+        """
+        Yields (row number, unsaved Recharge) for valid rows and records
+        errors for the rest in results
+        """
+        context = self.get_serializer_context()
+        for row, data in enumerate(rows):
+            serializer = RechargeSerializer(data=data, context=context)
+            if serializer.is_valid():
+                yield row, Recharge(**serializer.validated_data)
+            else:
+                results.append({"row": row, "errors": serializer.errors})
+
+
+class LatencyViewSet(viewsets.ViewSet):
+
+    """
+    API endpoint that shows the learned submission to final status latency
+    percentiles, in seconds, and the resulting first status check delay
+    for each network and product.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def list(self, request):
+        stats = get_latency_percentiles()
+        return Response([
+            dict(stat, first_check_delay=first_check_delay(
+                stat["network_code"], stat["product_code"], stats))
+            for stat in stats])
+
+
+def metrics(request):
+    """
+    Prometheus metrics for the recharge pipeline and this process, if
+    prometheus_client is installed
+    """
+    if not metrics_enabled:
+        raise Http404("prometheus_client is not installed")
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)